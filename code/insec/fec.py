@@ -0,0 +1,107 @@
+# Forward error correction of covert bits
+#
+# ------------------------------------------------------------------------------------------------
+"""
+HammingFEC Class
+------------------
+Decoder of the Hamming(7,4) code of sec/fec.py, the code, bit order and
+interleaving must be the same as the sender's.
+
+Every 4 data bits are sent as a 7-bit codeword p1 p2 d1 p3 d2 d3 d4, bit i of
+codeword j of a block of depth codewords is at position i * depth + j of the
+block. The receiver knows which bits are lost (their packets are missing), so
+they are decoded as erasures: a codeword with at most 2 erased bits is rebuilt
+exactly, one with no erasures also has a single flipped bit corrected.
+Decoding is a lookup in a table built once for every (erasure mask, word).
+"""
+# ------------------------------------------------------------------------------------------------
+
+DATA_BITS = 4
+CODE_BITS = 7
+MAX_ERASURES = 2
+UNDECODABLE = 0xFF
+
+def hamming74_encode(d1, d2, d3, d4)->list:
+    # Codeword bits p1 p2 d1 p3 d2 d3 d4 of the data bits, same as sec/fec.py
+    return [d1 ^ d2 ^ d4, d1 ^ d3 ^ d4, d1, d2 ^ d3 ^ d4, d2, d3, d4]
+
+def _syndrome(word)->int:
+    # Position (1..7) of a single flipped bit, 0 for a codeword. Bit of position pos is 1 << (7 - pos)
+    syndrome = 0
+    for pos in range(1, CODE_BITS + 1):
+        if word >> (CODE_BITS - pos) & 1: syndrome ^= pos
+    return syndrome
+
+def _data_nibble(word)->int:
+    # d1 d2 d3 d4 (positions 3, 5, 6, 7) as a 4-bit int
+    return ((word >> 4 & 1) << 3) | (word >> 2 & 1) << 2 | (word >> 1 & 1) << 1 | (word & 1)
+
+def _build_decode_table()->bytearray:
+    # table[mask << 7 | word] = data nibble, word has its erased (mask) bits 0
+    table = bytearray([UNDECODABLE]) * (1 << 2 * CODE_BITS)
+    for mask in range(1 << CODE_BITS):
+        erased = [1 << i for i in range(CODE_BITS) if mask >> i & 1]
+        if len(erased) > MAX_ERASURES: continue
+        for word in range(1 << CODE_BITS):
+            if word & mask: continue
+            for fill in range(1 << len(erased)):
+                candidate = word
+                for n, bit in enumerate(erased):
+                    if fill >> n & 1: candidate |= bit
+                syndrome = _syndrome(candidate)
+                if syndrome == 0:
+                    table[mask << CODE_BITS | word] = _data_nibble(candidate)
+                    break
+                if mask == 0: # No erasure, correct a single flipped bit
+                    table[word] = _data_nibble(candidate ^ (1 << (CODE_BITS - syndrome)))
+    return table
+
+class HammingFEC:
+    name = "hamming"
+    table = None # Built on first use, shared by every instance
+
+    def __init__(self, depth=8):
+        assert depth >= 1, f"[ERROR] Interleaving depth must be at least 1, got {depth}"
+        self.depth = depth
+        self.block_data_bits = DATA_BITS * depth
+        self.block_code_bits = CODE_BITS * depth
+        self.min_bits = CODE_BITS - MAX_ERASURES # Received bits a codeword needs to be decoded
+        if HammingFEC.table is None: HammingFEC.table = _build_decode_table()
+
+    def encoded_len(self, num_bits)->int:
+        num_blocks = -(-num_bits // self.block_data_bits)
+        return num_blocks * self.block_code_bits
+
+    def encode(self, bits)->str:
+        # Same as sec/fec.py, used to replay FEC sessions (see replay_bench.py)
+        num_blocks = -(-len(bits) // self.block_data_bits)
+        data = [int(bit) for bit in bits.ljust(num_blocks * self.block_data_bits, '0')]
+        encoded = []
+        for b in range(num_blocks):
+            block = data[b * self.block_data_bits:(b + 1) * self.block_data_bits]
+            codewords = [hamming74_encode(*block[j * DATA_BITS:(j + 1) * DATA_BITS]) for j in range(self.depth)]
+            encoded += [codewords[j][i] for i in range(CODE_BITS) for j in range(self.depth)]
+        return ''.join(map(str, encoded))
+
+    def codeword_of(self, pos)->tuple:
+        # (codeword index, bit index in the codeword) of encoded bit position pos
+        block, offset = divmod(pos, self.block_code_bits)
+        bit, j = divmod(offset, self.depth)
+        return block * self.depth + j, bit
+
+    def position(self, codeword, bit)->int:
+        # Encoded bit position of bit of codeword, inverse of codeword_of()
+        block, j = divmod(codeword, self.depth)
+        return block * self.block_code_bits + bit * self.depth + j
+
+    def decode(self, word, mask)->int:
+        # Data nibble of a received 7-bit word with erased bits mask, UNDECODABLE if it cannot be rebuilt
+        return self.table[mask << CODE_BITS | (word & ~mask)]
+
+def get_fec(name=None, depth=8):
+    # FEC of the covert bits, None if they are sent as they are
+    if name in (None, "none"):
+        return None
+    if name == HammingFEC.name:
+        return HammingFEC(depth)
+    raise ValueError(f"Unknown FEC {name}. Must be 'none' or '{HammingFEC.name}'.")
@@ -0,0 +1,203 @@
+# Raw socket UDP receiver
+#
+# ------------------------------------------------------------------------------------------------
+"""
+RawUDPReceiver Class
+----------------------
+Receives the UDP datagrams of one destination port through a raw IP socket
+instead of scapy's sniff(), which dissects every packet into scapy layers
+before the receiver even looks at it.
+
+A classic BPF program is attached to the socket, so the kernel drops every
+packet that is not UDP to the given port (and every non-first fragment)
+before it is copied to user space. Several receivers (e.g. one process per
+core) can share the port: the filter can also hash the flow (source IP and
+port) and keep only the flows of one shard. Packets are read in batches with
+recvmmsg(2) into preallocated buffers when libc provides it, and only the
+IP source, UDP header and payload offsets are parsed. Each packet is handed
+to the callback as a PacketView.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import os
+import errno
+import ctypes
+import socket
+import struct
+import selectors
+
+SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+UDP_HEADER_LEN = 8
+
+class PacketView:
+    # Fields of a received UDP packet that CovertReceiver uses
+    __slots__ = ("src", "sport", "dport", "chksum", "payload")
+
+    def __init__(self, src, sport, dport, chksum, payload):
+        self.src = src
+        self.sport = sport
+        self.dport = dport
+        self.chksum = chksum
+        self.payload = payload
+
+    @classmethod
+    def from_scapy(cls, packet):
+        from scapy.all import IP, UDP, Raw
+        return cls(packet[IP].src, packet[UDP].sport, packet[UDP].dport, packet[UDP].chksum, bytes(packet[Raw].load))
+
+# Classic BPF, offsets from the start of the IP header (raw IP sockets see no link layer)
+class _sock_filter(ctypes.Structure):
+    _fields_ = [("code", ctypes.c_uint16), ("jt", ctypes.c_uint8), ("jf", ctypes.c_uint8), ("k", ctypes.c_uint32)]
+
+class _sock_fprog(ctypes.Structure):
+    _fields_ = [("len", ctypes.c_ushort), ("filter", ctypes.POINTER(_sock_filter))]
+
+def udp_port_filter(port, shard=0, num_shards=1)->list:
+    # Same as tcpdump's "udp dst port <port>" on IPv4, as (code, jt, jf, k).
+    # With num_shards > 1, only flows with (source IP + source port) % num_shards == shard
+    # are accepted, so every worker gets a disjoint set of flows.
+    # Jumps are written as "accept"/"drop" and resolved to offsets below.
+    program = [
+        (0x30, 0, 0, 9),          # ldb [9]                IP protocol
+        (0x15, 0, "drop", 17),    # jeq #17 (UDP)          else drop
+        (0x28, 0, 0, 6),          # ldh [6]                flags + fragment offset
+        (0x45, "drop", 0, 0x1fff),# jset #0x1fff           non-first fragment, drop
+        (0xb1, 0, 0, 0),          # ldxb 4*([0]&0xf)       X = IP header length
+        (0x48, 0, 0, 2),          # ldh [x + 2]            UDP destination port
+        (0x15, 0, "drop", port),  # jeq #port              else drop
+    ]
+    if num_shards > 1:
+        program += [
+            (0x48, 0, 0, 0),      # ldh [x + 0]            UDP source port
+            (0x07, 0, 0, 0),      # tax                    X = source port
+            (0x20, 0, 0, 12),     # ld [12]                source IP
+            (0x0c, 0, 0, 0),      # add x
+            (0x94, 0, 0, num_shards), # mod #num_shards
+            (0x15, 0, "drop", shard), # jeq #shard         else drop
+        ]
+    program += [
+        (0x06, 0, 0, 0x40000),    # ret #262144            accept
+        (0x06, 0, 0, 0),          # ret #0                 drop
+    ]
+    targets = {"accept": len(program) - 2, "drop": len(program) - 1}
+    resolve = lambda i, jump: targets[jump] - i - 1 if isinstance(jump, str) else jump
+    return [(code, resolve(i, jt), resolve(i, jf), k) for i, (code, jt, jf, k) in enumerate(program)]
+
+def flow_shard(src_ip, sport, num_shards)->int:
+    # Shard of a flow, same as the kernel filter of udp_port_filter
+    return (int.from_bytes(socket.inet_aton(src_ip), 'big') + sport) % 2 ** 32 % num_shards
+
+# recvmmsg(2) is not exposed by the socket module, call it through libc when available
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+
+class RawUDPReceiver:
+    def __init__(self, port, batch_size=64, bufsize=65535, rcvbuf=4 * 1024 * 1024, verbose=False, shard=0, num_shards=1):
+        self.port = port
+        self.batch_size = batch_size
+        self.bufsize = bufsize
+        self.verbose = verbose
+        self.num_received = 0
+        self.num_batches = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_UDP)
+        try:
+            # Bigger kernel queue to absorb bursts of the sender's window
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        except OSError:
+            if self.verbose: print("[WARNING] Could not set the receive buffer size of the raw socket.")
+        self._attach_filter(udp_port_filter(port, shard, num_shards))
+        self.sock.setblocking(False)
+
+        # Buffers are allocated once and reused for every batch
+        self._bufs = [bytearray(bufsize) for _ in range(batch_size)]
+        self._views = [memoryview(buf) for buf in self._bufs]
+        if _recvmmsg is not None:
+            self._c_bufs = [(ctypes.c_char * bufsize).from_buffer(buf) for buf in self._bufs]
+            self._iovecs = (_iovec * batch_size)()
+            self._msgs = (_mmsghdr * batch_size)()
+            for i, c_buf in enumerate(self._c_bufs):
+                self._iovecs[i].iov_base = ctypes.addressof(c_buf)
+                self._iovecs[i].iov_len = bufsize
+                self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                self._msgs[i].msg_hdr.msg_iovlen = 1
+        if self.verbose: print(f"[DEBUG] Raw socket receiver listening on UDP port {port} (recvmmsg: {_recvmmsg is not None})")
+
+    def _attach_filter(self, program):
+        insns = (_sock_filter * len(program))(*[_sock_filter(*insn) for insn in program])
+        fprog = _sock_fprog(len(program), insns)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))
+        self._filter = insns # Keep the program alive as long as the socket
+
+    def _recv_batch(self)->list:
+        # Lengths of the packets received into self._bufs, at most batch_size without blocking
+        if _recvmmsg is not None:
+            for i in range(self.batch_size): self._msgs[i].msg_len = 0
+            n = _recvmmsg(self.sock.fileno(), self._msgs, self.batch_size, MSG_DONTWAIT, None)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EINTR): return []
+                raise OSError(err, os.strerror(err))
+            return [self._msgs[i].msg_len for i in range(n)]
+
+        lengths = []
+        for buf in self._bufs:
+            try:
+                lengths.append(self.sock.recv_into(buf))
+            except BlockingIOError:
+                break
+        return lengths
+
+    def parse(self, view, length):
+        # PacketView of the IP packet in view[:length], None if it is not a complete UDP packet
+        if length < 20: return None
+        ihl = (view[0] & 0x0F) * 4
+        if length < ihl + UDP_HEADER_LEN: return None
+        sport, dport, udp_len, chksum = struct.unpack_from('!HHHH', view, ihl)
+        end = min(ihl + udp_len, length)
+        src = socket.inet_ntoa(view[12:16])
+        return PacketView(src, sport, dport, chksum, bytes(view[ihl + UDP_HEADER_LEN:end])) # Buffer is reused, copy the payload
+
+    def receive(self, callback, stop_event=None, poll_timeout=0.5):
+        # Call callback(PacketView) for every packet until stop_event is set
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                if not selector.select(poll_timeout): continue
+                while True: # Drain the socket before sleeping again
+                    lengths = self._recv_batch()
+                    if not lengths: break
+                    self.num_batches += 1
+                    self.num_received += len(lengths)
+                    for view, length in zip(self._views, lengths):
+                        packet = self.parse(view, length)
+                        if packet is not None and packet.dport == self.port:
+                            callback(packet)
+        finally:
+            selector.close()
+
+    def close(self):
+        self.sock.close()
@@ -1,43 +1,525 @@
 
+import time
+import queue
+import bisect
 import socket
-from scapy.all import IP, UDP, Raw, sniff
+import struct
+import threading
+from collections import deque, OrderedDict
+
+from raw_receiver import RawUDPReceiver, PacketView
+from fec import get_fec, DATA_BITS, CODE_BITS, UNDECODABLE
 
 # ------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------
 def assert_type(obj, desired_type, note=""):
     assert isinstance(obj, desired_type), f"[ERROR] Expected {note} to be type {desired_type}, got {type(obj)}"
 
-def bits_to_message(bits: str)->str:
-    assert_type(bits, str, "bits")
-    chars = [bits[i:i+8] for i in range(0, len(bits), 8)]
-    return ''.join([chr(int(c, 2)) for c in chars])
 
+SACK_ACK_TYPE = b'S' # Must be the same as in sec/reliability.py
+
+# Binary framing: flags byte + 4-byte big-endian seq, must be the same as in sec/utils.py
+BINARY_HEADER = struct.Struct('!BI')
+BINARY_FRAMING_FLAG = 0x80 # Set in every binary header, ASCII payloads start with '['
+FLAG_SINGLE_SESSION = 0x01
+SESSION_ID_SHIFT = 1 # Number of the sender session mod 4 (see _is_new_sender_session)
+SESSION_ID_MASK = 0x06
+
+class SackState:
+    # Sequence numbers received in the current session, ACKed back as 
+    # b'S' + 1-byte epoch + 4-byte cumulative ACK (every seq below it is received)
+    # + 4-byte base seq + bitmap, bit i (MSB first) set if seq base+i is received.
+    # The bitmap ends at the seq that triggered the ACK, so a packet that never
+    # arrives (cum stuck below it) does not keep newer packets out of the bitmap.
+    # The epoch counts the sender sessions of the flow (mod 256), so the sender can
+    # ignore late ACKs of its previous session, whose seqs it reuses.
+    def __init__(self, max_bitmap_bytes=8):
+        self.max_bitmap_bits = 8 * max_bitmap_bytes
+        self.epoch = 0
+        self.reset()
+
+    def reset(self, new_session=False):
+        # new_session: a new sender session started (seq 0 or idle flow), not only a state toggle
+        if new_session: self.epoch = (self.epoch + 1) % 256
+        self.cum = 0
+        self.above = set() # Received seqs above cum
+
+    def add(self, seq):
+        if seq < self.cum: return
+        if seq == self.cum:
+            self.cum += 1
+            while self.cum in self.above:
+                self.above.remove(self.cum)
+                self.cum += 1
+        else:
+            self.above.add(seq)
+            if len(self.above) > 4 * self.max_bitmap_bits:
+                # Seqs far below the newest one were already reported in earlier ACKs
+                self.above = {s for s in self.above if s > seq - self.max_bitmap_bits}
+
+    def encode(self, seq)->bytes:
+        base = max(self.cum + 1, seq - self.max_bitmap_bits + 1)
+        bitmap, nbits = 0, 0
+        for offset in range(max(0, seq - base + 1)):
+            if base + offset in self.above:
+                bitmap |= 1 << (self.max_bitmap_bits - 1 - offset) # offset 0 is the MSB
+                nbits = offset + 1
+        nbytes = (nbits + 7) // 8 # Trailing zero bytes are not sent
+        bitmap >>= self.max_bitmap_bits - 8 * nbytes
+        return SACK_ACK_TYPE + struct.pack('!BII', self.epoch, self.cum, base) + bitmap.to_bytes(nbytes, 'big')
+
+class PreambleDetector:
+    # Preamble detection in constant time and memory per packet.
+    # add(): the preamble must be the bits of the len(preamble) highest seqs received
+    # so far (same as sorting every seq and taking the last ones). Only those seqs are
+    # kept, a seq below all of them can never be among the highest again. In order
+    # packets shift the register, out of order ones are inserted among the kept seqs.
+    # add_in_stream(): single session, the preamble must be on consecutive seqs and every
+    # seq before it must be received (cum: lowest seq not received yet), so covert symbols
+    # that arrive before a late seq 0 can not be taken for the preamble. Like a receive
+    # window, only seqs below cum + reorder_window are kept, the others are not ACKed (see
+    # accepts) and the sender sends them again. A kept seq is only dropped once it is
+    # below cum - len(preamble) + 1, where it can no longer be part of a preamble or come
+    # after one, so an ACKed early covert symbol is never lost. reorder_window should be
+    # at least the sender's window.
+    def __init__(self, preamble, reorder_window=64):
+        self.preamble = preamble
+        self.n = len(preamble)
+        self.target = int(preamble, 2)
+        self.mask = (1 << self.n) - 1
+        self.reorder_window = reorder_window
+        self.reset()
+
+    def reset(self):
+        self.seqs = [] # Highest n seqs, ascending
+        self.bits = [] # Their bits
+        self.register = 0 # self.bits as an int, the lowest seq is the MSB
+        self.stream = {} # seq -> symbol (first bit is the preamble bit) from cum - n + 1 on
+        self.cum = 0 # Every seq below it is received (single session)
+
+    def add(self, seq, bit)->bool:
+        seqs, bits = self.seqs, self.bits
+        if not seqs or seq > seqs[-1]:
+            seqs.append(seq)
+            bits.append(bit)
+            self.register = ((self.register << 1) | (bit == '1')) & self.mask
+        else:
+            i = bisect.bisect_left(seqs, seq)
+            if seqs[i] == seq:
+                bits[i] = bit # Duplicate, the last copy counts
+            elif i > 0 or len(seqs) < self.n:
+                seqs.insert(i, seq)
+                bits.insert(i, bit)
+            else:
+                return False # Older than every kept seq, nothing changes
+            self.register = int(''.join(bits[-self.n:]), 2)
+        if len(seqs) > self.n:
+            del seqs[0], bits[0]
+        return len(seqs) == self.n and self.register == self.target
+
+    def accepts(self, seq)->bool:
+        # Single session: False for seqs past the reorder window, they are not kept
+        return seq < self.cum + self.reorder_window
+
+    def add_in_stream(self, seq, symbol):
+        # Returns the seq right after the preamble if it is complete, None otherwise
+        n = self.n
+        if seq < self.cum or not self.accepts(seq): return None # Already received, or past the window
+        self.stream[seq] = symbol
+        if seq != self.cum: return None
+        prev_cum = self.cum
+        while self.cum in self.stream: self.cum += 1
+
+        # Check the runs of n seqs that are now inside the received prefix, the earliest first.
+        # When it is found, stream still has the symbols after the preamble that arrived before it
+        for end in range(max(prev_cum, n - 1), self.cum):
+            run = range(end - n + 1, end + 1)
+            if ''.join(self.stream[s][0] for s in run) == self.preamble:
+                return end + 1
+        for old in range(prev_cum - n + 1, self.cum - n + 1): self.stream.pop(old, None)
+        return None
+
+class CovertReassembler:
+    # Covert bits of a session packed into a bytearray as they arrive, bit i of the
+    # session (MSB first) is bit i % k of the symbol of seq i // k (k bits per packet).
+    # The contiguous prefix of received seqs is tracked, so the header is decoded once,
+    # as soon as its packets are in, and every completion check is O(1).
+    # WARNING: Header packets must be received. A missing payload packet leaves its bits 0.
+    def __init__(self, header_len=8, bits_per_packet=1, bits_per_char=8):
+        self.header_len = header_len
+        self.bits_per_packet = bits_per_packet
+        self.bits_per_char = bits_per_char
+        self.header_pkts = -(-header_len // bits_per_packet) # Packets carrying the header
+        self.reset()
+
+    def reset(self):
+        self.bits = bytearray()
+        self.received = bytearray() # 1 if seq is received
+        self.num_packets = 0
+        self.contiguous = 0 # Every seq below this is received
+        self.msg_len = None # Number of chars, known once the header is received
+        self.total_bits = None # Header + message bits
+        self.delivered = 0 # Message bytes already returned by pop_ready()
+
+    def __len__(self):
+        return self.num_packets
+
+    def has(self, seq)->bool:
+        # True if the bits of seq are already received
+        return seq < len(self.received) and self.received[seq] == 1
+
+    def _grow(self, seq):
+        if seq >= len(self.received):
+            self.received.extend(bytes(max(seq + 1, 2 * len(self.received)) - len(self.received)))
+            num_bytes = (len(self.received) * self.bits_per_packet + 7) // 8
+            self.bits.extend(bytes(num_bytes - len(self.bits)))
+
+    def add(self, seq, symbol)->bool:
+        # symbol is a string of bits_per_packet bits, returns True when every covert bit is received
+        self._store(seq, symbol)
+        if self.msg_len is None and self.contiguous >= self.header_pkts:
+            self.msg_len = self._read_bits(0, self.header_len)
+            self.total_bits = self.header_len + self.msg_len * self.bits_per_char
+        return self.is_complete()
+
+    def _store(self, seq, symbol)->bool:
+        # Saves the bits of seq, returns True if seq was not received before
+        k = self.bits_per_packet
+        self._grow(seq)
+        value = int(symbol, 2)
+        pos = seq * k
+        for i in range(k):
+            byte, mask = (pos + i) >> 3, 0x80 >> ((pos + i) & 7)
+            if value >> (k - 1 - i) & 1:
+                self.bits[byte] |= mask
+            else:
+                self.bits[byte] &= ~mask & 0xFF # A duplicate overwrites the bits
+        if self.received[seq]: return False
+        self.received[seq] = 1
+        self.num_packets += 1
+        while self.contiguous < len(self.received) and self.received[self.contiguous]:
+            self.contiguous += 1
+        return True
+
+    def is_complete(self)->bool:
+        return self.total_bits is not None and self.num_packets * self.bits_per_packet >= self.total_bits
+
+    def ready_bits(self)->int:
+        # Header + message bits at the start of the session that are final
+        return self.contiguous * self.bits_per_packet
+
+    def _data(self, start, end)->bytearray:
+        # Header + message bits packed MSB first, bits [start, end) are up to date
+        return self.bits
+
+    def _read_bits(self, start, nbits)->int:
+        # Bits [start, start + nbits) as an int
+        first, last = start // 8, (start + nbits + 7) // 8
+        data = self._data(start, start + nbits)
+        value = int.from_bytes(data[first:last].ljust(last - first, b'\x00'), 'big')
+        return (value >> (8 * (last - first) - (start - 8 * first) - nbits)) & ((1 << nbits) - 1)
+
+    def _message_bytes(self, first, last)->bytes:
+        # Chars [first, last) of the message, missing bits are 0
+        if self.header_len % 8 == 0 and self.bits_per_char == 8:
+            start = self.header_len // 8
+            data = self._data(self.header_len + 8 * first, self.header_len + 8 * last)
+            return bytes(data[start + first:start + last]).ljust(last - first, b'\x00')
+        nbits = (last - first) * self.bits_per_char
+        return self._read_bits(self.header_len + first * self.bits_per_char, nbits).to_bytes((nbits + 7) // 8, 'big')
+
+    def get_message(self)->str:
+        # Covert message decoded from the bits received so far, one char per byte (latin-1)
+        if self.msg_len is None: return ""
+        return self._message_bytes(0, self.msg_len).decode('latin-1')
+
+    def pop_ready(self, flush=False)->bytes:
+        # Message bytes whose bits are all in the contiguous prefix and were not returned before.
+        # flush=True returns every remaining byte (e.g. when the session is complete with gaps).
+        if self.msg_len is None: return b""
+        if flush:
+            ready = self.msg_len
+        else:
+            ready = min(self.msg_len, max(0, self.ready_bits() - self.header_len) // self.bits_per_char)
+        if ready <= self.delivered: return b""
+        data = self._message_bytes(self.delivered, ready)
+        self.delivered = ready
+        return data
+
+class FECReassembler(CovertReassembler):
+    # Covert bits protected by FEC (see fec.py). Packets fill the encoded bits as in
+    # CovertReassembler and every codeword counts its received bits. A codeword is decoded
+    # once it has fec.min_bits of them (lost bits are erasures), the header as soon as its
+    # codewords can be decoded. The session is complete when every codeword of the message
+    # can be decoded, lost packets need no retransmission.
+    def __init__(self, fec, header_len=8, bits_per_packet=1, bits_per_char=8):
+        self.fec = fec
+        super().__init__(header_len, bits_per_packet, bits_per_char)
+        self.header_codewords = -(-header_len // DATA_BITS)
+
+    def reset(self):
+        super().reset()
+        self.codeword_bits = bytearray() # Received bits of each codeword
+        self.data = bytearray() # Decoded data bits packed MSB first
+        self.decoded = bytearray() # 1 if the codeword is decoded into self.data
+        self.num_codewords = None # Codewords of header + message, known once the header is decoded
+        self.num_decodable = 0 # Codewords below num_codewords with enough bits
+        self.decodable_prefix = 0 # Every codeword below this has enough bits
+
+    def add(self, seq, symbol)->bool:
+        k, fec = self.bits_per_packet, self.fec
+        if self._store(seq, symbol):
+            for pos in range(seq * k, (seq + 1) * k):
+                codeword, _ = fec.codeword_of(pos)
+                if codeword >= len(self.codeword_bits):
+                    self.codeword_bits.extend(bytes(max(codeword + 1, 2 * len(self.codeword_bits)) - len(self.codeword_bits)))
+                self.codeword_bits[codeword] += 1
+                if self.codeword_bits[codeword] == fec.min_bits and self.num_codewords is not None and codeword < self.num_codewords:
+                    self.num_decodable += 1
+            while self.decodable_prefix < len(self.codeword_bits) and self.codeword_bits[self.decodable_prefix] >= fec.min_bits:
+                self.decodable_prefix += 1
+        if self.msg_len is None and self.decodable_prefix >= self.header_codewords:
+            self.msg_len = self._read_bits(0, self.header_len)
+            self.total_bits = self.header_len + self.msg_len * self.bits_per_char
+            self.num_codewords = -(-self.total_bits // DATA_BITS)
+            self.num_decodable = sum(1 for n in self.codeword_bits[:self.num_codewords] if n >= fec.min_bits)
+        return self.is_complete()
+
+    def is_complete(self)->bool:
+        return self.num_codewords is not None and self.num_decodable >= self.num_codewords
+
+    def ready_bits(self)->int:
+        return self.decodable_prefix * DATA_BITS
+
+    def _decode_codeword(self, codeword):
+        # Writes the data bits of codeword into self.data. A codeword that cannot be
+        # rebuilt (yet) gets its received data bits, missing ones are 0, and is decoded again later.
+        k, fec = self.bits_per_packet, self.fec
+        word, mask = 0, 0
+        for i in range(CODE_BITS):
+            pos = fec.position(codeword, i)
+            seq = pos // k
+            bit = 1 << (CODE_BITS - 1 - i)
+            if seq < len(self.received) and self.received[seq]:
+                if self.bits[pos >> 3] & (0x80 >> (pos & 7)): word |= bit
+            else:
+                mask |= bit
+        nibble = fec.decode(word, mask)
+        if nibble == UNDECODABLE:
+            nibble = (word >> 4 & 1) << 3 | (word >> 2 & 1) << 2 | (word >> 1 & 1) << 1 | (word & 1) # d1 d2 d3 d4
+        else:
+            self.decoded[codeword] = 1
+        pos = codeword * DATA_BITS
+        byte, shift = pos >> 3, 4 - (pos & 7) # DATA_BITS divides 8, a nibble never spans two bytes
+        self.data[byte] = (self.data[byte] & ~(0x0F << shift) & 0xFF) | nibble << shift
+
+    def _data(self, start, end)->bytearray:
+        first, last = start // DATA_BITS, -(-end // DATA_BITS)
+        if last > len(self.decoded):
+            self.decoded.extend(bytes(last - len(self.decoded)))
+            self.data.extend(bytes((last * DATA_BITS + 7) // 8 - len(self.data)))
+        for codeword in range(first, last):
+            if not self.decoded[codeword]: self._decode_codeword(codeword)
+        return self.data
+
+class AckCoalescer:
+    # Delayed ACKs: one SACK ACK per flow after max_packets packets, or max_delay seconds 
+    # after the first packet that is not ACKed yet, whichever comes first.
+    # ACKs are sent from a separate thread, the receive loop only updates the SACK state.
+    # SACK states of the flows are only touched with self.cond held.
+    def __init__(self, sock, max_packets=8, max_delay=0.005, verbose=False):
+        self.sock = sock
+        self.max_packets = max_packets
+        self.max_delay = max_delay
+        self.verbose = verbose
+        self.cond = threading.Condition()
+        self.pending = {} # flow -> [addr, sack, highest seq, packets, deadline]
+        self.ready = deque() # (ACK bytes, addr) to be sent
+        self.num_packets = 0 # Packets that asked for an ACK
+        self.num_acks = 0 # ACKs actually sent
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _queue(self, flow):
+        addr, sack, seq, _, _ = self.pending.pop(flow)
+        self.ready.append((sack.encode(seq), addr))
+
+    def reset_flow(self, flow, sack, new_session=True):
+        # New sender session (or state toggle): ACK what is pending, then start over
+        with self.cond:
+            if flow in self.pending:
+                self._queue(flow)
+                self.cond.notify()
+            sack.reset(new_session)
+
+    def add(self, flow, addr, sack, seq):
+        with self.cond:
+            sack.add(seq)
+            self.num_packets += 1
+            entry = self.pending.get(flow)
+            if entry is None:
+                entry = self.pending[flow] = [addr, sack, seq, 0, time.time() + self.max_delay]
+                self.cond.notify() # New deadline
+            entry[2] = max(entry[2], seq)
+            entry[3] += 1
+            if entry[3] >= self.max_packets:
+                self._queue(flow)
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                for flow in [flow for flow, entry in self.pending.items() if entry[4] <= now]:
+                    self._queue(flow)
+                if not self.ready:
+                    if self.stop_event.is_set(): return
+                    deadlines = [entry[4] for entry in self.pending.values()]
+                    self.cond.wait(max(0, min(deadlines) - now) if deadlines else None)
+                    continue
+                to_send, self.ready = self.ready, deque()
+            for ack, addr in to_send: # Socket is used outside the lock
+                try:
+                    self.sock.sendto(ack, addr)
+                    self.num_acks += 1
+                except OSError as e:
+                    if self.verbose: print(f"[WARNING] ACK to {addr} could not be sent: {e}")
+
+    def close(self):
+        # Send every pending ACK and stop the thread
+        with self.cond:
+            for flow in list(self.pending): self._queue(flow)
+            self.stop_event.set()
+            self.cond.notify()
+        self.thread.join()
+
+class CovertSession:
+    # Receiver state of one flow (sender IP, sender port)
+    def __init__(self, flow, preamble, header_len, bits_per_packet, bits_per_char, fec=None, reorder_window=64):
+        self.flow = flow
+        self.state = "overt" # overt, covert
+        self.preamble_detector = PreambleDetector(preamble, reorder_window)
+        if fec is not None:
+            self.reassembler = FECReassembler(fec, header_len, bits_per_packet, bits_per_char)
+        else:
+            self.reassembler = CovertReassembler(header_len, bits_per_packet, bits_per_char)
+        self.sack = SackState()
+        self.packet_flags = 0 # Flags of the last binary header, senders in single session mode set FLAG_SINGLE_SESSION
+        self.sender_session = None # Session id of the sender session in progress (binary framing), None if not known
+        self.highest_seq = -1 # Highest seq of the sender session in progress
+        self.covert_base = 0 # Single session: seq of the first covert packet
+        self.last_packet_time = 0
+        self.session_id = 0 # Id of the current covert session
+        self.start = None # Preamble detection time
+        self.first_data = None # Time the first message bytes were delivered
+        # The sender session that carried the preamble or the covert message has ended, its
+        # packets are late until the sender starts a new one (see CovertReceiver._is_late_packet).
+        # finished: received flags of the ended session's seqs and finished_base its covert_base.
+        # drop_all: every packet is late (covert session), otherwise only the seqs in finished.
+        self.ended = False
+        self.finished = None
+        self.finished_base = 0
+        self.drop_all = False
+        self.reset_counters()
+
+    def reset_counters(self):
+        # Retransmission counters of the current covert session
+        self.max_seq = -1 # Highest covert seq received (relative to covert_base)
+        self.num_duplicates = 0 # Seqs received again, bits already decided
+        self.num_out_of_order = 0 # New seqs below max_seq
+        self.num_late = 0 # Preamble seqs received after the preamble was detected (single session)
 
 class CovertReceiver:
 
-    def __init__(self, port=8888, dest_port=9999, verbose=False):
+    def __init__(self, port=8888, dest_port=9999, verbose=False, ack_format="sack", ack_idle_reset=0.5, bits_per_packet=1, single_session=False,
+                 backend="raw", batch_size=64, on_data=None, on_session=None, max_events=1024, max_messages=100,
+                 session_idle_timeout=30, max_sessions=1024, shard=0, num_shards=1, ack_every=1, ack_delay=0,
+                 fec=None, fec_depth=8, reorder_window=64):
         self.verbose = verbose
         self.port = port
         self.dest_port = dest_port
-        self.sock = self.create_and_bind_socket(port)
         
-        self.state = "overt" # overt, covert
+        # Receive path: "raw" raw socket with a BPF filter and batched receives, "scapy" sniff()
+        if backend not in ("raw", "scapy"):
+            raise ValueError(f"Unknown receive backend {backend}. Must be 'raw' or 'scapy'.")
+        self.backend = backend
+        self.batch_size = batch_size
+        if num_shards > 1 and backend != "raw":
+            raise ValueError("Sharding flows over workers needs the raw backend (kernel filter).")
+        self.stop_event = threading.Event()
+
+        # ACK format: "seq" ASCII sequence number per packet, "sack" cumulative ACK + SACK bitmap
+        if ack_format not in ("seq", "sack"):
+            raise ValueError(f"Unknown ACK format {ack_format}. Must be 'seq' or 'sack'.")
+        self.ack_format = ack_format
+        # WARNING: Sequence numbers restart with every sender session. The receiver sees the
+        # session boundaries from the session id of binary headers, seq 0 with ASCII framing and
+        # ack_idle_reset seconds without packets (see _is_new_sender_session). SACK state is reset
+        # on every boundary and when the state is toggled.
+        self.ack_idle_reset = ack_idle_reset
+        # Delayed ACKs (SACK only): ACK every ack_every packets or ack_delay seconds, see AckCoalescer
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.ack_coalescer = None
+        self.num_acked_packets = 0 # Packets ACKed right away (no coalescing)
+        if (ack_every > 1 or ack_delay > 0) and ack_format != "sack":
+            raise ValueError("Delayed ACKs need the sack ACK format, one seq ACK cannot confirm several packets.")
 
         # Overt state vars
         self.PREAMBLE = "01010011" # 8-bit TODO: make it an environment variable to share with sender.py?
-        self.received_preamble = {}
+        # Single session framing: preamble, header and covert bits come in one sender session,
+        # covert bits start right after the preamble (at covert_base), no session boundary in between.
+        # Must be the same with CovertSender's single_session, binary framed packets also carry it as a flag.
+        self.single_session = single_session
 
         # Covert state vars
         self.HEADER_LEN = 8 # Number of covert bytes, Must the same with CovertSender's TODO: share this variable across containers
         self.BITS_PER_COVERT_CHAR = 8 
+        # Covert bits per packet, must be the same with CovertSender's (see sec/encoding.py)
+        # 1: UDP checksum existence, k > 1: + (k-1) bits as UDP payload length modulo 2^(k-1)
+        self.bits_per_packet = bits_per_packet
+        # FEC of the header + covert bits, must be the same with CovertSender's (see fec.py)
+        self.fec = get_fec(fec, fec_depth)
+        # Single session: packets accepted past the lowest missing seq before the preamble is
+        # detected, should be at least the sender's window (see PreambleDetector)
+        self.reorder_window = reorder_window
+
+        # Every flow (sender IP, sender port) has its own CovertSession, so concurrent senders
+        # do not mix their bits. Flows idle for session_idle_timeout seconds are evicted, 
+        # at most max_sessions are kept (least recently active ones go first).
+        self.sessions = OrderedDict()
+        self.session = None # Session of the packet being handled
+        self.session_idle_timeout = session_idle_timeout
+        self.max_sessions = max_sessions
+        # Workers: flows are sharded over num_shards receivers by a hash in the kernel filter
+        self.shard = shard
+        self.num_shards = num_shards
 
-        self.covert_bits_chunk = {} 
-        self.covert_chunk_len = 0 # To be determined by <HEADER_LEN>-bit header
+        # Covert data is delivered while the receiver runs: on_data(event) for every new
+        # contiguous part of the message, on_session(event) when a session completes.
+        # Events are also put in a bounded queue (see events()), oldest ones are dropped when
+        # nobody reads it. Callbacks run on the receive thread, so they should return quickly.
+        self.on_data = on_data
+        self.on_session = on_session
+        self.event_queue = queue.Queue(maxsize=max_events)
+        self.num_dropped_events = 0
+        self.num_sessions = 0 # Covert sessions seen, used as session ids
+        # Retransmission counters over every session, see _is_new_covert_packet()
+        self.num_duplicates = 0
+        self.num_out_of_order = 0
+        self.num_late = 0
 
-        self.total_covert_msg = []
+        self.total_covert_msg = deque(maxlen=max_messages) # Last decoded messages
+        self.sock = self.create_and_bind_socket(port)
+        if ack_every > 1 or ack_delay > 0:
+            self.ack_coalescer = AckCoalescer(self.sock, max_packets=ack_every, 
+                                              max_delay=ack_delay if ack_delay > 0 else 0.2, verbose=verbose)
 
     def create_and_bind_socket(self, port):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.num_shards > 1: # Every worker sends its ACKs from the same port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_address = ( '', port)
         sock.bind(server_address)
 
@@ -46,57 +528,43 @@ class CovertReceiver:
 
     def reset_data(self):
         # To reset aggregated chunks in between
-        self.covert_bits_chunk = {}
-        self.received_preamble = {}
+        # of the current flow
+        self.session.reassembler.reset()
+        self.session.preamble_detector.reset()
         if self.verbose: print("[DEBUG] Covert and preamble dictionaries have been reset.")
 
+    def get_ack_stats(self)->dict:
+        if self.ack_coalescer is None:
+            return {"packets": self.num_acked_packets, "acks": self.num_acked_packets, "saved": 0}
+        packets, acks = self.ack_coalescer.num_packets, self.ack_coalescer.num_acks
+        return {"packets": packets, "acks": acks, "saved": packets - acks}
+
     def shutdown(self):
+        self.stop_event.set() # Stops the listener and events() iterators
+        if self.ack_coalescer is not None: self.ack_coalescer.close()
         self.sock.close()
         if self.verbose: print("[INFO] Socket closed.")
 
-    def _get_covert_len_from_header(self):
-        if len(self.covert_bits_chunk.items()) < self.HEADER_LEN:
-            return False
-        
-        # Extract bits in correct order (from index 0 to HEADER_LEN - 1)
-        sorted_covert_array = sorted(self.covert_bits_chunk)
-        header_bits = [self.covert_bits_chunk[sorted_covert_array[i]] for i in range(self.HEADER_LEN)]
-        if self.verbose: print("[DEBUG] Header bits:", header_bits)
-
-        # Join into a binary string and convert to number
-        bitstring = "".join(header_bits)
-        if self.verbose: print("[DEBUG] Header bitstring:", bitstring)
-        self.covert_chunk_len = int(bitstring, 2) * self.BITS_PER_COVERT_CHAR 
-
-        self.covert_chunk_len += self.HEADER_LEN # Don't forget to include header bits
-        if self.verbose: print(f"[DEBUG] Parsed covert chunk length: {self.covert_chunk_len}")
-        return True
-
     def get_covert_msg(self):
         # First HEADER_LEN bits represent the actual length of covert message
-        if self.covert_bits_chunk:
-            bit_str = ''.join(self.covert_bits_chunk[i] for i in sorted(self.covert_bits_chunk))
-            
-            covert_start = self.HEADER_LEN
-            length = int(bit_str[:covert_start], 2) # number of chars in covert message
-            covert_end = covert_start + (length * self.BITS_PER_COVERT_CHAR ) # 8 bits per char
-
-            if self.verbose:
-                print("Covert message starts at ", covert_start)
-                print("Covert message ends at ", covert_end)
-                print("bit_str:", bit_str)
-                print("length:", length)
-
-            bit_str = bit_str[covert_start:covert_end]
-            return bits_to_message(bit_str)
-        return ""
+        if self.verbose and self.session.reassembler.msg_len is not None:
+            print("Covert message length:", self.session.reassembler.msg_len)
+        return self.session.reassembler.get_message()
     
     def extract_sequence_number_from_payload(self, payload)->int:
         # Sequence number is embedded as '[<seq_number>] '
-        # where <seq_number> is an integer
+        # where <seq_number> is an integer, or as a binary header
+        # (flags + 4-byte seq) at offset 0 when the first byte has BINARY_FRAMING_FLAG.
         # Returns -1 if not found
         assert_type(payload, bytes, "payload")
 
+        if payload and payload[0] & BINARY_FRAMING_FLAG:
+            if len(payload) < BINARY_HEADER.size: return -1
+            flags, seq_number = BINARY_HEADER.unpack_from(payload)
+            self.session.packet_flags = flags
+            return seq_number
+        self.session.packet_flags = 0
+
         start = payload.find(b'[')
         end = payload.find(b']', start)
         if start != -1 and end != -1:
@@ -107,27 +575,156 @@ class CovertReceiver:
     def _check_udp_checksum_existence(self, packet):
         # In this implementation,
         # existence of UDP checksum field indicates 1 or 0 covert bit
-        covert_bit = '1' if packet[UDP].chksum != 0 else '0' # TODO: is 0 = 0?
+        covert_bit = '1' if packet.chksum != 0 else '0' # TODO: is 0 = 0?
         return covert_bit
 
-    def _save_covert_bit(self, packet, seq_number):
-        # Extract covert bit and save it
+    def _is_single_session(self):
+        return self.single_session or bool(self.session.packet_flags & FLAG_SINGLE_SESSION)
+
+    def _decode_symbol(self, packet):
+        # Covert bits of a packet, first one is the checksum existence
+        # and the rest is the payload length class (see sec/encoding.py)
         covert_bit = self._check_udp_checksum_existence(packet)
-        self.covert_bits_chunk[seq_number] = covert_bit
+        if self.bits_per_packet == 1:
+            return covert_bit
+        length_class = len(packet.payload) % 2 ** (self.bits_per_packet - 1)
+        return covert_bit + format(length_class, f'0{self.bits_per_packet - 1}b')
+
+    def _save_covert_bit(self, packet, seq_number):
+        # Extract covert bit(s) and save it
+        if self._is_single_session():
+            if seq_number < self.session.covert_base: return False # Late or retransmitted preamble packet
+            seq_number -= self.session.covert_base
+        covert_bit = self._decode_symbol(packet)
+        self.session.reassembler.add(seq_number, covert_bit)
         if self.verbose: 
             print(f"[INFO] Covert bit {covert_bit} saved for sequence number {seq_number}")
 
         return True
     
+    def _is_new_covert_packet(self, seq_number)->bool:
+        # Dedup fast path: retransmitted packets of seqs whose bits are already decided
+        # are only ACKed again, their bits are not decoded and nothing is checked.
+        # Also counts duplicate, out of order and late packets of the session.
+        session = self.session
+        if seq_number < 0: return False # Invalid packet
+        idx = seq_number
+        if self._is_single_session():
+            if seq_number < session.covert_base: # Preamble packet retransmitted after detection
+                session.num_late += 1
+                self.num_late += 1
+                return False
+            idx -= session.covert_base
+        if session.reassembler.has(idx):
+            session.num_duplicates += 1
+            self.num_duplicates += 1
+            return False
+        if idx < session.max_seq:
+            session.num_out_of_order += 1
+            self.num_out_of_order += 1
+        else:
+            session.max_seq = idx
+        return True
+
+    def _session_id_diff(self)->int:
+        # Session id of the packet's binary header minus the one of the sender session in progress, mod 4
+        return ((self.session.packet_flags & SESSION_ID_MASK) >> SESSION_ID_SHIFT) - self.session.sender_session & 3
+
+    def _is_new_sender_session(self, seq_number, idle_time)->bool:
+        # Sender session boundary of the flow (seqs restart from 0 with every sender session):
+        # ack_idle_reset seconds without packets, otherwise with binary framing the next session id
+        # (also when a packet arrives before its seq 0), with ASCII framing seq 0. A seq 0 is only
+        # a retransmission while the session in progress has no seq past the sender's window
+        # (at most reorder_window): the sender does not send past it before seq 0 is ACKed.
+        session = self.session
+        if seq_number < 0: return False
+        if idle_time > self.ack_idle_reset: return True
+        if session.packet_flags & BINARY_FRAMING_FLAG:
+            return session.sender_session is None or self._session_id_diff() in (1, 2)
+        return seq_number == 0 and (session.ended or session.highest_seq >= self.reorder_window)
+
+    def _is_previous_sender_session(self)->bool:
+        # Binary framing: late packet of the sender session before the one in progress
+        session = self.session
+        return bool(session.packet_flags & BINARY_FRAMING_FLAG) and session.sender_session is not None \
+            and self._session_id_diff() == 3
+
+    def _start_sender_session(self):
+        # A new sender session started on the flow. Packets of the ended session are no longer
+        # expected, a covert session that is still in progress ends with what it has, so the new
+        # session's packets are never decoded as its bits. The preamble search starts over and
+        # the SACK state gets a new epoch.
+        session = self.session
+        binary = session.packet_flags & BINARY_FRAMING_FLAG
+        session.sender_session = (session.packet_flags & SESSION_ID_MASK) >> SESSION_ID_SHIFT if binary else None
+        if not session.ended and session.state == "covert":
+            print(f"[WARNING] New sender session on {session.flow} before the covert message was complete.")
+            self._toggle_state()
+        session.ended, session.finished = False, None
+        session.highest_seq = -1
+        session.preamble_detector.reset()
+        if self.ack_coalescer is not None:
+            self.ack_coalescer.reset_flow(session.flow, session.sack)
+        else:
+            session.sack.reset(new_session=True)
+
+    def _is_late_packet(self, seq_number)->bool:
+        # True for packets of a sender session that has ended for the receiver, they are not decoded:
+        # - after a preamble session (two sessions), retransmissions of its seqs, otherwise they 
+        #   would be saved as covert bits. Other seqs belong to the covert session.
+        # - after a covert session, every packet: retransmissions (lost ACKs) and covert packets
+        #   the message did not need (FEC), otherwise they could look like a preamble.
+        # Until the next sender session starts (see _start_sender_session).
+        session = self.session
+        if not session.ended or seq_number < 0: return False
+        if session.drop_all or self._was_received(seq_number):
+            self.num_late += 1
+            return True
+        return False
+
+    def _was_received(self, seq_number)->bool:
+        # True if seq was received in the ended session. Those late packets are ACKed again, the 
+        # others are not: with ASCII framing, one of them could be a packet of the new session that
+        # arrived before its seq 0, the sender must retransmit it.
+        finished = self.session.finished
+        idx = seq_number - self.session.finished_base
+        return finished is not None and (idx < 0 or (idx < len(finished) and finished[idx] == 1))
+
+    def _should_ack_late(self, seq_number)->bool:
+        # Late packets that are ACKed: seqs received in the ended session and, after a covert
+        # session, its covert seqs (past the preamble in two sessions mode, a preamble session
+        # sends no more packets, from finished_base on in single session mode), e.g. FEC packets
+        # the message did not need, so the sender does not wait for them. With ASCII framing, a
+        # packet of the next session that arrives before its seq 0 gets the ended session's SACK
+        # epoch, the sender drops that ACK and sends the packet again.
+        if self._was_received(seq_number): return True
+        if not self.session.drop_all: return False
+        first_covert = self.session.finished_base if self._is_single_session() else len(self.PREAMBLE)
+        return seq_number >= first_covert
+
+    def get_retransmission_stats(self)->dict:
+        return {"duplicates": self.num_duplicates, "out_of_order": self.num_out_of_order, "late": self.num_late}
+
     def _send_ack(self, packet, seq_number):
-        sender_ip = packet[IP].src
-        ack = str(seq_number).encode() 
-        sent = self.sock.sendto(ack, (sender_ip, self.dest_port))
-        if self.verbose: print(f"[INFO] Sent {sent} bytes (ACK) back to ({sender_ip}, {self.dest_port})")
+        # SACK state is reset for every new sender session (see _start_sender_session)
+        sender_ip = packet.src
+        dest_port = self.dest_port or packet.sport # dest_port 0: ACK to the source port of the flow
+        if self.ack_coalescer is not None:
+            self.ack_coalescer.add(self.session.flow, (sender_ip, dest_port), self.session.sack, seq_number)
+            return True
+
+        if self.ack_format == "sack":
+            self.session.sack.add(seq_number)
+            ack = self.session.sack.encode(seq_number)
+        else:
+            ack = str(seq_number).encode() 
+        self.num_acked_packets += 1
+        sent = self.sock.sendto(ack, (sender_ip, dest_port))
+        if self.verbose: print(f"[INFO] Sent {sent} bytes (ACK) back to ({sender_ip}, {dest_port})")
         return True
     
     def _retrieve_seq_number(self, packet):
-        payload = bytes(packet[Raw])
+        payload = packet.payload
         seq_number = self.extract_sequence_number_from_payload(payload)
         if seq_number == -1:
             print(f"[WARNING] Invalid packet received: {payload}")
@@ -137,65 +734,224 @@ class CovertReceiver:
         return seq_number
 
     def _check_all_coverts_received(self):
-        if self._get_covert_len_from_header():
-            if len(self.covert_bits_chunk.items()) >= self.covert_chunk_len:
-                if self.verbose:
-                    print(f"[DEBUG] Covert bits {len(self.covert_bits_chunk.items())} >= Expected Length {self.covert_chunk_len}")
-                print(f"[INFO] All covert bits of the session are received: {self.get_covert_msg()}")
-                return True
+        if self.session.reassembler.is_complete():
+            if self.verbose:
+                num_bits = len(self.session.reassembler) * self.bits_per_packet
+                print(f"[DEBUG] Covert bits {num_bits} >= Expected Length {self.session.reassembler.total_bits}")
+            print(f"[INFO] All covert bits of the session are received: {self.get_covert_msg()}")
+            return True
         return False
 
     def _check_preamble(self, packet, seq_number):
         
+        if self._is_single_session():
+            return self._check_preamble_in_stream(packet, seq_number)
+
         covert_bit = self._check_udp_checksum_existence(packet)  # Returns "0" or "1"
-        self.received_preamble[seq_number] = covert_bit
         if self.verbose:
             print(f"[DEBUG] Covert bit {covert_bit} saved for sequence number {seq_number}")
 
-        # (Naive implementation)
-        if len(self.received_preamble) >= len(self.PREAMBLE):
-            # Sort by sequence number and get the most recent N bits
-            recent_seq = sorted(self.received_preamble.keys())[-len(self.PREAMBLE):]
-            recent_bits = ''.join(self.received_preamble[seq] for seq in recent_seq)
-            if self.verbose:
-                print(f"[DEBUG] Recent bits for preamble check: {recent_bits}. Recent seq: {recent_seq}")
+        # Bits of the most recent N sequence numbers (see PreambleDetector)
+        detected = self.session.preamble_detector.add(seq_number, covert_bit)
+        if self.verbose:
+            print(f"[DEBUG] Recent bits for preamble check: {''.join(self.session.preamble_detector.bits)}. Recent seq: {self.session.preamble_detector.seqs}")
 
-            if recent_bits == self.PREAMBLE:
-                print("[INFO] Preamble detected!")
-                return True
+        if detected:
+            print("[INFO] Preamble detected!")
+            return True
 
         return False
 
+    def _check_preamble_in_stream(self, packet, seq_number):
+        # Single session: the preamble must be on consecutive sequence numbers,
+        # since covert bits start right after it. The whole symbol is kept, packets 
+        # after the preamble may arrive before it is complete.
+        symbol = self._decode_symbol(packet)
+        if self.verbose:
+            print(f"[DEBUG] Covert symbol {symbol} saved for sequence number {seq_number}")
+        covert_base = self.session.preamble_detector.add_in_stream(seq_number, symbol)
+        if covert_base is not None:
+            print(f"[INFO] Preamble detected! Covert bits start at sequence number {covert_base}")
+            self.session.covert_base = covert_base
+            return True
+        return False
+
+    def _emit(self, event):
+        callback = self.on_data if event["type"] == "data" else self.on_session
+        if callback is not None: callback(event)
+        while True:
+            try:
+                self.event_queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.event_queue.get_nowait() # Drop the oldest event
+                    self.num_dropped_events += 1
+                except queue.Empty:
+                    pass
+
+    def events(self, timeout=0.5):
+        # Iterate over delivered events (from another thread) until the receiver stops
+        while not self.stop_event.is_set():
+            try:
+                yield self.event_queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+    def _deliver_ready(self, flush=False):
+        # Emit the message bytes that became contiguous
+        offset = self.session.reassembler.delivered
+        data = self.session.reassembler.pop_ready(flush)
+        if not data: return
+        now = time.time()
+        if self.session.first_data is None: self.session.first_data = now
+        self._emit({"type": "data", "session": self.session.session_id, "flow": self.session.flow, "offset": offset, "data": data, "time": now})
+
+    def _end_session(self):
+        # Session complete event with latency stats
+        self._deliver_ready(flush=True)
+        session, reassembler = self.session, self.session.reassembler
+        now = time.time()
+        duration = now - session.start
+        message = self.get_covert_msg()
+        self._emit({
+            "type": "session",
+            "session": session.session_id,
+            "flow": session.flow,
+            "message": message,
+            "bytes": reassembler.msg_len or 0,
+            "packets": len(reassembler),
+            "complete": reassembler.ready_bits() >= (reassembler.total_bits or 0),
+            "duration": duration, # Preamble detection -> last covert packet
+            "first_byte_latency": (session.first_data or now) - session.start,
+            "bits_per_second": (reassembler.total_bits or 0) / duration if duration > 0 else 0.0,
+            "duplicates": session.num_duplicates,
+            "out_of_order": session.num_out_of_order,
+            "late": session.num_late,
+            "time": now,
+        })
+        return message
+
     def _toggle_state(self):
-        prev_state = self.state
-        if self.state == "overt":
-            self.state = "covert"
-        elif self.state == "covert":
-            self.total_covert_msg.append(self.get_covert_msg()) # Save covert chunk before reset
-            self.state = "overt"
+        prev_state = self.session.state
+        if self.session.state == "overt":
+            self.session.state = "covert"
+            self.num_sessions += 1
+            self.session.session_id = self.num_sessions
+            self.session.start = time.time()
+            self.session.first_data = None
+            self.session.reset_counters()
+            self.session.ended = not self._is_single_session() # Preamble session ended
+            if self.session.ended:
+                seqs = self.session.preamble_detector.seqs
+                self.session.finished = bytearray(max(seqs) + 1)
+                for seq in seqs: self.session.finished[seq] = 1
+                self.session.finished_base = 0
+                self.session.drop_all = False
+        elif self.session.state == "covert":
+            self.total_covert_msg.append(self._end_session()) # Save covert chunk before reset
+            self.session.state = "overt"
+            self.session.ended = True
+            self.session.drop_all = True
+            self.session.finished = self.session.reassembler.received # reset_data() makes a new one
+            self.session.finished_base = self.session.covert_base if self._is_single_session() else 0
         else:
-            raise ValueError(f"Unknown state {self.state}")
+            raise ValueError(f"Unknown state {self.session.state}")
         
-        print(f"[INFO] State is toggled to {prev_state} -> {self.state}")
+        print(f"[INFO] State of {self.session.flow} is toggled to {prev_state} -> {self.session.state}")
+        early_symbols = self.session.preamble_detector.stream # Symbols that arrived before the preamble was detected
         self.reset_data()
+        if not self._is_single_session():
+            if self.ack_coalescer is not None:
+                self.ack_coalescer.reset_flow(self.session.flow, self.session.sack, new_session=False)
+            else:
+                self.session.sack.reset()
+        elif self.session.state == "covert":
+            # Same sender session goes on, keep the ACK state and
+            # the covert bits that arrived before the preamble was complete
+            for seq, symbol in early_symbols.items():
+                if seq >= self.session.covert_base: 
+                    self.session.reassembler.add(seq - self.session.covert_base, symbol)
+                    self.session.max_seq = max(self.session.max_seq, seq - self.session.covert_base)
+            self._deliver_ready()
         return
 
+    def _get_session(self, packet, now):
+        # Session of the packet's flow, created on its first packet
+        flow = (packet.src, packet.sport)
+        session = self.sessions.get(flow)
+        if session is None:
+            session = CovertSession(flow, self.PREAMBLE, self.HEADER_LEN, self.bits_per_packet, self.BITS_PER_COVERT_CHAR, self.fec,
+                                    self.reorder_window)
+            self.sessions[flow] = session
+            if self.verbose: print(f"[DEBUG] New flow {flow}, {len(self.sessions)} active.")
+        else:
+            self.sessions.move_to_end(flow) # Most recently active flows are at the end
+        session.last_packet_time, last_time = now, session.last_packet_time
+        self._evict_sessions(now)
+        return session, last_time
+
+    def _evict_sessions(self, now):
+        # Least recently active flows are at the front, stop at the first one that is still active
+        while self.sessions:
+            flow, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and now - session.last_packet_time <= self.session_idle_timeout:
+                return
+            del self.sessions[flow]
+            if session.state == "covert": # Deliver what was received of the unfinished message
+                current, self.session = self.session, session
+                self.total_covert_msg.append(self._end_session())
+                self.session = current
+            if self.verbose: print(f"[DEBUG] Flow {flow} evicted, {len(self.sessions)} active.")
+
     # Main packet receive logic
     def packet_callback(self, packet):
+        # scapy sniff() callback
+        from scapy.all import UDP, Raw
         if UDP in packet and Raw in packet:
-            
+            self.handle_packet(PacketView.from_scapy(packet))
+
+    def handle_packet(self, packet):
+        # packet is a PacketView (source IP, UDP checksum and payload)
+        if packet.payload:
+            now = time.time()
+            self.session, last_packet_time = self._get_session(packet, now)
+            idle_time = now - last_packet_time
             seq_number = self._retrieve_seq_number(packet) # Analyze packet
 
-            if self.state == "overt":
-                preamble = self._check_preamble(packet, seq_number) 
-                if preamble: self._toggle_state()
+            if self._is_new_sender_session(seq_number, idle_time):
+                self._start_sender_session()
+            elif self._is_previous_sender_session():
+                # Not ACKed either, the SACK state is the new session's and the sender moved on
+                self.num_late += 1
+                if self.verbose: print(f"[DEBUG] Sequence number {seq_number} belongs to the previous sender session.")
+                return
+            self.session.highest_seq = max(self.session.highest_seq, seq_number)
+
+            if self._is_late_packet(seq_number):
+                if self.verbose: print(f"[DEBUG] Sequence number {seq_number} belongs to the ended sender session.")
+                if self._should_ack_late(seq_number): self._send_ack(packet, seq_number)
+                return
 
-            elif self.state == "covert":
-                self._save_covert_bit(packet, seq_number)
-                received = self._check_all_coverts_received()
-                if received: self._toggle_state()
+            if self.session.state == "overt":
+                if self._is_single_session() and not self.session.preamble_detector.accepts(seq_number):
+                    # Past the reorder window, not kept so not ACKed: the sender sends it again later
+                    if self.verbose: print(f"[DEBUG] Sequence number {seq_number} is past the reorder window, not ACKed.")
+                    return
+                if self._check_preamble(packet, seq_number): 
+                    self._toggle_state()
+                    if self._is_single_session() and self._check_all_coverts_received(): self._toggle_state()
+
+            elif self.session.state == "covert":
+                if self._is_new_covert_packet(seq_number):
+                    self._save_covert_bit(packet, seq_number)
+                    self._deliver_ready()
+                    received = self._check_all_coverts_received()
+                    if received: self._toggle_state()
+                elif self.verbose:
+                    print(f"[DEBUG] Sequence number {seq_number} is already received, only ACKed.")
             else:
-                print(f"[WARNING] Unknown state {self.state}")
+                print(f"[WARNING] Unknown state {self.session.state}")
 
             self._send_ack(packet, seq_number)
 
@@ -203,28 +959,79 @@ class CovertReceiver:
 
     def start_udp_listener(self):
         if self.verbose: print("Receiver is running...")
-        sniff(filter=f"udp and dst port {self.port}", prn=self.packet_callback, store=False)        
+        if self.backend == "raw":
+            try:
+                listener = RawUDPReceiver(self.port, batch_size=self.batch_size, verbose=self.verbose,
+                                          shard=self.shard, num_shards=self.num_shards)
+            except OSError as e:
+                if self.num_shards > 1: raise
+                print(f"[WARNING] Raw socket receiver is not available ({e}), falling back to scapy.")
+                self.backend = "scapy"
+            else:
+                try:
+                    listener.receive(self.handle_packet, stop_event=self.stop_event)
+                finally:
+                    listener.close()
+                return
+
+        from scapy.all import sniff
+        sniff(filter=f"udp and dst port {self.port}", prn=self.packet_callback, store=False,
+              stop_filter=lambda _: self.stop_event.is_set())
 
     
 # ------------------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------------------
 
 
-if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-v", "--verbose", help="print intermediate steps", action="store_true", default=False)
-    args = parser.parse_args()
-
-    receiver = CovertReceiver(port=8888, dest_port=9999, verbose=args.verbose)
-    
+def run_receiver(args, shard=0, num_shards=1):
+    receiver = CovertReceiver(port=8888, dest_port=args.ack_port, verbose=args.verbose, ack_format=args.ack_format,
+                              bits_per_packet=args.bits, single_session=args.single_session,
+                              backend=args.backend, shard=shard, num_shards=num_shards,
+                              ack_every=args.ack_every, ack_delay=args.ack_delay / 1000,
+                              fec=args.fec, fec_depth=args.fec_depth, reorder_window=args.reorder_window)
+    name = f"Worker {shard}" if num_shards > 1 else "Receiver"
     try:
-        print("Receiver started. Press Ctrl+C to stop and see the received covert message.")
+        print(f"{name} started. Press Ctrl+C to stop and see the received covert message.")
         receiver.start_udp_listener()
     except KeyboardInterrupt:
-        print("Receiver stopped.")
+        print(f"{name} stopped.")
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
         receiver.shutdown()
-        print(f"\nCovert message: {receiver.total_covert_msg}")
+        ack_stats = receiver.get_ack_stats()
+        print(f"[INFO] {ack_stats['acks']} ACKs sent for {ack_stats['packets']} packets ({ack_stats['saved']} saved).")
+        retrans_stats = receiver.get_retransmission_stats()
+        print(f"[INFO] Covert packets: {retrans_stats['duplicates']} duplicates, {retrans_stats['out_of_order']} out of order, {retrans_stats['late']} late.")
+        print(f"\n{name} covert message: {list(receiver.total_covert_msg)}")
+    return receiver
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", help="print intermediate steps", action="store_true", default=False)
+    parser.add_argument("-k", "--bits", help="covert bits per packet, must be the same as the sender's. Default 1", type=int, default=1)
+    parser.add_argument("--single-session", help="preamble and covert message come in one sender session, must be the same as the sender's (detected from binary framing)", action="store_true", default=False)
+    parser.add_argument("-b", "--backend", help="packet receive path, raw: raw socket + BPF filter with batched receives, scapy: sniff(). Default raw", type=str, choices=["raw", "scapy"], default="raw")
+    parser.add_argument("-n", "--workers", help="number of receiver processes, flows (sender IP, port) are sharded over them. Default 1", type=int, default=1)
+    parser.add_argument("--reorder-window", help="single session: packets accepted past the lowest missing seq before the preamble is detected, must be at least the sender's window (-w). Default 64", type=int, default=64)
+    parser.add_argument("--ack-port", help="port the ACKs are sent to, 0 for the source port of each flow. Default 9999", type=int, default=9999)
+    parser.add_argument("--fec", help="forward error correction of the covert bits, must be the same as the sender's. Default none", type=str, choices=["none", "hamming"], default="none")
+    parser.add_argument("--fec-depth", help="FEC interleaving depth in codewords, must be the same as the sender's. Default 8", type=int, default=8)
+    parser.add_argument("--ack-every", help="delayed ACKs: one SACK ACK per flow every N packets. Default 1 (ACK every packet)", type=int, default=1)
+    parser.add_argument("--ack-delay", help="delayed ACKs: send a pending SACK ACK at most this many milliseconds after its first packet. Default 0 (200 ms if --ack-every > 1)", type=float, default=0)
+    parser.add_argument("-a", "--ack-format", help="ACK format, seq: one ASCII sequence number per packet, sack: cumulative ACK + SACK bitmap. Default sack", type=str, choices=["seq", "sack"], default="sack")
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_receiver(args)
+    else:
+        # One process per shard of flows, every process filters its own flows in the kernel
+        import multiprocessing
+        workers = [multiprocessing.Process(target=run_receiver, args=(args, shard, args.workers)) for shard in range(args.workers)]
+        for worker in workers: worker.start()
+        try:
+            for worker in workers: worker.join()
+        except KeyboardInterrupt:
+            for worker in workers: worker.join() # Workers got the same Ctrl+C and print their messages
@@ -0,0 +1,272 @@
+"""
+Offline replay benchmark for the receiver hot path.
+
+Packets are fed straight into CovertReceiver.handle_packet (raw backend path,
+PacketViews) or packet_callback (scapy backend path, scapy packets) as fast
+as possible, without NATS, the switch, the processor or a live sender.
+So the numbers show the cost of the receiver itself.
+
+Packet sources:
+    pcap       a capture of the traffic to the receiver port (read with scapy, no libpcap needed)
+    csv        a session log of the sender (shared-data/covert_sessions_*.csv), every row
+               becomes a packet with the logged payload and checksum
+    synthetic  preamble + covert sessions of random messages, as CovertSender would send
+               them, optionally from several flows interleaved (default)
+
+Reported:
+    packets/s            replay rate without per packet timing
+    latency percentiles  time spent in the receiver for one packet (decode, reassembly, ACK)
+    memory per packet    tracemalloc peak and net allocated bytes/blocks per packet
+
+Example use:
+    python replay_bench.py                                  # synthetic, 1 flow
+    python replay_bench.py synthetic --flows 16 -k 3
+    python replay_bench.py csv ../../shared-data/covert_sessions_07a9b3a4.csv
+    python replay_bench.py pcap capture.pcap --mode scapy --no-acks
+
+WARNING: The receiver ACKs every packet (to 127.0.0.1 for csv and synthetic
+packets). Use --no-acks for captures from other hosts, ACKs are then dropped
+before the socket. Receiver logs are silenced during the replay unless -v is given.
+"""
+import io
+import csv
+import time
+import random
+import argparse
+import tracemalloc
+import contextlib
+
+from receiver import CovertReceiver, BINARY_HEADER, BINARY_FRAMING_FLAG, FLAG_SINGLE_SESSION, SESSION_ID_SHIFT
+from raw_receiver import PacketView
+from fec import get_fec
+
+CARRIER_TEXT = b"Hello, this is a long message. "
+LOCAL_IP = "127.0.0.1"
+
+class _NullSocket:
+    # Drops the ACKs instead of sending them (--no-acks)
+    def sendto(self, data, addr): return len(data)
+    def close(self): pass
+
+class _NullOutput(io.TextIOBase):
+    # Receiver logs during the replay, discarded so they are not counted as receiver memory
+    def write(self, text): return len(text)
+
+# ------------------------------------------------------------------------------------------------
+# Packet sources, all return a list of PacketViews (or scapy packets with scapy=True)
+# ------------------------------------------------------------------------------------------------
+def load_pcap(path, port=8888, scapy=False)->list:
+    # UDP packets to port in the capture
+    from scapy.all import PcapReader, IP, UDP, Raw
+    packets = []
+    with PcapReader(path) as reader:
+        for packet in reader:
+            if IP in packet and UDP in packet and Raw in packet and packet[UDP].dport == port:
+                packets.append(packet if scapy else PacketView.from_scapy(packet))
+    return packets
+
+def load_csv(path, port=8888, sport=9999)->list:
+    # Rows of a session log: timestamp, checksum, payload, length, is_covert
+    packets = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            packets.append(PacketView(LOCAL_IP, sport, port, int(row["checksum"]), row["payload"].encode()))
+    return packets
+
+def _session_packets(symbols, k, flow, port, flags=None, chunk_size=12, dup_rate=0.0, loss=0.0, first_lossy=0):
+    # Packets of one sender session, symbol i is carried by packet i.
+    # flags None: ASCII "[seq]" framing, otherwise binary header with flags.
+    # With dup_rate > 0, that fraction of the packets is received again a few packets
+    # later, like a retransmission whose original was received. With loss > 0, that
+    # fraction of the packets from first_lossy on is lost (never retransmitted).
+    src, sport = flow
+    packets = []
+    for seq, symbol in enumerate(symbols):
+        start = seq * chunk_size % len(CARRIER_TEXT)
+        chunk = (CARRIER_TEXT * 2)[start:start + chunk_size]
+        header = b"[%d]" % seq if flags is None else BINARY_HEADER.pack(BINARY_FRAMING_FLAG | flags, seq)
+        payload = header + chunk
+        if k > 1: # Length class padding, see sec/encoding.py
+            num_classes = 2 ** (k - 1)
+            payload += b" " * ((int(symbol[1:], 2) - len(payload)) % num_classes)
+        chksum = 0 if symbol[0] == '0' else random.randint(1, 0xFFFF)
+        if seq >= first_lossy and random.random() < loss: continue
+        packets.append(PacketView(src, sport, port, chksum, payload))
+        if len(packets) >= 5 and random.random() < dup_rate:
+            packets.append(packets[-random.randint(2, 5)])
+    return packets
+
+def synthetic_packets(num_sessions=100, msg_len=16, k=1, flows=1, single_session=False,
+                      port=8888, preamble="01010011", header_len=8, dup_rate=0.0, loss=0.0, fec=None,
+                      preamble_delay=0)->tuple:
+    # Covert sessions of random messages, flows are interleaved packet by packet.
+    # Covert bits are encoded with fec (see fec.py) if given, loss only hits covert packets.
+    # Single session: binary headers with the session id of the sender, seq 0 of every session
+    # is received preamble_delay packets late.
+    # Returns (packets, sent messages)
+    streams, messages = [], []
+    for f in range(flows):
+        flow = (LOCAL_IP, 10000 + f)
+        stream = []
+        for s in range(num_sessions):
+            message = bytes(random.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(msg_len))
+            messages.append(message.decode())
+            bits = format(len(message), f'0{header_len}b') + ''.join(format(byte, '08b') for byte in message)
+            if fec is not None: bits = fec.encode(bits)
+            covert = [bits[i:i + k].ljust(k, '0') for i in range(0, len(bits), k)]
+            pre = [bit.ljust(k, '0') for bit in preamble]
+            if single_session:
+                flags = FLAG_SINGLE_SESSION | (s % 4) << SESSION_ID_SHIFT
+                session = _session_packets(pre + covert, k, flow, port, flags=flags, dup_rate=dup_rate,
+                                           loss=loss, first_lossy=len(pre))
+                if preamble_delay: session.insert(min(preamble_delay, len(session) - 1), session.pop(0))
+                stream += session
+            else:
+                stream += _session_packets(pre, k, flow, port, dup_rate=dup_rate) + \
+                          _session_packets(covert, k, flow, port, dup_rate=dup_rate, loss=loss)
+        streams.append(stream)
+
+    packets = []
+    for i in range(max(len(stream) for stream in streams)):
+        packets += [stream[i] for stream in streams if i < len(stream)]
+    return packets, messages
+
+# ------------------------------------------------------------------------------------------------
+# Replay
+# ------------------------------------------------------------------------------------------------
+def _new_receiver(args):
+    receiver = CovertReceiver(port=0, dest_port=args.ack_port, verbose=args.verbose, ack_format=args.ack_format,
+                              bits_per_packet=args.bits, single_session=args.single_session,
+                              max_sessions=max(1024, args.flows), max_messages=max(100, args.sessions * args.flows),
+                              fec=args.fec, fec_depth=args.fec_depth, reorder_window=args.reorder_window)
+    if args.no_acks:
+        receiver.sock.close()
+        receiver.sock = _NullSocket()
+    return receiver
+
+def _replay(args, packets, callback_name, timed=False):
+    # Feed every packet to a fresh receiver, returns (receiver, elapsed seconds, per packet latencies in ns)
+    receiver = _new_receiver(args)
+    callback = getattr(receiver, callback_name)
+    latencies = []
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(_NullOutput())
+    try:
+        with quiet:
+            start = time.perf_counter()
+            if timed:
+                clock = time.perf_counter_ns
+                for packet in packets:
+                    t0 = clock()
+                    callback(packet)
+                    latencies.append(clock() - t0)
+            else:
+                for packet in packets:
+                    callback(packet)
+            elapsed = time.perf_counter() - start
+    finally:
+        receiver.shutdown()
+    return receiver, elapsed, latencies
+
+def _percentile(sorted_values, p):
+    if not sorted_values: return 0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+def run_benchmark(args, packets, expected_messages=None)->dict:
+    callback_name = "packet_callback" if args.mode == "scapy" else "handle_packet"
+    num_packets = len(packets)
+    results = {"packets": num_packets}
+
+    # Throughput, best of the repeats
+    best = None
+    for _ in range(args.repeat):
+        receiver, elapsed, _ = _replay(args, packets, callback_name)
+        best = elapsed if best is None else min(best, elapsed)
+    results["packets_per_second"] = num_packets / best
+    results["messages"] = len(receiver.total_covert_msg)
+    if expected_messages is not None:
+        decoded = list(receiver.total_covert_msg)
+        results["correct"] = sum(msg in expected_messages for msg in decoded)
+    print(f"[INFO] {num_packets} packets in {best:.3f} s: {results['packets_per_second']:.1f} pkt/s, "
+          f"{results['messages']} covert messages decoded"
+          + (f" ({results['correct']} correct)" if expected_messages is not None else ""))
+    results.update(receiver.get_retransmission_stats())
+    print(f"[INFO] Covert packets: {results['duplicates']} duplicates, {results['out_of_order']} out of order, {results['late']} late.")
+
+    # Per packet latency
+    _, _, latencies = _replay(args, packets, callback_name, timed=True)
+    latencies.sort()
+    for p in (50, 90, 99, 99.9):
+        results[f"p{p}_us"] = _percentile(latencies, p) / 1000
+    results["max_us"] = latencies[-1] / 1000 if latencies else 0
+    print("[INFO] Latency per packet: " + "  ".join(f"p{p} {results[f'p{p}_us']:.2f} us" for p in (50, 90, 99, 99.9))
+          + f"  max {results['max_us']:.2f} us")
+
+    # Memory, traced over one more replay
+    tracemalloc.start()
+    try:
+        before_size, _ = tracemalloc.get_traced_memory()
+        before = tracemalloc.take_snapshot()
+        receiver, _, _ = _replay(args, packets, callback_name)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    net_bytes = sum(stat.size_diff for stat in stats)
+    net_blocks = sum(stat.count_diff for stat in stats)
+    results["peak_bytes_per_packet"] = (peak - before_size) / max(1, num_packets)
+    results["net_bytes_per_packet"] = net_bytes / max(1, num_packets)
+    results["net_blocks_per_packet"] = net_blocks / max(1, num_packets)
+    print(f"[INFO] Memory per packet: peak {results['peak_bytes_per_packet']:.1f} B, "
+          f"net {results['net_bytes_per_packet']:.1f} B in {results['net_blocks_per_packet']:.2f} blocks")
+    return results
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="packet source, default synthetic", nargs="?", choices=["synthetic", "csv", "pcap"], default="synthetic")
+    parser.add_argument("path", help="csv or pcap file", nargs="?", default=None)
+    parser.add_argument("-m", "--mode", help="handle: PacketViews to handle_packet (raw backend), scapy: scapy packets to packet_callback. Default handle", choices=["handle", "scapy"], default="handle")
+    parser.add_argument("-p", "--port", help="receiver port, only packets to it are read from a pcap. Default 8888", type=int, default=8888)
+    parser.add_argument("-s", "--sessions", help="synthetic: covert sessions per flow, default 100", type=int, default=100)
+    parser.add_argument("-l", "--msg-len", help="synthetic: covert message length in bytes, default 16", type=int, default=16)
+    parser.add_argument("--flows", help="synthetic: number of interleaved sender flows, default 1", type=int, default=1)
+    parser.add_argument("--dup-rate", help="synthetic: fraction of packets received twice, default 0", type=float, default=0.0)
+    parser.add_argument("--loss", help="synthetic: fraction of covert packets lost, default 0", type=float, default=0.0)
+    parser.add_argument("--fec", help="FEC of the covert bits, default none", choices=["none", "hamming"], default="none")
+    parser.add_argument("--fec-depth", help="FEC interleaving depth in codewords, default 8", type=int, default=8)
+    parser.add_argument("--preamble-delay", help="synthetic single session: seq 0 arrives after this many later packets (retransmission of a lost seq 0). Default 0", type=int, default=0)
+    parser.add_argument("--reorder-window", help="receiver reorder window (single session), default 64", type=int, default=64)
+    parser.add_argument("-k", "--bits", help="covert bits per packet, default 1", type=int, default=1)
+    parser.add_argument("--single-session", help="preamble and covert message in one sender session (binary framing for synthetic packets)", action="store_true", default=False)
+    parser.add_argument("-a", "--ack-format", help="ACK format of the receiver, default sack", choices=["seq", "sack"], default="sack")
+    parser.add_argument("--ack-port", help="destination port of the ACKs, default 9999", type=int, default=9999)
+    parser.add_argument("--no-acks", help="drop ACKs instead of sending them", action="store_true", default=False)
+    parser.add_argument("-r", "--repeat", help="throughput runs, the best one is reported. Default 3", type=int, default=3)
+    parser.add_argument("--seed", help="random seed of the synthetic packets, default 0", type=int, default=0)
+    parser.add_argument("-v", "--verbose", help="print the receiver logs", action="store_true", default=False)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    random.seed(args.seed)
+
+    expected = None
+    if args.source == "synthetic":
+        if args.mode == "scapy":
+            raise ValueError("Synthetic packets are PacketViews, use --mode handle (or replay a pcap).")
+        packets, expected = synthetic_packets(args.sessions, args.msg_len, args.bits, args.flows,
+                                              args.single_session, port=args.port, dup_rate=args.dup_rate,
+                                              loss=args.loss, fec=get_fec(args.fec, args.fec_depth),
+                                              preamble_delay=args.preamble_delay)
+    elif args.path is None:
+        raise ValueError(f"A {args.source} file is needed.")
+    elif args.source == "csv":
+        if args.mode == "scapy":
+            raise ValueError("CSV rows are replayed as PacketViews, use --mode handle.")
+        packets = load_csv(args.path, port=args.port)
+    else:
+        packets = load_pcap(args.path, port=args.port, scapy=(args.mode == "scapy"))
+
+    if not packets:
+        raise ValueError("No packets to replay.")
+    run_benchmark(args, packets, expected)
@@ -0,0 +1,386 @@
+# Tests of the receiver's session state
+#
+# ------------------------------------------------------------------------------------------------
+"""
+Preamble detection and sender session boundaries with reordered, lost and
+late packets. Packets are fed to CovertReceiver.handle_packet() as
+PacketViews, ACKs are kept in a list instead of being sent. The building
+blocks (PreambleDetector, CovertReassembler, FECReassembler, SackState,
+AckCoalescer) are also tested on their own.
+
+    python3 -m pytest test_receiver.py
+"""
+# ------------------------------------------------------------------------------------------------
+
+import time
+import random
+import struct
+
+from fec import get_fec
+from raw_receiver import PacketView
+from receiver import (CovertReceiver, PreambleDetector, CovertReassembler, FECReassembler, SackState, AckCoalescer,
+                      BINARY_HEADER, BINARY_FRAMING_FLAG, FLAG_SINGLE_SESSION, SESSION_ID_SHIFT)
+
+PREAMBLE = "01010011"
+FLOW = ("10.0.0.1", 10000)
+
+class ListSocket:
+    # ACKs are appended to self.acks instead of being sent
+    def __init__(self): self.acks = []
+    def sendto(self, data, addr):
+        self.acks.append(data)
+        return len(data)
+    def close(self): pass
+
+def new_receiver(**kwargs)->CovertReceiver:
+    receiver = CovertReceiver(port=0, **kwargs)
+    receiver.sock.close()
+    receiver.sock = ListSocket()
+    return receiver
+
+def message_symbols(message, preamble=True, fec=None)->list:
+    # Preamble bits, then the 8-bit length header and the message bits (FEC encoded), one bit per packet
+    bits = format(len(message), '08b') + ''.join(format(byte, '08b') for byte in message.encode())
+    if fec is not None: bits = fec.encode(bits)
+    return list(PREAMBLE if preamble else "") + list(bits)
+
+def session_packets(symbols, session=0, single_session=True, framing="binary")->list:
+    # [(seq, PacketView)] of one sender session, seq i carries symbols[i]
+    flags = (FLAG_SINGLE_SESSION if single_session else 0) | (session % 4) << SESSION_ID_SHIFT
+    packets = []
+    for seq, symbol in enumerate(symbols):
+        header = BINARY_HEADER.pack(BINARY_FRAMING_FLAG | flags, seq) if framing == "binary" else b"[%d]" % seq
+        packets.append((seq, PacketView(FLOW[0], FLOW[1], 8888, 0 if symbol == '0' else 0x1234, header + b"carrier")))
+    return packets
+
+def feed(receiver, packets):
+    for _, packet in packets: receiver.handle_packet(packet)
+    return list(receiver.total_covert_msg)
+
+def move(packets, seq, position)->list:
+    # seq received after the packet at position instead of in order
+    packets = list(packets)
+    packets.insert(position, packets.pop(seq))
+    return packets
+
+# PreambleDetector.add (two sessions)
+
+def test_preamble_in_order():
+    detector = PreambleDetector(PREAMBLE)
+    results = [detector.add(seq, bit) for seq, bit in enumerate("11" + PREAMBLE)]
+    assert results == [False] * 9 + [True]
+
+def test_preamble_out_of_order():
+    # The preamble is the bits of the highest seqs, whatever the order they arrive in
+    rng = random.Random(0)
+    for _ in range(50):
+        detector = PreambleDetector(PREAMBLE)
+        order = list(range(len(PREAMBLE)))
+        rng.shuffle(order)
+        results = [detector.add(seq, PREAMBLE[seq]) for seq in order]
+        assert results == [False] * 7 + [True]
+
+def test_preamble_old_seq_ignored():
+    detector = PreambleDetector(PREAMBLE)
+    for seq, bit in enumerate(PREAMBLE): detector.add(seq + 10, bit)
+    assert detector.add(3, '1') is False # Below every kept seq
+    assert detector.seqs == list(range(10, 18))
+    assert detector.add(17, '0') is False # A duplicate replaces the bit
+    assert detector.add(17, '1') is True
+
+# PreambleDetector.add_in_stream (single session)
+
+def test_in_order_preamble():
+    detector = PreambleDetector(PREAMBLE)
+    symbols = PREAMBLE + "1111"
+    results = [detector.add_in_stream(seq, symbol) for seq, symbol in enumerate(symbols)]
+    assert results[:7] == [None] * 7
+    assert results[7] == len(PREAMBLE)
+
+def test_late_seq_0_keeps_early_symbols():
+    for delay in (7, 8, 16, 40, 63): # The rest of the preamble is in when seq 0 arrives
+        detector = PreambleDetector(PREAMBLE, reorder_window=64)
+        symbols = PREAMBLE + "10" * 40
+        for seq in range(1, delay + 1):
+            assert detector.add_in_stream(seq, symbols[seq]) is None
+        assert detector.add_in_stream(0, symbols[0]) == len(PREAMBLE)
+        # Every covert symbol that arrived before seq 0 is still there for the reassembler
+        assert all(detector.stream[seq] == symbols[seq] for seq in range(len(PREAMBLE), delay + 1))
+
+def test_preamble_in_covert_bits_before_late_seq_0():
+    # Covert bits that look like the preamble are not taken for it while seq 0 is missing
+    detector = PreambleDetector(PREAMBLE)
+    symbols = PREAMBLE + "1100" + PREAMBLE + "0000"
+    for seq in range(1, len(symbols)):
+        assert detector.add_in_stream(seq, symbols[seq]) is None
+    assert detector.add_in_stream(0, symbols[0]) == len(PREAMBLE)
+
+def test_reorder_window():
+    detector = PreambleDetector(PREAMBLE, reorder_window=16)
+    assert detector.accepts(15) and not detector.accepts(16)
+    assert detector.add_in_stream(16, '1') is None
+    assert 16 not in detector.stream
+    for seq in range(4): detector.add_in_stream(seq, PREAMBLE[seq])
+    assert detector.accepts(19) and not detector.accepts(20) # The window moves with the received prefix
+
+def test_random_reorder_and_duplicates():
+    rng = random.Random(0)
+    symbols = PREAMBLE + ''.join(rng.choice("01") for _ in range(56))
+    for _ in range(200):
+        detector = PreambleDetector(PREAMBLE, reorder_window=64)
+        order = list(range(len(symbols)))
+        rng.shuffle(order)
+        order += rng.sample(order, 10) # Retransmissions
+        for seq in order:
+            covert_base = detector.add_in_stream(seq, symbols[seq])
+            if covert_base is not None: break
+        assert covert_base == len(PREAMBLE)
+        received = set(order[:order.index(seq) + 1])
+        assert all(detector.stream[s] == symbols[s] for s in received if s >= covert_base)
+
+def test_reset_starts_a_new_session():
+    detector = PreambleDetector(PREAMBLE)
+    for seq in range(1, 5): detector.add_in_stream(seq, "1")
+    detector.reset()
+    results = [detector.add_in_stream(seq, symbol) for seq, symbol in enumerate(PREAMBLE)]
+    assert results[-1] == len(PREAMBLE)
+
+# CovertReassembler and FECReassembler
+
+def covert_symbols(message, bits_per_packet=1, fec=None)->list:
+    # Header + message bits (FEC encoded) in symbols of bits_per_packet bits, the last one padded
+    bits = ''.join(message_symbols(message, preamble=False, fec=fec))
+    k = bits_per_packet
+    return [bits[i:i + k].ljust(k, '0') for i in range(0, len(bits), k)]
+
+def test_reassembler_in_order():
+    reassembler = CovertReassembler()
+    symbols = covert_symbols("hi")
+    results = [reassembler.add(seq, symbol) for seq, symbol in enumerate(symbols)]
+    assert results == [False] * (len(symbols) - 1) + [True]
+    assert reassembler.msg_len == 2 and reassembler.get_message() == "hi"
+
+def test_reassembler_reorder_and_duplicates():
+    symbols = covert_symbols("reordered")
+    order = list(range(len(symbols)))
+    random.Random(1).shuffle(order)
+    reassembler = CovertReassembler()
+    for seq in order + order[:10]: reassembler.add(seq, symbols[seq])
+    assert len(reassembler) == len(symbols) and reassembler.has(0)
+    assert reassembler.is_complete() and reassembler.get_message() == "reordered"
+
+def test_reassembler_bits_per_packet():
+    for k in (2, 3, 4):
+        reassembler = CovertReassembler(bits_per_packet=k)
+        for seq, symbol in enumerate(covert_symbols("multi", bits_per_packet=k)): reassembler.add(seq, symbol)
+        assert reassembler.is_complete() and reassembler.get_message() == "multi"
+
+def test_reassembler_pop_ready():
+    symbols = covert_symbols("abc")
+    reassembler = CovertReassembler()
+    for seq in range(16): reassembler.add(seq, symbols[seq]) # Header and "a"
+    assert reassembler.pop_ready() == b"a"
+    assert reassembler.pop_ready() == b""
+    for seq in range(17, len(symbols)): reassembler.add(seq, symbols[seq]) # Seq 16 ("b") is missing
+    assert reassembler.pop_ready() == b""
+    flushed = reassembler.pop_ready(flush=True) # The missing bit is 0
+    assert flushed == bytes([ord("b") & 0x7F]) + b"c"
+
+def test_reassembler_header_lost():
+    symbols = covert_symbols("ab")
+    reassembler = CovertReassembler()
+    for seq in range(1, len(symbols)): reassembler.add(seq, symbols[seq])
+    assert reassembler.msg_len is None and not reassembler.is_complete() and reassembler.get_message() == ""
+
+def test_fec_reassembler_erasures():
+    fec = get_fec("hamming")
+    symbols = covert_symbols("erasures", fec=fec)
+    lost = set(range(0, len(symbols), 9)) # At most one bit of every codeword
+    reassembler = FECReassembler(fec)
+    results = [reassembler.add(seq, symbols[seq]) for seq in range(len(symbols)) if seq not in lost]
+    assert results[-1] and reassembler.is_complete()
+    assert reassembler.get_message() == "erasures"
+    assert reassembler.ready_bits() >= reassembler.total_bits
+
+def test_fec_reassembler_too_many_erasures():
+    fec = get_fec("hamming")
+    symbols = covert_symbols("erasures", fec=fec)
+    reassembler = FECReassembler(fec)
+    for seq in range(len(symbols) - 3 * fec.depth): reassembler.add(seq, symbols[seq])
+    assert reassembler.msg_len == len("erasures") and not reassembler.is_complete()
+    for seq in range(len(symbols) - 3 * fec.depth, len(symbols)): reassembler.add(seq, symbols[seq])
+    assert reassembler.is_complete() and reassembler.get_message() == "erasures"
+
+def test_fec_reassembler_pop_ready():
+    fec = get_fec("hamming")
+    symbols = covert_symbols("stream", fec=fec)
+    reassembler = FECReassembler(fec)
+    delivered = b""
+    for seq, symbol in enumerate(symbols):
+        reassembler.add(seq, symbol)
+        delivered += reassembler.pop_ready()
+    assert delivered == b"stream"
+
+# SackState
+
+def decode_sack(data)->tuple:
+    # (epoch, cum, seqs of the bitmap), as decode_ack() of sec/reliability.py
+    assert data[:1] == b'S'
+    epoch, cum, base = struct.unpack_from('!BII', data, 1)
+    bitmap = data[10:]
+    seqs = [base + i for i in range(8 * len(bitmap)) if bitmap[i // 8] & (0x80 >> (i % 8))]
+    return epoch, cum, seqs
+
+def test_sack_cumulative():
+    sack = SackState()
+    for seq in (0, 1, 2): sack.add(seq)
+    assert sack.cum == 3 and not sack.above
+    assert decode_sack(sack.encode(2)) == (0, 3, [])
+
+def test_sack_bitmap():
+    sack = SackState()
+    for seq in (0, 2, 3, 5): sack.add(seq)
+    assert sack.cum == 1
+    assert decode_sack(sack.encode(5)) == (0, 1, [2, 3, 5])
+    assert decode_sack(sack.encode(3)) == (0, 1, [2, 3]) # The bitmap ends at the seq of the ACK
+    sack.add(1)
+    assert sack.cum == 4 and sack.above == {5}
+    sack.add(1) # Duplicate below cum
+    assert sack.cum == 4
+
+def test_sack_bitmap_window():
+    sack = SackState(max_bitmap_bytes=2)
+    for seq in range(1, 40): sack.add(seq)
+    epoch, cum, seqs = decode_sack(sack.encode(39))
+    assert cum == 0 and seqs == list(range(24, 40)) # The last 16 seqs
+    for seq in range(1000, 1200): sack.add(seq)
+    assert len(sack.above) <= 4 * 16 + 1 # Seqs far below the newest one are forgotten
+
+def test_sack_epoch():
+    sack = SackState()
+    sack.add(0)
+    sack.reset()
+    assert sack.cum == 0 and sack.epoch == 0 # State toggle, same sender session
+    for _ in range(256): sack.reset(new_session=True)
+    assert sack.epoch == 0
+    sack.reset(new_session=True)
+    assert decode_sack(sack.encode(0))[0] == 1
+
+# AckCoalescer
+
+def test_coalescer_max_packets():
+    sock = ListSocket()
+    coalescer = AckCoalescer(sock, max_packets=4, max_delay=10)
+    sack = SackState()
+    for seq in range(8): coalescer.add(FLOW, FLOW, sack, seq)
+    coalescer.close()
+    assert [decode_sack(ack)[1] for ack in sock.acks] == [4, 8]
+    assert coalescer.num_packets == 8 and coalescer.num_acks == 2
+
+def test_coalescer_max_delay():
+    sock = ListSocket()
+    coalescer = AckCoalescer(sock, max_packets=100, max_delay=0.01)
+    sack = SackState()
+    coalescer.add(FLOW, FLOW, sack, 0)
+    coalescer.add(FLOW, FLOW, sack, 2)
+    deadline = time.time() + 2
+    while not sock.acks and time.time() < deadline: time.sleep(0.005)
+    assert [decode_sack(ack) for ack in sock.acks] == [(0, 1, [2])]
+    coalescer.close()
+    assert len(sock.acks) == 1
+
+def test_coalescer_flows_and_reset():
+    sock = ListSocket()
+    coalescer = AckCoalescer(sock, max_packets=100, max_delay=10)
+    other = ("10.0.0.2", 10000)
+    sacks = {FLOW: SackState(), other: SackState()}
+    coalescer.add(FLOW, FLOW, sacks[FLOW], 0)
+    coalescer.add(other, other, sacks[other], 1)
+    coalescer.reset_flow(FLOW, sacks[FLOW]) # The pending ACK of FLOW goes out with the old epoch
+    assert sacks[FLOW].epoch == 1 and sacks[FLOW].cum == 0
+    coalescer.close()
+    assert sorted(decode_sack(ack) for ack in sock.acks) == [(0, 0, [1]), (0, 1, [])]
+
+# Sender session boundaries (CovertReceiver)
+
+def test_single_session_late_seq_0_every_session():
+    messages = ["first", "second", "third", "fourth", "fifth"]
+    receiver = new_receiver()
+    for i, message in enumerate(messages):
+        packets = session_packets(message_symbols(message), session=i)
+        feed(receiver, move(packets, 0, 20))
+    assert list(receiver.total_covert_msg) == messages
+
+def test_single_session_lost_packet_does_not_splice_sessions():
+    # Seq 1 of the second session is lost (the sender gave up on it), the third session
+    # must not be decoded as the rest of the second one
+    receiver = new_receiver()
+    feed(receiver, session_packets(message_symbols("mynbiqpmzjplsgqe"), session=0))
+    feed(receiver, [p for p in session_packets(message_symbols("lostlostlostlost"), session=1) if p[0] != 1])
+    feed(receiver, session_packets(message_symbols("waqoyvlpmaqcvcvx"), session=2))
+    assert list(receiver.total_covert_msg) == ["mynbiqpmzjplsgqe", "waqoyvlpmaqcvcvx"]
+
+def test_previous_session_packets_are_not_decoded():
+    receiver = new_receiver()
+    first = session_packets(message_symbols("first"), session=0)
+    second = session_packets(message_symbols("second"), session=1)
+    feed(receiver, first)
+    num_acks = len(receiver.sock.acks)
+    # Retransmissions of the first session arrive among the second session's packets
+    feed(receiver, second[:5] + first[8:20] + second[5:])
+    assert list(receiver.total_covert_msg) == ["first", "second"]
+    assert len(receiver.sock.acks) == num_acks + len(second)
+
+def test_unfinished_covert_session_ends_at_next_session():
+    # The first message misses its last packet, the next session's packets are not its bits
+    receiver = new_receiver()
+    first = session_packets(message_symbols("ab"), session=0)
+    feed(receiver, first[:-1])
+    feed(receiver, session_packets(message_symbols("cd"), session=1))
+    messages = list(receiver.total_covert_msg)
+    assert len(messages) == 2 and messages[0][0] == "a" and messages[1] == "cd"
+
+def test_two_sessions_ascii_duplicate_seq_0():
+    # ASCII framing has no session id: a retransmitted seq 0 is not a new session
+    receiver = new_receiver()
+    preamble = session_packets(list(PREAMBLE), single_session=False, framing="ascii")
+    covert = session_packets(message_symbols("dup", preamble=False), single_session=False, framing="ascii")
+    feed(receiver, preamble[:5] + [preamble[0]] + preamble[5:])
+    feed(receiver, covert[:5] + [covert[0]] + covert[5:])
+    assert list(receiver.total_covert_msg) == ["dup"]
+
+# FEC sessions
+
+def test_fec_erasures_are_not_filled_by_the_next_session():
+    # The last packets of the first message are lost, too many for its last codewords to be
+    # rebuilt: it ends incomplete at the next session, whose packets are not used as its bits
+    fec = get_fec("hamming")
+    receiver = new_receiver(fec="hamming")
+    first = session_packets(message_symbols("first message", fec=fec), session=0)
+    feed(receiver, first[:-3 * fec.depth])
+    feed(receiver, session_packets(message_symbols("second", fec=fec), session=1))
+    messages = list(receiver.total_covert_msg)
+    assert len(messages) == 2
+    assert messages[0][:11] == "first messa" # Codewords of the last chars lost 3 bits each
+    assert messages[1] == "second"
+
+def test_fec_recovered_loss_then_next_session():
+    fec = get_fec("hamming")
+    receiver = new_receiver(fec="hamming")
+    first = session_packets(message_symbols("first message", fec=fec), session=0)
+    feed(receiver, [p for p in first if p[0] not in (20, 21, 60, 100, 101, 102)])
+    feed(receiver, session_packets(message_symbols("second", fec=fec), session=1))
+    assert list(receiver.total_covert_msg) == ["first message", "second"]
+
+def test_fec_two_sessions_ascii():
+    # ASCII framing: the next preamble session's seq 0 ends the unfinished covert session
+    fec = get_fec("hamming")
+    receiver = new_receiver(fec="hamming")
+    for message, lost in (("first message", 3 * fec.depth), ("second message", 0)):
+        feed(receiver, session_packets(list(PREAMBLE), single_session=False, framing="ascii"))
+        covert = session_packets(message_symbols(message, preamble=False, fec=fec), single_session=False, framing="ascii")
+        feed(receiver, covert[:len(covert) - lost])
+    messages = list(receiver.total_covert_msg)
+    assert len(messages) == 2
+    assert messages[0][:11] == "first messa"
+    assert messages[1] == "second message"
@@ -1,9 +1,12 @@
 import asyncio
 from nats.aio.client import Client as NATS
-import os, random
+import os, random, argparse
 from scapy.all import Ether
 
-async def run():
+async def run(queue=None, shard=None):
+    # queue: NATS queue group to join, every frame goes to one processor of the group
+    # shard: only handle the frames of this flow shard, published to <topic>.<shard> by
+    # the dispatcher of udp-checksum-processor/sharding.py (frames of a flow stay on one processor)
     nc = NATS()
 
     nats_url = os.getenv("NATS_SURVEYOR_SERVERS", "nats://nats:4222")
@@ -18,16 +21,18 @@ async def run():
         # Publish the received message to outpktsec and outpktinsec
         #delay = random.expovariate(1 / 5e-6)
         #await asyncio.sleep(delay)
-        if subject == "inpktsec":
+        if subject == in_topics[0]:
             await nc.publish("outpktinsec", msg.data)
         else:
             await nc.publish("outpktsec", msg.data)
    
     # Subscribe to inpktsec and inpktinsec topics
-    await nc.subscribe("inpktsec", cb=message_handler)
-    await nc.subscribe("inpktinsec", cb=message_handler)
+    in_topics = ["inpktsec", "inpktinsec"]
+    if shard is not None: in_topics = [f"{topic}.{shard}" for topic in in_topics]
+    for topic in in_topics:
+        await nc.subscribe(topic, queue=queue or "", cb=message_handler)
 
-    print("Subscribed to inpktsec and inpktinsec topics")
+    print(f"Subscribed to {' and '.join(in_topics)} topics" + (f" in queue group {queue}" if queue else ""))
 
     try:
         while True:
@@ -37,4 +42,8 @@ async def run():
         await nc.close()
 
 if __name__ == '__main__':
-    asyncio.run(run())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-q', '--queue', type=str, default=None, help='Join this NATS queue group, to run several processors that share the frames.')
+    parser.add_argument('--shard', type=int, default=None, help='Only handle the frames of this flow shard (see udp-checksum-processor/sharding.py).')
+    args = parser.parse_args()
+    asyncio.run(run(args.queue, args.shard))
\ No newline at end of file
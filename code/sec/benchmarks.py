@@ -0,0 +1,127 @@
+"""
+Micro benchmarks for the sender hot paths.
+
+These do not need the receiver, NATS or the processor to be running.
+ACKs are simulated, so the numbers show the cost of the sender itself,
+not the capacity of the covert channel (use run_experiments.py for that).
+
+Example use:
+    python benchmarks.py window              # threaded vs batched window sends
+    python benchmarks.py window -b scapy     # same with the scapy send path
+    python benchmarks.py scheduler           # retransmission timer cost per packet
+
+WARNING: Sending through raw sockets requires root (as does sender.py).
+If INSECURENET_HOST_IP is not set, packets are sent to 127.0.0.1.
+"""
+import os
+import time
+import random
+import argparse
+
+from sender import CovertSender
+from reliability import RetransmissionScheduler
+from carrier import CarrierSource
+from utils import random_string
+
+def _prepare_session(sender, num_packets):
+    # Fill the sender with a session of num_packets packets
+    # without starting the ACK thread
+    carrier = CarrierSource(random_string(num_packets * (sender.max_payload - 8)), sender.max_payload - 8)
+
+    sender.covert_bits_str = ''.join(random.choice('01') for _ in range(num_packets))
+    sender.session_covert_bits_len = sender.session_data_bits_len = num_packets
+    sender.session_covert_pkts_len = num_packets
+    sender.cur_pkt_idx = 0
+    sender.window_start = 0
+    return carrier
+
+def bench_window_send(window_sizes, num_packets, backend="raw", udpsize=20)->dict:
+    # Packets per second of the threaded window send (a thread per packet)
+    # against the batched one (single sendmmsg), for each window size.
+    # Every window is assumed to be ACKed right after it is sent.
+    results = {}
+    for window_size in window_sizes:
+        results[window_size] = {}
+        for mode in ["threaded", "batch"]:
+            sender = CovertSender(window_size=window_size, max_udp_payload=udpsize,
+                                  backend=backend, batch=(mode == "batch"))
+            try:
+                carrier = _prepare_session(sender, num_packets)
+                packet_timers, packet_transmission_count = {}, {}
+
+                start = time.perf_counter()
+                while sender.cur_pkt_idx < num_packets:
+                    if sender.batch:
+                        sender._send_window_batch(packet_timers, packet_transmission_count, carrier)
+                    else:
+                        sender._send_packets_within_window(packet_timers, packet_transmission_count, carrier)
+                    sender.window_start = sender.cur_pkt_idx # Simulate ACK of the whole window
+                elapsed = time.perf_counter() - start
+            finally:
+                sender.shutdown()
+
+            results[window_size][mode] = sender.total_packets_sent / elapsed
+
+        threaded, batch = results[window_size]["threaded"], results[window_size]["batch"]
+        print(f"window={window_size:3d}  threaded: {threaded:10.1f} pkt/s  batch: {batch:10.1f} pkt/s  speedup: x{batch / threaded:.2f}")
+    return results
+
+def _linear_scan_cost(window_size, num_packets, timeout, loss):
+    # Cost of the former window scan: every pass visits each packet in the window
+    received_acks, packet_timers = {}, {}
+    lost = set(random.sample(range(num_packets), int(num_packets * loss)))
+    start = time.perf_counter()
+    for i in range(num_packets):
+        packet_timers[i] = i # Packet i is sent at time i
+        if i >= window_size and (i - window_size) not in lost:
+            received_acks[i - window_size] = i
+        for idx in range(max(0, i - window_size + 1), i + 1):
+            if idx not in received_acks:
+                if i - packet_timers[idx] > timeout:
+                    received_acks[idx] = -1
+    return time.perf_counter() - start
+
+def _scheduler_cost(window_size, num_packets, timeout, loss):
+    # Same traffic through RetransmissionScheduler: schedule on send, cancel on ACK
+    scheduler = RetransmissionScheduler()
+    lost = set(random.sample(range(num_packets), int(num_packets * loss)))
+    start = time.perf_counter()
+    for i in range(num_packets):
+        scheduler.schedule(i, i + timeout)
+        if i >= window_size and (i - window_size) not in lost:
+            scheduler.cancel(i - window_size)
+        scheduler.pop_expired(i)
+    return time.perf_counter() - start
+
+def bench_scheduler(window_sizes, num_packets, loss=0.01)->dict:
+    # Timer bookkeeping cost per packet, linear window scan vs heap scheduler.
+    # Time is counted in packets: one packet is sent per time unit, the oldest
+    # packet of the window is ACKed (unless lost) and the timeout is a bit
+    # longer than a window, so only lost packets ever time out.
+    results = {}
+    for window_size in window_sizes:
+        timeout = window_size + 1
+        linear = _linear_scan_cost(window_size, num_packets, timeout, loss)
+        heap = _scheduler_cost(window_size, num_packets, timeout, loss)
+        results[window_size] = {"linear": linear / num_packets, "heap": heap / num_packets}
+        print(f"window={window_size:5d}  linear scan: {1e6 * linear / num_packets:9.3f} us/pkt  heap: {1e6 * heap / num_packets:7.3f} us/pkt")
+    return results
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", help="benchmark to run", choices=["window", "scheduler"])
+    parser.add_argument("-n", "--packets", help="number of packets per run, default 2048", type=int, default=2048)
+    parser.add_argument("-b", "--backend", help="packet send path, default raw", type=str, choices=["raw", "scapy"], default="raw")
+    parser.add_argument("-s", "--udpsize", help="maximum UDP payload size, default 20", type=int, default=20)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    os.environ.setdefault('INSECURENET_HOST_IP', '127.0.0.1')
+
+    if args.benchmark == "window":
+        window_sizes = [1, 2, 4, 8, 16, 32, 64]
+        bench_window_send(window_sizes, args.packets, backend=args.backend, udpsize=args.udpsize)
+    elif args.benchmark == "scheduler":
+        window_sizes = [1, 4, 16, 64, 256, 1024]
+        bench_scheduler(window_sizes, args.packets)
@@ -0,0 +1,136 @@
+# Carrier message sources
+#
+# ------------------------------------------------------------------------------------------------
+"""
+CarrierSource Class
+---------------------
+Produces the overt packets of a session lazily, only when the sender's
+window reaches them, instead of splitting the whole carrier message and
+building every "[seq]payload" string before the first packet is sent.
+
+The carrier can be a str/bytes message, a binary (or text) file object,
+an iterable of str/bytes blocks (e.g. a generator), or None for an endless
+synthetic carrier. Chunks are memoryview slices of the blocks read from the
+source, so nothing is copied until a packet is built. Chunks below the
+window are released (see release()), so memory stays flat however long
+the session is.
+
+Every packet starts with its sequence number, either as ASCII "[seq]"
+(framing="ascii") or as a fixed size binary header (framing="binary",
+see binary_sequence_header in utils.py).
+
+The same CarrierSource can be used for several sessions (e.g. preamble
+and covert message), every session starts numbering packets from 0 and
+continues reading the source where the previous one stopped.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import itertools
+from collections import deque
+
+from utils import BINARY_HEADER, binary_sequence_header
+
+DEFAULT_SYNTHETIC_TEXT = "Hello, this is a long message. "
+# Payload bytes kept for the sequence number header of each framing
+FRAMING_HEADER_LEN = {"ascii": 8, "binary": BINARY_HEADER.size}
+
+def synthetic_carrier(text=DEFAULT_SYNTHETIC_TEXT, block_repeat=256):
+    # Endless carrier, yields blocks of the repeated text
+    block = (text * block_repeat).encode()
+    return itertools.repeat(block)
+
+class CarrierSource:
+    def __init__(self, source=None, chunk_size=12, read_size=65536, framing="ascii"):
+        self.chunk_size = chunk_size
+        self.framing = framing
+        self.flags = 0 # Flags of the binary header
+        self.read_size = read_size # Block size when reading file objects
+        self.length = None # Total bytes of the carrier, None if not known in advance (streams)
+
+        if source is None:
+            self._blocks = synthetic_carrier()
+        elif isinstance(source, str):
+            encoded = source.encode()
+            self._blocks = iter([encoded])
+            self.length = len(encoded)
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self._blocks = iter([source])
+            self.length = len(source)
+        elif hasattr(source, "read"):
+            self._blocks = iter(lambda: source.read(self.read_size), source.read(0))
+        else:
+            self._blocks = iter(source)
+
+        self._buf = memoryview(b"") # Unread part of the current block
+        self._exhausted = False
+        self.bytes_read = 0 # Carrier bytes consumed so far, over all sessions
+        self.start_session(chunk_size, framing)
+
+    def start_session(self, chunk_size=None, framing=None, flags=0):
+        # Packet numbers restart from 0, unsent chunks of the last session are skipped
+        if chunk_size is not None:
+            assert chunk_size > 0, f"[ERROR] Carrier chunk size must be positive, got {chunk_size}"
+            self.chunk_size = chunk_size
+        if framing is not None:
+            if framing not in FRAMING_HEADER_LEN:
+                raise ValueError(f"Unknown framing {framing}. Must be one of {list(FRAMING_HEADER_LEN)}.")
+            self.framing = framing
+        self.flags = flags
+        self._chunks = deque() # Chunks of packets first_idx, first_idx + 1, ...
+        self._first_idx = 0
+        self._session_start = self.bytes_read
+
+    def num_packets(self):
+        # Packets left in the carrier for this session, None if unknown (streamed carrier)
+        if self.length is None: return None
+        remaining = self.length - self._session_start
+        return max(0, -(-remaining // self.chunk_size))
+
+    def _next_block(self):
+        for block in self._blocks:
+            if isinstance(block, str): block = block.encode()
+            if len(block): return memoryview(block)
+        self._exhausted = True
+        return None
+
+    def _read_chunk(self):
+        # Next chunk of the carrier, None at the end of the carrier
+        while len(self._buf) < self.chunk_size and not self._exhausted:
+            block = self._next_block()
+            if block is None: break
+            if len(self._buf):
+                # A chunk spans two blocks, only the leftover of the old block is copied
+                block = memoryview(bytes(self._buf) + bytes(block))
+            self._buf = block
+
+        if not len(self._buf): return None
+        chunk, self._buf = self._buf[:self.chunk_size], self._buf[self.chunk_size:]
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def has_packet(self, idx)->bool:
+        # Reads the carrier up to packet idx, False if the carrier ends before it
+        while idx >= self._first_idx + len(self._chunks):
+            chunk = self._read_chunk()
+            if chunk is None: return False
+            self._chunks.append(chunk)
+        return True
+
+    def get_packet(self, idx)->bytes:
+        # Payload of packet idx: sequence number header followed by its chunk
+        if idx < self._first_idx:
+            raise IndexError(f"Carrier packet {idx} is already released (first kept packet is {self._first_idx}).")
+        if not self.has_packet(idx):
+            raise IndexError(f"Carrier has no packet {idx}.")
+        chunk = self._chunks[idx - self._first_idx]
+        if self.framing == "binary":
+            return binary_sequence_header(idx, self.flags) + chunk
+        return b"[%d]" % idx + chunk # Same as assign_sequence_number
+
+    __getitem__ = get_packet
+
+    def release(self, below):
+        # Forget the chunks of packets before below (ACKed or dropped)
+        while self._chunks and self._first_idx < below:
+            self._chunks.popleft()
+            self._first_idx += 1
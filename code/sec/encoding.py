@@ -0,0 +1,51 @@
+# Covert symbol encodings
+#
+# ------------------------------------------------------------------------------------------------
+"""
+Encodings decide how a symbol of k covert bits is carried by one packet.
+
+ChecksumEncoding (k=1): existence of the UDP checksum encodes the bit,
+                        '1' -> checksum present, '0' -> checksum 0 (the original design)
+LengthClassEncoding (k>=2): first bit as above, the remaining k-1 bits are the
+                        UDP payload length modulo 2^(k-1), reached by padding the
+                        payload with up to 2^(k-1)-1 bytes.
+
+The receiver must be started with the same number of bits per packet
+(see CovertReceiver). Preamble is always sent with ChecksumEncoding.
+"""
+# ------------------------------------------------------------------------------------------------
+
+class ChecksumEncoding:
+    bits_per_packet = 1
+    max_padding = 0 # Bytes that may be added to a payload
+
+    def _check_symbol(self, symbol):
+        if len(symbol) != self.bits_per_packet or symbol.strip('01'):
+            raise ValueError(f"Invalid covert symbol. Must be {self.bits_per_packet} bit(s) of '0' or '1'. Got: {symbol}")
+
+    def encode(self, payload, symbol)->tuple:
+        # Returns (payload to send, whether to send the UDP checksum)
+        # symbol is None for packets that carry no covert bits
+        if symbol is None: return payload, True
+        self._check_symbol(symbol)
+        return payload, symbol != '0'
+
+class LengthClassEncoding(ChecksumEncoding):
+    def __init__(self, bits_per_packet=2, pad_byte=b' '):
+        assert bits_per_packet >= 2, f"[ERROR] Length classes need at least 2 bits per packet, got {bits_per_packet}"
+        self.bits_per_packet = bits_per_packet
+        self.num_classes = 2 ** (bits_per_packet - 1)
+        self.max_padding = self.num_classes - 1
+        self.pad_byte = pad_byte
+
+    def encode(self, payload, symbol)->tuple:
+        if symbol is None: return payload, True
+        self._check_symbol(symbol)
+        length_class = int(symbol[1:], 2)
+        num_pad = (length_class - len(payload)) % self.num_classes
+        return bytes(payload) + self.pad_byte * num_pad, symbol[0] != '0'
+
+def get_encoding(bits_per_packet=1)->ChecksumEncoding:
+    if bits_per_packet == 1:
+        return ChecksumEncoding()
+    return LengthClassEncoding(bits_per_packet)
@@ -0,0 +1,63 @@
+# Forward error correction of covert bits
+#
+# ------------------------------------------------------------------------------------------------
+"""
+HammingFEC Class
+------------------
+Hamming(7,4) code over the covert bitstream (header + message bits), so the
+receiver can rebuild the bits of lost packets without waiting for a timeout
+and a retransmission.
+
+Every 4 data bits are sent as a 7-bit codeword. A codeword survives 2 lost
+bits (erasures, the receiver knows which packets are missing) or 1 flipped bit.
+Codewords are interleaved in blocks of depth codewords: bit i of codeword j
+of a block is sent at position i * depth + j of the block, so a burst of up
+to 2 * depth lost bits costs every codeword of the block at most 2 bits.
+The data is padded with zeros to a whole block.
+
+Codeword bits are in Hamming's order p1 p2 d1 p3 d2 d3 d4, the syndrome of a
+received word is the position (1..7) of a single flipped bit.
+
+The receiver must be started with the same code and depth (see insec/fec.py).
+"""
+# ------------------------------------------------------------------------------------------------
+
+DATA_BITS = 4
+CODE_BITS = 7
+
+def hamming74_encode(d1, d2, d3, d4)->list:
+    # Codeword bits p1 p2 d1 p3 d2 d3 d4 of the data bits
+    return [d1 ^ d2 ^ d4, d1 ^ d3 ^ d4, d1, d2 ^ d3 ^ d4, d2, d3, d4]
+
+class HammingFEC:
+    name = "hamming"
+
+    def __init__(self, depth=8):
+        assert depth >= 1, f"[ERROR] Interleaving depth must be at least 1, got {depth}"
+        self.depth = depth
+        self.block_data_bits = DATA_BITS * depth
+        self.block_code_bits = CODE_BITS * depth
+
+    def encoded_len(self, num_bits)->int:
+        # Number of bits sent for num_bits data bits
+        num_blocks = -(-num_bits // self.block_data_bits)
+        return num_blocks * self.block_code_bits
+
+    def encode(self, bits)->str:
+        # bits: string of '0' and '1', returns the interleaved codeword bits as a string
+        num_blocks = -(-len(bits) // self.block_data_bits)
+        data = [int(bit) for bit in bits.ljust(num_blocks * self.block_data_bits, '0')]
+        encoded = []
+        for b in range(num_blocks):
+            block = data[b * self.block_data_bits:(b + 1) * self.block_data_bits]
+            codewords = [hamming74_encode(*block[j * DATA_BITS:(j + 1) * DATA_BITS]) for j in range(self.depth)]
+            encoded += [codewords[j][i] for i in range(CODE_BITS) for j in range(self.depth)]
+        return ''.join(map(str, encoded))
+
+def get_fec(name=None, depth=8):
+    # FEC of the covert bits, None to send them as they are
+    if name in (None, "none"):
+        return None
+    if name == HammingFEC.name:
+        return HammingFEC(depth)
+    raise ValueError(f"Unknown FEC {name}. Must be 'none' or '{HammingFEC.name}'.")
@@ -0,0 +1,157 @@
+# Raw socket UDP sender
+#
+# ------------------------------------------------------------------------------------------------
+"""
+RawUDPSender Class
+--------------------
+Sends IPv4/UDP packets through a single raw socket that stays open for the
+whole session, instead of building scapy layers and calling send() (which
+opens and closes a L3 socket) for every packet.
+
+IP and UDP headers are precomputed once as a byte template; per packet only
+the IP total length, IP id, UDP length, UDP checksum and the payload are written.
+The UDP checksum is computed here, so the covert bit (checksum present or 0)
+is decided without having to re-parse the packet afterwards.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import os
+import ctypes
+import socket
+import struct
+
+from utils import ones_complement_sum, internet_checksum
+
+IP_HEADER_LEN = 20
+UDP_HEADER_LEN = 8
+HEADER_LEN = IP_HEADER_LEN + UDP_HEADER_LEN
+
+# sendmmsg(2) is not exposed by the socket module, call it through libc when available
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+_sendmmsg = _load_sendmmsg()
+
+class RawUDPSender:
+    def __init__(self, dst_ip, dport, sport, src_ip=None, ttl=64, verbose=False):
+        self.verbose = verbose
+        self.dst_ip = dst_ip
+        self.dport = dport
+        self.sport = sport
+        self.src_ip = src_ip if src_ip else self.get_source_ip(dst_ip, dport)
+
+        self.ip_id = 0
+        self.template = self._build_template(ttl)
+        # Checksum of the parts of pseudo header + UDP header that never change
+        # (addresses, protocol and ports), lengths are added per packet.
+        self.partial_sum = ones_complement_sum(socket.inet_aton(self.src_ip) + socket.inet_aton(self.dst_ip) +
+                                               struct.pack('!HHH', socket.IPPROTO_UDP, self.sport, self.dport))
+
+        # IPPROTO_RAW implies IP_HDRINCL, the kernel still fills in the IP header checksum
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        self.sock.connect((self.dst_ip, 0)) # Connected so that send() needs no address per packet
+        if self.verbose: print(f"[DEBUG] Raw socket opened {self.src_ip}:{self.sport} -> {self.dst_ip}:{self.dport}")
+
+    def get_source_ip(self, dst_ip, dport, IP_NAME='SECURENET_HOST_IP'):
+        # Source address is needed for the UDP pseudo header,
+        # use the environment if set, otherwise ask the routing table.
+        src_ip = os.getenv(IP_NAME)
+        if src_ip: return src_ip
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect((dst_ip, dport)) # No packet is sent for UDP connect
+            return probe.getsockname()[0]
+        finally:
+            probe.close()
+
+    def _build_template(self, ttl):
+        # version/IHL, TOS, total length, id, flags/fragment, TTL, protocol, IP checksum, src, dst
+        ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 0, 0, 0, ttl, socket.IPPROTO_UDP, 0,
+                                socket.inet_aton(self.src_ip), socket.inet_aton(self.dst_ip))
+        # sport, dport, length, checksum
+        udp_header = struct.pack('!HHHH', self.sport, self.dport, 0, 0)
+        return ip_header + udp_header
+
+    def udp_checksum(self, payload)->int:
+        udp_len = UDP_HEADER_LEN + len(payload)
+        # UDP length appears both in the pseudo header and in the UDP header
+        return internet_checksum(payload, self.partial_sum + 2 * udp_len)
+
+    def build_packet(self, payload, with_checksum=True)->tuple:
+        # Returns (packet bytes, UDP checksum written into the packet)
+        udp_len = UDP_HEADER_LEN + len(payload)
+        chksum = self.udp_checksum(payload) if with_checksum else 0
+
+        self.ip_id = (self.ip_id + 1) & 0xFFFF
+        pkt = bytearray(self.template)
+        struct.pack_into('!HH', pkt, 2, IP_HEADER_LEN + udp_len, self.ip_id)
+        struct.pack_into('!HH', pkt, IP_HEADER_LEN + 4, udp_len, chksum)
+        pkt += payload
+        return pkt, chksum
+
+    def send(self, payload, with_checksum=True)->int:
+        # Send a single packet, returns the UDP checksum that was sent
+        pkt, chksum = self.build_packet(payload, with_checksum)
+        self.sock.send(pkt)
+        return chksum
+
+    def send_batch(self, payloads, checksum_flags)->list:
+        # Send all payloads with as few syscalls as possible (a single sendmmsg
+        # for the whole batch when libc provides it, one send per packet otherwise).
+        # checksum_flags[i] tells whether packet i carries a UDP checksum.
+        # Returns the list of UDP checksums that were sent.
+        pkts, chksums = [], []
+        for payload, with_checksum in zip(payloads, checksum_flags):
+            pkt, chksum = self.build_packet(payload, with_checksum)
+            pkts.append(pkt)
+            chksums.append(chksum)
+
+        if _sendmmsg is None or len(pkts) == 1:
+            for pkt in pkts:
+                self.sock.send(pkt)
+        else:
+            self._sendmmsg(pkts)
+        return chksums
+
+    def _sendmmsg(self, pkts):
+        n = len(pkts)
+        bufs = [(ctypes.c_char * len(pkt)).from_buffer(pkt) for pkt in pkts] # Keeps the buffers alive until sent
+        iovecs = (_iovec * n)()
+        msgs = (_mmsghdr * n)()
+        for i, buf in enumerate(bufs):
+            iovecs[i].iov_base = ctypes.addressof(buf)
+            iovecs[i].iov_len = len(pkts[i])
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1 # Socket is connected, so msg_name stays NULL
+
+        sent = 0
+        while sent < n:
+            ret = _sendmmsg(self.sock.fileno(), ctypes.byref(msgs[sent]), n - sent, 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            sent += ret
+        if self.verbose: print(f"[DEBUG] {n} packets sent with sendmmsg.")
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,257 @@
+# Reliability helpers of the covert sender
+#
+# ------------------------------------------------------------------------------------------------
+"""
+RetransmissionScheduler Class
+------------------------------
+Keeps the retransmission deadline of every packet in flight in a min-heap,
+so the sender only touches packets that actually timed out instead of
+scanning the whole window on every pass of its loop.
+
+Cancelling (e.g. when an ACK arrives) is lazy: the deadline is forgotten
+and the stale heap entry is skipped when it reaches the top of the heap.
+Every method takes the scheduler's own lock: in the threaded loop without
+batching, the per-packet send threads schedule their packets while the main
+thread holds the sender's lock (and joins them), so they cannot use that one.
+
+AckTracker Class
+------------------
+ACK state of a session: one byte per sequence number (pending, ACKed or
+dropped) plus running counters, so counting successful transmissions
+does not need to rescan every ACK of the session.
+
+RTOEstimator Class
+--------------------
+Adaptive retransmission timeout in the style of Jacobson/Karels (RFC 6298):
+smoothed RTT and RTT variance from ACKed packets, exponential backoff on
+timeouts. Lets the sender follow the delay added by the processor
+without sweeping the timeout by hand.
+
+CongestionWindow Class
+------------------------
+AIMD window: slow start up to ssthresh, then +1 packet per window of
+ACKs; halved (at most once per window of packets) on timeouts and drops.
+Keeps the trajectory of the window for the session stats.
+
+ACK wire format
+------------------
+Legacy ACKs are the ASCII decimal sequence number of a single packet.
+SACK ACKs (see CovertReceiver) are b'S' + 1-byte epoch + 4-byte big-endian
+cumulative ACK (every seq below it is received) + 4-byte big-endian base seq
++ a bitmap where bit i (MSB first) tells that seq base+i is received. One
+SACK ACK can confirm many packets. The receiver moves to the next epoch
+(mod 256) when a new sender session starts, so ACKs of the previous session
+that arrive late can be told apart although the seqs start over at 0.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import time
+import heapq
+import struct
+import threading
+
+SACK_ACK_TYPE = b'S' # Must be the same as in CovertReceiver
+PENDING, ACKED, DROPPED = 0, 1, 2
+
+def decode_ack(data)->tuple:
+    # Returns (epoch or None, cumulative ACK or None, list of individually ACKed seqs)
+    if data[:1] == SACK_ACK_TYPE:
+        epoch, cum, base = struct.unpack_from('!BII', data, 1)
+        bitmap = int.from_bytes(data[10:], 'big')
+        nbits = 8 * (len(data) - 10)
+        seqs = [base + i for i in range(nbits) if bitmap >> (nbits - 1 - i) & 1]
+        return epoch, cum, seqs
+    return None, None, [int(data.decode())]
+
+class RetransmissionScheduler:
+    def __init__(self):
+        self._heap = [] # (deadline, packet index)
+        self._deadlines = {} # packet index -> current deadline, the source of truth
+        self._lock = threading.Lock() # Not reentrant, _drop_stale_top and _compact expect it held
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, idx):
+        return idx in self._deadlines
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+            self._deadlines.clear()
+
+    def schedule(self, idx, deadline):
+        # (Re)schedule packet idx to time out at deadline
+        with self._lock:
+            self._deadlines[idx] = deadline
+            heapq.heappush(self._heap, (deadline, idx))
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._compact()
+
+    def cancel(self, idx):
+        # Returns True if idx was scheduled
+        with self._lock:
+            return self._deadlines.pop(idx, None) is not None
+
+    def next_deadline(self):
+        # Earliest deadline, None if nothing is scheduled
+        with self._lock:
+            self._drop_stale_top()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now)->list:
+        # Remove and return the indices whose deadline is not later than now
+        expired = []
+        with self._lock:
+            heap, deadlines = self._heap, self._deadlines
+            while heap and heap[0][0] <= now:
+                deadline, idx = heapq.heappop(heap)
+                if deadlines.get(idx) == deadline: # Skip cancelled or rescheduled entries
+                    del deadlines[idx]
+                    expired.append(idx)
+        return expired
+
+    def _drop_stale_top(self):
+        heap, deadlines = self._heap, self._deadlines
+        while heap and deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def _compact(self):
+        # Too many cancelled entries, rebuild the heap from live deadlines (lock held by schedule)
+        self._heap = [(deadline, idx) for idx, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+
+class AckTracker:
+    def __init__(self):
+        self._state = bytearray() # seq -> PENDING, ACKED or DROPPED
+        self._cum = 0 # Every seq below this is already ACKed by a cumulative ACK
+        self.num_acked = 0
+        self.num_dropped = 0
+
+    def __len__(self):
+        # Number of packets that are either ACKed or dropped
+        return self.num_acked + self.num_dropped
+
+    def __contains__(self, seq):
+        return 0 <= seq < len(self._state) and self._state[seq] != PENDING
+
+    def clear(self):
+        self._state = bytearray()
+        self._cum = 0
+        self.num_acked = 0
+        self.num_dropped = 0
+
+    def is_acked(self, seq):
+        return 0 <= seq < len(self._state) and self._state[seq] == ACKED
+
+    def _grow(self, seq):
+        if seq >= len(self._state):
+            self._state.extend(bytes(max(seq + 1, 2 * len(self._state)) - len(self._state)))
+
+    def mark_acked(self, seq)->bool:
+        # Returns True if seq was not ACKed before (a dropped packet can still be ACKed late)
+        if seq < 0: return False
+        self._grow(seq)
+        state = self._state[seq]
+        if state == ACKED: return False
+        if state == DROPPED: self.num_dropped -= 1
+        self._state[seq] = ACKED
+        self.num_acked += 1
+        return True
+
+    def mark_acked_below(self, cum)->list:
+        # Cumulative ACK, returns the seqs that are newly ACKed
+        newly_acked = [seq for seq in range(self._cum, cum) if self.mark_acked(seq)]
+        self._cum = max(self._cum, cum)
+        return newly_acked
+
+    def mark_dropped(self, seq):
+        if seq < 0: return
+        self._grow(seq)
+        if self._state[seq] == PENDING:
+            self._state[seq] = DROPPED
+            self.num_dropped += 1
+
+
+class RTOEstimator:
+    def __init__(self, initial_rto=1.0, min_rto=0.01, max_rto=10.0, alpha=1/8, beta=1/4, k=4, max_backoff=64):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.max_backoff = max_backoff
+
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.backoff = 1
+        self.num_samples = 0
+
+    def get_rto(self)->float:
+        return min(self.rto * self.backoff, self.max_rto)
+
+    def add_sample(self, rtt):
+        # Only use samples of packets transmitted once (Karn's algorithm),
+        # an ACK of a retransmitted packet may belong to any of its copies.
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = min(max(self.srtt + self.k * self.rttvar, self.min_rto), self.max_rto)
+        self.backoff = 1 # A fresh sample ends the backoff
+        self.num_samples += 1
+
+    def on_timeout(self):
+        self.backoff = min(2 * self.backoff, self.max_backoff)
+
+
+class CongestionWindow:
+    def __init__(self, max_window=64, min_window=1, initial_window=1):
+        self.max_window = max_window
+        self.min_window = min_window
+        self.cwnd = float(max(min(initial_window, max_window), min_window))
+        self.ssthresh = float(max_window)
+        self.recover_until = 0 # Losses of packets sent before this seq belong to the last decrease
+
+        self.start_time = time.time()
+        self.trajectory = [(0.0, self.size)] # (seconds since start, window size) at every change
+
+    @property
+    def size(self)->int:
+        return int(self.cwnd)
+
+    def on_ack(self, num_acked=1):
+        prev_size = self.size
+        for _ in range(num_acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1 # Slow start
+            else:
+                self.cwnd += 1 / self.cwnd # Additive increase
+        self.cwnd = min(self.cwnd, self.max_window)
+        self._record(prev_size)
+
+    def on_loss(self, seq, next_seq):
+        # seq timed out or was dropped, next_seq is the next seq to be sent.
+        # Packets already in flight were sent with the old window, 
+        # so their losses do not shrink the window again.
+        if seq < self.recover_until: return
+        prev_size = self.size
+        self.ssthresh = max(self.cwnd / 2, self.min_window)
+        self.cwnd = self.ssthresh # Multiplicative decrease
+        self.recover_until = next_seq
+        self._record(prev_size)
+
+    def _record(self, prev_size):
+        if self.size != prev_size:
+            self.trajectory.append((time.time() - self.start_time, self.size))
+
+    def mean_window(self)->float:
+        # Time weighted average of the window size
+        end = time.time() - self.start_time
+        points = self.trajectory + [(end, self.size)]
+        total = sum((t1 - t0) * w for (t0, w), (t1, _) in zip(points[:-1], points[1:]))
+        return total / end if end > 0 else float(self.size)
@@ -54,15 +54,17 @@ def run_and_retrieve_statistics(args, num_trials)-> dict:
         elapsed_secs = end - start
 
         print(f"Sending took {elapsed_secs:.2f} seconds.")
-        print(f"Sent {sender.session_covert_bits_len} covert bits.")
+        print(f"Sent {sender.session_data_bits_len} covert bits.")
         print("Covert Channel capacity: ")
         cap = sender.get_capacity() 
-        bps_cap = sender.session_covert_bits_len / elapsed_secs 
+        bps_cap = sender.session_data_bits_len / elapsed_secs # Goodput, FEC redundancy is not counted
         print(f"\t {bps_cap:.2f} covert bits per second.")
         print(f"\t {cap:.2f} covert bits per packet.")
         
         stats['capacity'].append(cap)
         stats['bps_capacity'].append(bps_cap)
+        if sender.auto_window:
+            stats.setdefault('mean_window', []).append(sender.get_session_stats()['mean_window'])
         print(f"[INFO] Trial {i+1}/{num_trials} - Capacity: {cap}")
     return stats
     #capacity = sender.get_capacity()
@@ -16,48 +16,99 @@ E.g. to send 3 bits of covert message, and fixed header is 8 bits, send: 0000 00
 # ------------------------------------------------------------------------------------------------
 
 import os
+import sys
 import time
 import random
 import socket
 import argparse
+import selectors
 import threading
 from threading import Thread
 from scapy.all import IP, UDP, Raw, send
 
+from raw_sender import RawUDPSender
+from reliability import RetransmissionScheduler, AckTracker, RTOEstimator, CongestionWindow, decode_ack
+from encoding import get_encoding
+from fec import get_fec
+from carrier import CarrierSource, FRAMING_HEADER_LEN
 from utils import assert_type
+from utils import FLAG_SINGLE_SESSION, session_id_flags
 from utils import random_string
 from utils import message_to_bits
-from utils import assign_sequence_number
-from utils import split_message_into_chunks
 from utils import save_session, save_session_csv
 
 class CovertSender:
     def __init__(self, verbose=False, 
                  window_size=5, timeout=5, max_udp_payload=1458, max_trans=3, 
-                 port=9999, dport=8888):        
+                 port=9999, dport=8888, backend="raw", batch=False, loop="event", adaptive_rto=False,
+                 auto_window=False, pacing=False, bits_per_packet=1, single_session=False,
+                 framing="ascii", fec=None, fec_depth=8):        
         
         self.state = "overt" # overt, covert
         self.PREAMBLE = "01010011"
         self.HEADER_LEN = 8       
         self.covert_bits_str = "" # Covert bits to be sent
-        self.session_covert_bits_len = 0
+        self.session_covert_bits_len = 0 # Bits sent covertly, FEC encoded
+        self.session_data_bits_len = 0 # Header + message bits (goodput), before FEC
+        self.session_covert_pkts_len = 0 # Packets needed to carry the covert bits
+        self.session_preamble_pkts = 0 # Packets carrying the preamble at the start of the session (single session)
+        # Single session: preamble, header and covert bits go out as one sequence numbered stream,
+        # instead of a preamble session followed by a covert session. Receiver must use the same mode.
+        self.single_session = single_session
         
         self.verbose = verbose
-        self.timeout = timeout
+        self.timeout = timeout # Fixed timeout, or the initial one if adaptive_rto is set
+        self.adaptive_rto = adaptive_rto
+        self.rto = RTOEstimator(initial_rto=timeout) # Measures RTT in any case, sets the timeout only if adaptive_rto
         self.max_payload = max_udp_payload
+        self.encoding = get_encoding(bits_per_packet) # How covert bits are carried, see encoding.py
+        self.session_encoding = self.encoding
+        # Forward error correction of the header + covert bits (see fec.py), receiver must use the same
+        self.fec = get_fec(fec, fec_depth)
         self.max_trans = max_trans
+        # Sequence number header of each packet: "ascii" [seq] or "binary" flags + 4-byte seq (see utils.py)
+        if framing not in FRAMING_HEADER_LEN:
+            raise ValueError(f"Unknown framing {framing}. Must be one of {list(FRAMING_HEADER_LEN)}.")
+        self.framing = framing
         
         self.port = port
         self.dport = dport
         self.recv_ip = self.get_host()
-        self.received_acks = {} # Store sequence numbers as well as their timestamps
+        self.received_acks = AckTracker() # ACKed / dropped state of each sequence number
+        self.retrans_scheduler = RetransmissionScheduler() # Retransmission deadlines of packets in flight
+        self.packet_timers = {} # Last send time of each packet of the session
+        self.packet_transmission_count = {}
+        self.carrier = None # CarrierSource of the session, packets are built as the window reaches them
         self.ack_sock = self.create_udp_socket('', self.port) # Socket dedicated to receive ACK
+        # SACK epochs (see reliability.py) seen in the current and the previous session,
+        # ACKs with an epoch of the previous session are late and ignored
+        self.session_ack_epochs, self.stale_ack_epochs = set(), set()
+        self.num_sessions = 0 # Sender sessions started, their number goes in the binary header (see utils.py)
+
+        # Send path: "raw" keeps a single raw socket open for the session, "scapy" builds and sends every packet with scapy
+        self.backend = backend
+        if backend == "raw":
+            self.raw_sender = RawUDPSender(self.recv_ip, self.dport, self.port, verbose=verbose)
+        elif backend == "scapy":
+            self.raw_sender = None
+        else:
+            raise ValueError(f"Unknown send backend {backend}. Must be 'raw' or 'scapy'.")
         
         self.ack_thread = None
         self.total_packets_sent = 0 # WARNING: Assumes packets are sent only until all covert bits are sent
         self.cur_pkt_idx = 0
         self.window_start = 0
         self.window_size = window_size
+        # Automatic window: AIMD between 1 and window_size packets, optionally paced over one RTT
+        self.auto_window = auto_window
+        self.max_window = window_size
+        self.cwnd = None
+        self.pacing = pacing
+        self.next_send_time = 0
+        self.batch = batch # Send whole window in one batch instead of a thread per packet
+        self.loop = loop # "event": single threaded selector loop, "threaded": ACK thread + polling loop
+        if loop not in ("event", "threaded"):
+            raise ValueError(f"Unknown sender loop {loop}. Must be 'event' or 'threaded'.")
         self.lock = threading.Lock()
         self.stop_event = threading.Event()
 
@@ -81,27 +132,25 @@ class CovertSender:
         #if self.ack_thread is not None:
         #    self.ack_thread.join() # Wait for the ACK thread to finish
         self.ack_sock.close()
+        if self.raw_sender is not None: self.raw_sender.close()
 
     def count_successful_transmissions(self):
         # Count the number of successful transmissions
-        # print("Received ACKs: ", self.received_acks)
-        num_success = 0
-        for _, timestamp in self.received_acks.items():
-            if timestamp != -1:
-                num_success += 1
-        return num_success
+        return self.received_acks.num_acked
     
     def get_capacity(self):
         # Calculate the capacity of the channel by number of bits 
         # sent successfully over the total number of packets sent
         
-        # WARNING: Since each packet carries 1 bit of covert message
-        # in this design, the maximum capacity is 1 bit per packet.
+        # WARNING: Each packet carries bits_per_packet bits of covert
+        # message (1 with the default checksum encoding, see encoding.py),
+        # which is the maximum capacity per packet. 
         # With that being said, the capacity is calculated by 
         # counting number of successful transmissions assuming
-        # each successful transmission carries 1 bit of covert message.
-        # If it wasn't this design choice, one could carry more bits
-        # per packet, then this capacity function would be obselete.
+        # each successful transmission carries bits_per_packet covert bits.
+
+        # In single session mode the preamble packets of the session carry 1 bit each
+        # (see _get_symbol), they are counted apart from the covert packets.
 
         # IMPORTANT WARNING: This function assumes that the receiver
         # is not sending any ACKs for the packets after the covert bits
@@ -111,56 +160,185 @@ class CovertSender:
             print("[WARNING] No packets sent yet. The capacity is returned 0.")
             return 0
         
-        capacity = n_success / n_total
+        n_preamble = sum(self.received_acks.is_acked(seq) for seq in range(self.session_preamble_pkts))
+        n_bits = n_preamble + (n_success - n_preamble) * self.session_encoding.bits_per_packet
+        capacity = n_bits / n_total
         if self.verbose: 
-            print(f"[DEBUG] Capacity: {capacity:.2%} ({n_success}/{n_total})")
+            print(f"[DEBUG] Capacity: {capacity:.2f} bits per packet ({n_bits} bits: {n_preamble} preamble "
+                  f"+ {n_success - n_preamble} covert packets, {n_total} packets)")
             print(f"[WARNING] This capacity assumes the packet wasn't delivered if ACK wasn't received within the timeout but in fact,\n \
                     ACK may come later than the timeout, so the capacity may be higher than this value. Check the receiver's covert message to verify.")
 
         return capacity
 
+    def get_session_stats(self)->dict:
+        # Statistics of the last session
+        stats = {
+            "packets_sent": self.total_packets_sent,
+            "acked": self.received_acks.num_acked,
+            "dropped": self.received_acks.num_dropped,
+            "srtt": self.rto.srtt,
+            "timeout": self.get_timeout(),
+            "window_size": self.window_size,
+        }
+        if self.auto_window and self.cwnd is not None:
+            stats["mean_window"] = self.cwnd.mean_window()
+            stats["window_trajectory"] = list(self.cwnd.trajectory)
+        return stats
+
     def _get_ACK(self, sleep_time=0.01):
         # Listen for ACKs until all the covert bits are sent
         # WARNING: This assumes the rest of the message is not ACKed
         # so some packets after the covert bits may be lost.
 
         # Wait until every packet is either ACKed or marked as dropped
-        while len(self.received_acks) < self.session_covert_bits_len and not self.stop_event.is_set():
+        while len(self.received_acks) < self.session_covert_pkts_len and not self.stop_event.is_set():
             data, addr = self.ack_sock.recvfrom(4096)
-            seq_num = int(data.decode())
             
-            # Save the ACK timestamp with sequence number as key
             with self.lock: # To avoid race conditions
-                if seq_num not in self.received_acks:
-                    if self.verbose: print(f"[ACK] ({data}) received from {addr}. Sequence number: {seq_num}")
-                    self.received_acks[seq_num] = time.time() # TODO: I assumed this could be useful for packet stats, but is it used?
-                else:
-                     if self.received_acks[seq_num] == -1:
-                        self.received_acks[seq_num] = time.time() # Mark dropped packet it as received
-
-                while self.window_start in self.received_acks: 
-                    self.window_start += 1 # Slide the window
-                    if self.verbose: print(f"[SLIDE] Window is slided to {self.window_start}.")
+                self._handle_ack(data, addr)
 
             time.sleep(sleep_time) # Sleep to let the other threads acquire the lock more easily
 
-    def _timeout_based_retransmissions(self, packet_transmission_count, packet_timers, msg_str_list):
-        for idx in range(self.window_start, self.cur_pkt_idx):
-            if idx not in self.received_acks:
-                if time.time() - packet_timers[idx] > self.timeout:
+    def _handle_ack(self, data, addr):
+        # Accepts both legacy (one seq) and SACK (cumulative + bitmap) ACKs.
+        # Only packets that are already sent can be ACKed.
+        epoch, cum, seqs = decode_ack(data)
+        if epoch is not None:
+            if epoch in self.stale_ack_epochs:
+                # Seqs start over every session, this ACK is about packets of the previous one
+                if self.verbose: print(f"[ACK] ({data}) of the previous session (epoch {epoch}) ignored.")
+                return
+            self.session_ack_epochs.add(epoch)
+        newly_acked = []
+        if cum is not None:
+            newly_acked.extend(self.received_acks.mark_acked_below(min(cum, self.cur_pkt_idx)))
+        for seq_num in seqs:
+            if seq_num < self.cur_pkt_idx and self.received_acks.mark_acked(seq_num): # Also marks a dropped packet as received
+                newly_acked.append(seq_num)
+        if self.verbose: print(f"[ACK] ({data}) received from {addr}. Newly ACKed sequence numbers: {newly_acked}")
+
+        for seq_num in newly_acked:
+            self.retrans_scheduler.cancel(seq_num)
+
+        self._update_rto(newly_acked)
+        if self.auto_window and newly_acked:
+            self.cwnd.on_ack(len(newly_acked))
+            self.window_size = self.cwnd.size
+        self._slide_window()
+
+    def _update_rto(self, newly_acked):
+        # One RTT sample per ACK, from the most recently sent packet it confirms.
+        # Retransmitted packets are skipped (Karn's algorithm).
+        send_times = [self.packet_timers[seq] for seq in newly_acked
+                      if self.packet_transmission_count.get(seq) == 1 and seq in self.packet_timers]
+        if send_times:
+            self.rto.add_sample(time.time() - max(send_times))
+            if self.verbose and self.adaptive_rto: print(f"[RTO] SRTT: {self.rto.srtt:.4f}s RTTVAR: {self.rto.rttvar:.4f}s RTO: {self.rto.get_rto():.4f}s")
+
+    def get_timeout(self)->float:
+        # Current retransmission timeout
+        return self.rto.get_rto() if self.adaptive_rto else self.timeout
+
+    def _slide_window(self):
+        while self.window_start in self.received_acks: 
+            self.window_start += 1 # Slide the window
+            if self.verbose: print(f"[SLIDE] Window is slided to {self.window_start}.")
+        if self.carrier is not None: self.carrier.release(self.window_start) # Not needed for retransmissions anymore
+
+    def _drain_acks(self):
+        # Read every ACK waiting in the (non-blocking) ACK socket
+        while True:
+            try:
+                data, addr = self.ack_sock.recvfrom(4096)
+            except BlockingIOError:
+                return
+            self._handle_ack(data, addr)
+
+    def _run_event_loop(self, carrier, wait_time):
+        # Single threaded sender engine. ACK reception, window sliding and 
+        # retransmission timers share one selector, so the loop sleeps until
+        # either an ACK arrives or the earliest timer expires (no busy-waiting).
+        # Ends when every covert packet is ACKed or dropped, or wait_time
+        # seconds after the last covert packet is sent (like the threaded engine).
+        packet_timers, packet_transmission_count = self.packet_timers, self.packet_transmission_count
+        n_packets = self.session_covert_pkts_len # Less if the carrier ends before
+
+        selector = selectors.DefaultSelector()
+        self.ack_sock.setblocking(False)
+        selector.register(self.ack_sock, selectors.EVENT_READ)
+        end_time = None
+        try:
+            while not self.stop_event.is_set():
+                # Retransmissions first, dropping a packet may slide the window
+                self._timeout_based_retransmissions(packet_transmission_count, packet_timers, carrier)
+
+                pacing_time = None
+                if self.cur_pkt_idx < n_packets and not carrier.has_packet(self.cur_pkt_idx):
+                    if self.verbose: print("[WARNING] Not all covert bits can be sent. Out of carrier message.")
+                    n_packets = self.cur_pkt_idx
+                if self.cur_pkt_idx < n_packets:
+                    budget = self._pacing_budget()
+                    if budget != 0:
+                        self._send_window_batch(packet_timers, packet_transmission_count, carrier, max_packets=budget)
+                    elif self.cur_pkt_idx < self.window_start + self.window_size:
+                        pacing_time = self.next_send_time # Window has room, wait for the pacer
+                elif end_time is None:
+                    if self.verbose: print(f"[DEBUG] All packets sent. Waiting at most {wait_time} seconds for ACKs...")
+                    end_time = time.time() + wait_time
+
+                if end_time is not None:
+                    if len(self.received_acks) >= n_packets or time.time() >= end_time:
+                        break
+
+                # Sleep until the next ACK or timer
+                wake_times = [t for t in (self.retrans_scheduler.next_deadline(), end_time, pacing_time) if t is not None]
+                select_timeout = max(0, min(wake_times) - time.time()) if wake_times else None
+                if selector.select(select_timeout):
+                    self._drain_acks()
+        finally:
+            selector.close()
+            self.ack_sock.setblocking(True)
+
+    def _discard_acks(self):
+        # Drop the ACKs waiting in the socket, they are about the previous session
+        while True:
+            try:
+                self.ack_sock.recvfrom(4096, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+
+    def _pacing_budget(self):
+        # Number of packets allowed to leave now, None if pacing is off.
+        # Paced windows are spread over one smoothed RTT (SRTT / window packets apart).
+        if not (self.pacing and self.auto_window) or self.rto.srtt is None:
+            return None
+        return 1 if time.time() >= self.next_send_time else 0
+
+    def _timeout_based_retransmissions(self, packet_transmission_count, packet_timers, carrier):
+        # Only the packets whose timer expired are visited (see RetransmissionScheduler)
+        expired = self.retrans_scheduler.pop_expired(time.time())
+        if expired:
+            self.rto.on_timeout() # Back off once per burst of timeouts, not per packet
+            if self.auto_window:
+                self.cwnd.on_loss(min(expired), self.cur_pkt_idx)
+                self.window_size = self.cwnd.size
+        for idx in expired:
+            if idx in self.received_acks: continue
                     
-                    if packet_transmission_count[idx] >= self.max_trans:
-                        if self.verbose: print(f"[TIMEOUT] Maximum transmission limit reached for packet {idx}. Dropping it.")
-                        assert not idx in self.received_acks, f"[ERROR] Packet {idx} should not be in received_acks."
-                        self.received_acks[idx] = -1 # Mark it as missing 
-                        if self.window_start == idx: self.window_start += 1 # Slide the window
-                        
-                    else:
-                        if self.verbose: print(f"[TIMEOUT] Packet {idx} timed out. Resending...")
-                        self._send_packet_with_covert(msg_str_list[idx], self.covert_bits_str[idx])
-                        self.total_packets_sent += 1
-                        packet_timers[idx] = time.time() # Reset the timer
-                        packet_transmission_count[idx] += 1 # Increment transmission count
+            if packet_transmission_count[idx] >= self.max_trans:
+                if self.verbose: print(f"[TIMEOUT] Maximum transmission limit reached for packet {idx}. Dropping it.")
+                self.received_acks.mark_dropped(idx) # Mark it as missing 
+                self._slide_window()
+                
+            else:
+                if self.verbose: print(f"[TIMEOUT] Packet {idx} timed out. Resending...")
+                bit = self._get_symbol(idx)
+                self._send_packet_with_covert(carrier[idx], bit)
+                self.total_packets_sent += 1
+                packet_timers[idx] = time.time() # Reset the timer
+                packet_transmission_count[idx] += 1 # Increment transmission count
+                self.retrans_scheduler.schedule(idx, packet_timers[idx] + self.get_timeout())
                                 
     def _create_ack_thread(self):
         self.ack_thread = threading.Thread(target=self._get_ACK, daemon=True)
@@ -168,20 +346,21 @@ class CovertSender:
         if self.verbose: print("[DEBUG] ACK thread started.")
 
     
-    def _send_packets_within_window(self, packet_timers, packet_transmission_count, msg_str_list):
+    def _send_packets_within_window(self, packet_timers, packet_transmission_count, carrier):
         threads = []
 
-        while self.cur_pkt_idx < self.window_start + self.window_size:
+        window_end = min(self.window_start + self.window_size, self.session_covert_pkts_len) # Nothing is sent past the last covert packet
+        while self.cur_pkt_idx < window_end:
             if self.verbose: print("Current bit index:", self.cur_pkt_idx)
 
-            if self.cur_pkt_idx >= len(msg_str_list):
+            if not carrier.has_packet(self.cur_pkt_idx):
                 if self.verbose: print("[INFO] No more overt packets to send.")
-                if self.cur_pkt_idx < self.session_covert_bits_len:
+                if self.cur_pkt_idx < self.session_covert_pkts_len:
                     if self.verbose: print("[WARNING] Not all covert bits can be sent. Out of carrier message.")
                 break
 
-            msg_str = msg_str_list[self.cur_pkt_idx]
-            bit = None if self.cur_pkt_idx >= self.session_covert_bits_len else self.covert_bits_str[self.cur_pkt_idx]
+            msg_str = carrier[self.cur_pkt_idx]
+            bit = self._get_symbol(self.cur_pkt_idx)
             
             # Prepare thread to send this packet
             t = Thread(target=self._send_and_track, args=(self.cur_pkt_idx, msg_str, bit, packet_timers, packet_transmission_count))
@@ -193,40 +372,119 @@ class CovertSender:
         for t in threads:
             t.join()  # Optional: Wait for all threads to finish
 
+    def _send_window_batch(self, packet_timers, packet_transmission_count, carrier, max_packets=None):
+        # Same as _send_packets_within_window but sends every eligible packet
+        # of the window (at most max_packets if given) as one batch from the calling thread
+        indices = []
+        window_end = min(self.window_start + self.window_size, self.session_covert_pkts_len) # Nothing is sent past the last covert packet
+        while self.cur_pkt_idx < window_end:
+            if max_packets is not None and len(indices) >= max_packets: break
+            if not carrier.has_packet(self.cur_pkt_idx):
+                if self.verbose: print("[INFO] No more overt packets to send.")
+                if self.cur_pkt_idx < self.session_covert_pkts_len:
+                    if self.verbose: print("[WARNING] Not all covert bits can be sent. Out of carrier message.")
+                break
+            indices.append(self.cur_pkt_idx)
+            self.cur_pkt_idx += 1
+
+        if not indices: return
+        bits = [self._get_symbol(idx) for idx in indices]
+        self._send_packets_batch([carrier[idx] for idx in indices], bits)
+
+        # Whole batch leaves at the same time
+        now = time.time()
+        packet_timers.update(dict.fromkeys(indices, now))
+        packet_transmission_count.update(dict.fromkeys(indices, 1))
+        for idx in indices:
+            self.retrans_scheduler.schedule(idx, now + self.get_timeout())
+        self.total_packets_sent += len(indices)
+        if self.pacing and self.rto.srtt is not None:
+            self.next_send_time = now + len(indices) * self.rto.srtt / max(self.window_size, 1)
+        if self.verbose: print(f"[DEBUG] Sent packets {indices[0]}-{indices[-1]} as a batch. Total packets sent: {self.total_packets_sent}")
+
     def _send_packet_with_covert(self, message, cov_bit=None, save_pkt=True):
         # Send packet using UDP with ACK
         # Returns 0 if message sent successfully
         # -1 if it cannot be delivered in max_resend trials.
+        # cov_bit is the covert symbol of the packet (bits_per_packet bits, see encoding.py),
+        # None when no covert bit is sent
+        payload = message.encode() if isinstance(message, str) else message
+        payload, with_checksum = self.session_encoding.encode(payload, cov_bit)
+        
+        if self.raw_sender is not None:
+            chksum = self.raw_sender.send(payload, with_checksum=with_checksum)
+            pkt = payload
+        else:
+            pkt, chksum = self._send_packet_with_scapy(payload, with_checksum, save_pkt)
+        if self.verbose: print(f"[DEBUG] Message sent to {self.recv_ip}:{self.dport}")
+
+        # Save packet cache for dataset creation
+        if save_pkt: self._save_pkt_data(payload, with_checksum, chksum)
+        return pkt
+
+    def _send_packets_batch(self, messages, cov_bits, save_pkt=True):
+        # Send a list of packets at once, cov_bits[i] is the covert symbol of messages[i]
+        # Raw backend hands the whole batch to sendmmsg, scapy sends the list over a single socket
+        payloads, checksum_flags = [], []
+        for message, cov_bit in zip(messages, cov_bits):
+            payload = message.encode() if isinstance(message, str) else message
+            payload, with_checksum = self.session_encoding.encode(payload, cov_bit)
+            payloads.append(payload)
+            checksum_flags.append(with_checksum)
+
+        if self.raw_sender is not None:
+            chksums = self.raw_sender.send_batch(payloads, checksum_flags)
+        else:
+            pkts = [self._build_scapy_packet(payload, with_checksum) for payload, with_checksum in zip(payloads, checksum_flags)]
+            send(pkts, verbose=False)
+            chksums = [IP(bytes(pkt))[UDP].chksum for pkt in pkts] if save_pkt else [None] * len(pkts)
+        if self.verbose: print(f"[DEBUG] {len(messages)} messages sent to {self.recv_ip}:{self.dport}")
+
+        if save_pkt:
+            for payload, with_checksum, chksum in zip(payloads, checksum_flags, chksums):
+                self._save_pkt_data(payload, with_checksum, chksum)
+
+    def _save_pkt_data(self, message, with_checksum, chksum):
+        if not with_checksum: assert chksum == 0, "[UNEXPECTED ERROR] Checksum must be 0"
+        pkt_dict = {
+            "timestamp": time.time(),
+            "checksum": chksum,
+            "payload": message.decode(errors="replace") if isinstance(message, (bytes, bytearray)) else str(message),
+            "length": len(message),
+            "is_covert": 1 if self.state=="covert" else 0  # ground truth
+            }
+        
+        self.outgoing_pkt_data.append(pkt_dict)
+
+    def _build_scapy_packet(self, message, with_checksum):
         ip = IP(dst=self.recv_ip)
         udp = UDP(dport=self.dport, sport=self.port)
-        # Covert bit as checksum field existence
-        if cov_bit == '1' or cov_bit == None: # None when no covrt bit is sent
+        if with_checksum:
             udp.chksum = None  # Let OS/scapy compute it
-        elif cov_bit == '0':
-            udp.chksum = 0  # Explicitly remove checksum
         else:
-            raise ValueError(f"Invalid covert bit. Must be '0' or '1'. Got: {cov_bit}")
-        
-        pkt = ip/udp/Raw(load=message)
+            udp.chksum = 0  # Explicitly remove checksum
+        return ip/udp/Raw(load=message)
+
+    def _send_packet_with_scapy(self, message, with_checksum, parse_chksum=True):
+        pkt = self._build_scapy_packet(message, with_checksum)
         send(pkt, verbose=False)
-        if self.verbose: print(f"[DEBUG] Message sent to {self.recv_ip}:{self.dport}")
 
-        # Save packet cache for dataset creation
-        if save_pkt:
+        chksum = None
+        if parse_chksum:
             tmp_pkt = IP(bytes(pkt))
             chksum =  tmp_pkt[UDP].chksum
-            if cov_bit == '0': assert chksum == 0, "[UNEXPECTED ERROR] Checksum must be 0"
-            pkt_dict = {
-                "timestamp": time.time(),
-                "checksum": chksum,
-                "payload": message.decode(errors="replace") if isinstance(message, bytes) else str(message),
-                "length": len(message),
-                "is_covert": 1 if self.state=="covert" else 0  # ground truth
-                }
-            
-            self.outgoing_pkt_data.append(pkt_dict)
-        return pkt
+        return pkt, chksum
             
+    def _get_symbol(self, idx):
+        # Covert bits carried by packet idx, None if it carries none.
+        # Last symbol is padded with zeros, receiver ignores bits after the message.
+        if idx >= self.session_covert_pkts_len: return None
+        k = self.session_encoding.bits_per_packet
+        if idx < self.session_preamble_pkts: # Preamble is 1 bit per packet, length class is left 0
+            return self.PREAMBLE[idx].ljust(k, '0')
+        idx -= self.session_preamble_pkts
+        return self.covert_bits_str[idx * k:(idx + 1) * k].ljust(k, '0')
+
     def _get_covert_bitstream(self, covert_msg_str, header_len)->str:
         # Given a covert message string and number of bits 
         # in the header, return string of bits to be sent covertly
@@ -243,6 +501,8 @@ class CovertSender:
         covert_len_bits_str_padded = covert_len_bits_str.zfill(self.HEADER_LEN) # Pad remaining bits with zeroes
         
         msg_bits_string = message_to_bits(covert_bytes)
+        if self.fec is not None: # Lost bits are rebuilt by the receiver, no retransmission needed
+            return self.fec.encode(covert_len_bits_str_padded + msg_bits_string)
         return covert_len_bits_str_padded + msg_bits_string
 
     def _send_and_track(self, idx, msg_str, bit, packet_timers, packet_transmission_count):
@@ -250,63 +510,108 @@ class CovertSender:
         self.total_packets_sent += 1
         packet_timers[idx] = time.time()
         packet_transmission_count[idx] = 1
+        self.retrans_scheduler.schedule(idx, packet_timers[idx] + self.get_timeout())
         if self.verbose:
             print("[DEBUG] Total packets sent:", self.total_packets_sent,
                 "[DEBUG] total received ACKs:", self.count_successful_transmissions())
 
+    def _run_threaded_loop(self, carrier, wait_time):
+        # Create a daemon to receive ACKs continuously
+        self._create_ack_thread()
+
+        # Send message packets
+        # WARNING: This assumes the rest of the message after all the
+        # covert bits are sent, can be dropped. (See get_ACK() Warning)
+        packet_timers, packet_transmission_count = self.packet_timers, self.packet_transmission_count
+        while self.cur_pkt_idx < self.session_covert_pkts_len: #len(encoded_msg_chunks):    
+            with self.lock: 
+                if not carrier.has_packet(self.cur_pkt_idx): break # Out of carrier message
+                if self.batch:
+                    self._send_window_batch(packet_timers, packet_transmission_count, carrier)
+                else:
+                    self._send_packets_within_window(packet_timers, packet_transmission_count, carrier)
+                self._timeout_based_retransmissions(packet_transmission_count, packet_timers, carrier)
+        # Done sending 
+        if self.verbose: print(f"[DEBUG] All packets sent. Waiting extra {wait_time} seconds for ACKs...")
+        time.sleep(wait_time) # Sleep for last ACKs to be received
+
     def send_preamble(self, carrier_msg, wait_time=1):
         covert_bitstream = self.PREAMBLE
         self.process_and_send_msg(carrier_msg, 
                                   covert_msg=covert_bitstream, 
                                   covert_bitstream = True,
-                                  wait_time=wait_time) 
+                                  wait_time=wait_time,
+                                  encoding=get_encoding(1)) # Receiver looks for the preamble 1 bit per packet
 
-    def process_and_send_msg(self, message, covert_msg="", wait_time=1, covert_bitstream=False):
+    def send_covert_stream(self, carrier_msg, covert_msg, wait_time=1):
+        # Single session: preamble followed by the header and covert bits, no gap in between
+        self.process_and_send_msg(carrier_msg, covert_msg=covert_msg, wait_time=wait_time, preamble=True)
+
+    def process_and_send_msg(self, message, covert_msg="", wait_time=1, covert_bitstream=False, encoding=None, preamble=False):
         # Set covert_bitstream=True if covert message itself is given as a string of bits
         # otherwise it is assumed covert message is a string of chars 
         # Sends a legitimate message 
         # The given message is split into chunks of size max_payload
         # and sent over UDP with the covert bits embedded in the checksum field.
+        # message is a str/bytes or a CarrierSource (file, generator or synthetic carrier),
+        # chunks are only read when the window reaches them (see carrier.py).
+        # Set preamble=True to send the preamble in the first packets of the same session.
 
         # top of process_and_send_msg
         self.cur_pkt_idx = 0
         self.window_start = 0
         self.received_acks.clear()
+        self.retrans_scheduler.clear()
+        self.packet_timers, self.packet_transmission_count = {}, {}
+        self._discard_acks()
+        self.stale_ack_epochs, self.session_ack_epochs = self.session_ack_epochs, set()
+        if self.auto_window:
+            self.cwnd = CongestionWindow(max_window=self.max_window)
+            self.window_size = self.cwnd.size
+
+        self.session_encoding = encoding if encoding is not None else self.encoding
+
+        # Room for the sequence number header in the beginning (8 bytes for "[seq]"),
+        # padding of the encoding must fit as well
+        chunk_size = self.max_payload - FRAMING_HEADER_LEN[self.framing] - self.session_encoding.max_padding
+        assert chunk_size > 0, f"[ERROR] UDP payload size {self.max_payload} is too small for {self.session_encoding.bits_per_packet} bits per packet."
+        flags = (FLAG_SINGLE_SESSION if preamble else 0) | session_id_flags(self.num_sessions)
+        self.num_sessions += 1
+        if isinstance(message, CarrierSource):
+            carrier = message
+            carrier.start_session(chunk_size, self.framing, flags) # Continue where the last session stopped
+        else:
+            carrier = CarrierSource(message, chunk_size, framing=self.framing)
+            carrier.flags = flags
+        self.carrier = carrier
+        num_packets = carrier.num_packets()
+        if self.verbose and num_packets is not None: print(f"[DEBUG] Message is splitted into {num_packets} packets.")
 
-        encoded_msg = message.encode() 
-        encoded_msg_chunks = split_message_into_chunks(encoded_msg, self.max_payload-8) # -8 is to be able to add sequence number in the beginning 
-        if self.verbose: print(f"[DEBUG] Message is splitted into {len(encoded_msg_chunks)} packets.")
-        assert len(encoded_msg_chunks) >= self.session_covert_bits_len, f"[ERROR] Number of packets are not enough for the number of covert bits {len(encoded_msg_chunks)} < {self.session_covert_bits_len}, please increase the carrier message length."
-
-        # Add sequence number to each chunk
-        msg_str_list = [assign_sequence_number(chunk.decode(), i) for i, chunk in enumerate(encoded_msg_chunks)]
-        
         if covert_bitstream:
             self.covert_bits_str = covert_msg
+            self.session_data_bits_len = len(covert_msg)
         else:
             self.covert_bits_str = self._get_covert_bitstream(covert_msg, self.HEADER_LEN)
+            self.session_data_bits_len = self.HEADER_LEN + 8 * len(covert_msg.encode())
         
         self.session_covert_bits_len = len(self.covert_bits_str)
+        k = self.session_encoding.bits_per_packet
+        self.session_preamble_pkts = len(self.PREAMBLE) if preamble else 0
+        self.session_covert_pkts_len = self.session_preamble_pkts + (self.session_covert_bits_len + k - 1) // k
+        if num_packets is not None: # Streamed carriers are only checked while sending
+            assert num_packets >= self.session_covert_pkts_len, f"[ERROR] Number of packets are not enough for the number of covert bits {num_packets} < {self.session_covert_pkts_len}, please increase the carrier message length."
         if self.verbose: print(f"[DEBUG] Covert bits string: {self.covert_bits_str}")
-        if self.verbose: print(f"[DEBUG] There are {self.session_covert_bits_len} bits to be sent covertly.")
+        if self.verbose: print(f"[DEBUG] There are {self.session_covert_bits_len} bits to be sent covertly in {self.session_covert_pkts_len} packets.")
 
-        # Create a daemon to receive ACKs continuously
         self.stop_event.clear()
-        self._create_ack_thread()
-
-        # Send message packets
-        # WARNING: This assumes the rest of the message after all the
-        # covert bits are sent, can be dropped. (See get_ACK() Warning)
-        packet_timers, packet_transmission_count = {}, {}
-        while self.cur_pkt_idx < self.session_covert_bits_len: #len(encoded_msg_chunks):    
-            with self.lock: 
-                self._send_packets_within_window(packet_timers, packet_transmission_count, msg_str_list)
-                self._timeout_based_retransmissions(packet_transmission_count, packet_timers, msg_str_list)
-        # Done sending 
-        if self.verbose: print(f"[DEBUG] All packets sent. Waiting extra {wait_time} seconds for ACKs...")
-        time.sleep(wait_time) # Sleep for last ACKs to be received
+        if self.loop == "event":
+            self._run_event_loop(carrier, wait_time)
+        else:
+            self._run_threaded_loop(carrier, wait_time)
     
         self.stop_event.set() # Tell ACK daemon to stop
+        self.carrier = None
+        carrier.release(self.cur_pkt_idx)
                                 
    
 
@@ -326,21 +631,60 @@ def run_sender(args, save_session_bool=False, **kwargs)->CovertSender:
     #     window_size : sliding window size
     #     udpsize : maximum UDP payload size
     #     trans : maximum number of transmissions
+    #     backend : packet send path, "raw" or "scapy"
+    #     batch : send the window as one batch instead of a thread per packet
+    #     loop : "event" (single threaded selector loop) or "threaded" (ACK thread)
+    #     adaptive_rto : adapt the timeout to the measured RTT, timeout is then the initial value
+    #     auto_window : AIMD window up to window_size, pacing : spread the window over one RTT
+    #     bits_per_packet : covert bits per packet, must match the receiver's
+    #     single_session : send preamble and covert message in one session, must match the receiver's
+    #     framing : sequence number header, "ascii" [seq] or "binary" (5 bytes, receiver detects it)
+    #     fec : forward error correction of the covert bits, None or "hamming", must match the receiver's
+    #     fec_depth : FEC interleaving depth in codewords, must match the receiver's
+
+    #     overt_file : read the carrier from this file ("-" for stdin) instead of overt
+    #     synthetic : endless synthetic carrier instead of overt
 
     # WARNING: If the length of the carrier message is too short
     # not all the covert bits will be sent. 
     carrier_msg = args.overt
     covert_msg =  args.covert
+    overt_file = kwargs.get('overt_file', getattr(args, 'overt_file', None))
+    synthetic = kwargs.get('synthetic', getattr(args, 'synthetic', False))
 
     verbose = kwargs.get('verbose', args.verbose)
     timeout = kwargs.get('timeout', args.timeout)
     window = kwargs.get('window_size', args.window)
     udpsize = kwargs.get('max_udp_payload', args.udpsize)
     trans = kwargs.get('max_transmissions', args.trans)
+    backend = kwargs.get('backend', args.backend)
+    batch = kwargs.get('batch', args.batch)
+    loop = kwargs.get('loop', args.loop)
+    adaptive_rto = kwargs.get('adaptive_rto', args.adaptive_rto)
+    auto_window = kwargs.get('auto_window', args.auto_window)
+    pacing = kwargs.get('pacing', args.pacing)
+    bits_per_packet = kwargs.get('bits_per_packet', args.bits)
+    single_session = kwargs.get('single_session', getattr(args, 'single_session', False))
+    framing = kwargs.get('framing', getattr(args, 'framing', "ascii"))
+    fec = kwargs.get('fec', getattr(args, 'fec', None))
+    fec_depth = kwargs.get('fec_depth', getattr(args, 'fec_depth', 8))
+    if fec == "none": fec = None
 
     sender = CovertSender(verbose=verbose, 
                           window_size=window, timeout=timeout, 
-                          max_udp_payload=udpsize, max_trans=trans)
+                          max_udp_payload=udpsize, max_trans=trans,
+                          backend=backend, batch=batch, loop=loop,
+                          adaptive_rto=adaptive_rto, auto_window=auto_window, pacing=pacing,
+                          bits_per_packet=bits_per_packet, single_session=single_session,
+                          framing=framing, fec=fec, fec_depth=fec_depth)
+
+    # Streamed carriers are read lazily and shared by the preamble and the covert message
+    carrier_file = None
+    if overt_file:
+        carrier_file = sys.stdin.buffer if overt_file == "-" else open(overt_file, "rb")
+        carrier_msg = CarrierSource(carrier_file)
+    elif synthetic:
+        carrier_msg = CarrierSource(None)
 
     try:
         prob_cov = args.probcov # Probability of sending covert message
@@ -349,11 +693,15 @@ def run_sender(args, save_session_bool=False, **kwargs)->CovertSender:
             mode = "covert"
             sender.state = mode
 
-            print(f"[INFO] Sending preamble first...")
-            sender.send_preamble(carrier_msg=carrier_msg, wait_time=1) # TODO: Why reuse carrier?
+            if single_session:
+                print(f"[INFO] Sending preamble and covert message in a single session...")
+                sender.send_covert_stream(carrier_msg, covert_msg, wait_time=args.senderwait)
+            else:
+                print(f"[INFO] Sending preamble first...")
+                sender.send_preamble(carrier_msg=carrier_msg, wait_time=1) # TODO: Why reuse carrier?
 
-            print(f"[INFO] Sending covert message...")
-            sender.process_and_send_msg(carrier_msg, covert_msg=covert_msg, wait_time=args.senderwait) 
+                print(f"[INFO] Sending covert message...")
+                sender.process_and_send_msg(carrier_msg, covert_msg=covert_msg, wait_time=args.senderwait) 
         else:
             mode = "overt"
             sender.state = mode
@@ -370,6 +718,12 @@ def run_sender(args, save_session_bool=False, **kwargs)->CovertSender:
                     "timeout": timeout,
                     "trans": trans,
                 }
+        if adaptive_rto: params["adaptive_rto"] = True # Keep the hash of earlier (fixed timeout) datasets unchanged
+        if auto_window: params["auto_window"] = True
+        if bits_per_packet != 1: params["bits_per_packet"] = bits_per_packet
+        if single_session: params["single_session"] = True
+        if framing != "ascii": params["framing"] = framing
+        if fec is not None: params["fec"], params["fec_depth"] = fec, fec_depth
         
         if save_session_bool:
             save_session(
@@ -385,6 +739,7 @@ def run_sender(args, save_session_bool=False, **kwargs)->CovertSender:
         print(f"[ERROR] An error occurred on the sender side: {e}")
     finally:
         sender.shutdown()
+        if carrier_file is not None and carrier_file is not sys.stdin.buffer: carrier_file.close()
         print("[INFO] Sending completed. Socket closed. Stop receiver process to see the message.")
     
     return sender
@@ -395,7 +750,7 @@ def get_args():
     # WARNING: Content of carrier message is assumed to be unimportant, i.e.
     # this sender will send packets until all covert bits are sent, ignoring
     # remaining carrier message packets after that point.
-    default_carrier_msg = "Hello, this is a long message. " * 200 # WARNING : Carrier must be much longer than covert message for now.
+    default_carrier_msg = "Hello, this is a long message. " * 200 # WARNING : Carrier must be much longer than covert message, or use --overt-file / --synthetic
     default_covert_msg =  "Covert."*3 #"This is a covert message."
     default_udp_payload = 20 # 1458 for a typical 1500 MTU Ethernet network but I use smaller for sending more packets.
     default_sender_wait = 1 # seconds before stopping ACK daemon
@@ -404,21 +759,37 @@ def get_args():
     default_max_transmissions = 1
     default_timeout = 0.5   # seconds
     default_covert_prob = 1 # Set 1 to always send covert
+    default_backend = "raw" # Persistent raw socket, use "scapy" for the original send path
+    default_loop = "event" # Use "threaded" for the ACK thread + polling loop
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", help="print intermediate steps", action="store_true", default=False)
     parser.add_argument("-c", "--covert", help="covert message to be sent", type=str, default=default_covert_msg, required=False)
     parser.add_argument("-o", "--overt", help="carrier message to be sent", type=str, default=default_carrier_msg, required=False)
+    parser.add_argument("-of", "--overt-file", help="read the carrier message from a file (- for stdin) as the window needs it, instead of --overt", type=str, default=None, required=False)
+    parser.add_argument("--synthetic", help="use an endless synthetic carrier instead of --overt", action="store_true", default=False)
     parser.add_argument("-s", "--udpsize", help=f"maximum UDP payload size, default {default_udp_payload}. use small value to send more covert bits.", type=int, default=default_udp_payload, required=False) 
     parser.add_argument("-sw", "--senderwait", help=f"sleep time before closing the communication, default {default_sender_wait}", type=int, default=default_sender_wait, required=False)
 
     parser.add_argument("-w", "--window", help=f"sliding window size, default {default_window_size}", type=int, default=default_window_size, required=False)
     parser.add_argument("-r", "--trans", help=f"maximum number of transmissions of the same packet, 1 to send packets only once, default {default_max_transmissions}", type=int, default=default_max_transmissions, required=False)
     parser.add_argument("-t", "--timeout", help=f"timeout in seconds, default {default_timeout}", type=float, default=default_timeout, required=False)
+    parser.add_argument("-b", "--backend", help=f"packet send path, default {default_backend}", type=str, choices=["raw", "scapy"], default=default_backend, required=False)
+    parser.add_argument("--batch", help="send all packets of the window in one batch (sendmmsg) instead of a thread per packet", action="store_true", default=False)
+    parser.add_argument("-l", "--loop", help=f"sender engine, default {default_loop}. event loop always sends the window in batches", type=str, choices=["event", "threaded"], default=default_loop, required=False)
+    parser.add_argument("--adaptive-rto", help="adapt the timeout to the measured RTT (SRTT + 4 RTTVAR with backoff), --timeout is then the initial timeout", action="store_true", default=False)
+    parser.add_argument("--auto-window", help="grow the window on ACKs and halve it on timeouts (AIMD), --window is then the maximum window", action="store_true", default=False)
+    parser.add_argument("--pacing", help="with --auto-window, spread the packets of a window over one RTT (event loop only)", action="store_true", default=False)
+    parser.add_argument("-k", "--bits", help="covert bits per packet, default 1 (checksum existence). k > 1 adds k-1 bits as payload length classes, receiver must use the same value", type=int, default=1, required=False)
+    parser.add_argument("--single-session", help="send the preamble and the covert message as one session (no gap, seq numbers continue), receiver must use the same mode", action="store_true", default=False)
+    parser.add_argument("-f", "--framing", help="sequence number header, ascii: '[seq]' (8 bytes kept), binary: flags + 4-byte seq (5 bytes). Default ascii", type=str, choices=["ascii", "binary"], default="ascii", required=False)
+    parser.add_argument("--fec", help="forward error correction of the covert bits, hamming: Hamming(7,4) codewords interleaved over --fec-depth codewords, lost bits are rebuilt without retransmission. Receiver must use the same. Default none", type=str, choices=["none", "hamming"], default="none", required=False)
+    parser.add_argument("--fec-depth", help="FEC interleaving depth in codewords, default 8", type=int, default=8, required=False)
     parser.add_argument("-p", "--probcov", help=f"probability of sending covert message between [0,1], default {default_covert_prob}", type=float, default=default_covert_prob, required=False)
 
     args = parser.parse_args()
     assert args.probcov >= 0 and args.probcov <= 1, f"Expected probability to be in range [0,1]. Got {args.probcov}."
+    assert args.bits >= 1, f"Expected at least 1 covert bit per packet. Got {args.bits}."
     return args
 
 # ------------------------------------------------------------------------------------------------
@@ -438,9 +809,14 @@ if __name__ == '__main__':
 
         elapsed_secs = end - start
         print(f"Sending took {elapsed_secs:.2f} seconds.")
-        print(f"Sent {sender.session_covert_bits_len} covert bits.")
+        print(f"Sent {sender.session_data_bits_len} covert bits.")
+        if sender.fec is not None:
+            print(f"\t {sender.session_covert_bits_len} bits with FEC.")
         print("Covert Channel capacity: ")
 
-        bps_capacity = sender.session_covert_bits_len / elapsed_secs 
+        bps_capacity = sender.session_data_bits_len / elapsed_secs # Goodput, FEC redundancy is not counted
         print(f"\t {bps_capacity:.2f} covert bits per second.")
         print(f"\t {sender.get_capacity():.2f} covert bits per packet.")
+        if sender.auto_window:
+            session_stats = sender.get_session_stats()
+            print(f"Window: mean {session_stats['mean_window']:.2f}, final {session_stats['window_size']}, trajectory {session_stats['window_trajectory']}")
@@ -0,0 +1,181 @@
+# Tests of the sender's reliability helpers
+#
+# ------------------------------------------------------------------------------------------------
+"""
+decode_ack (legacy and SACK ACKs), RetransmissionScheduler, AckTracker,
+RTOEstimator and CongestionWindow of reliability.py.
+
+    python3 -m pytest test_reliability.py
+"""
+# ------------------------------------------------------------------------------------------------
+
+import random
+import struct
+import threading
+
+import pytest
+
+from reliability import (decode_ack, RetransmissionScheduler, AckTracker, RTOEstimator, CongestionWindow,
+                         SACK_ACK_TYPE)
+
+def sack(epoch, cum, base, bitmap=b"")->bytes:
+    return SACK_ACK_TYPE + struct.pack('!BII', epoch, cum, base) + bitmap
+
+# decode_ack
+
+def test_decode_legacy_ack():
+    assert decode_ack(b"42") == (None, None, [42])
+
+def test_decode_sack():
+    assert decode_ack(sack(3, 10, 11)) == (3, 10, [])
+    assert decode_ack(sack(0, 1, 2, bytes([0b10100000]))) == (0, 1, [2, 4])
+    assert decode_ack(sack(255, 0, 100, bytes([0x01, 0x80]))) == (255, 0, [107, 108])
+
+def test_decode_sack_large_seqs():
+    assert decode_ack(sack(7, 2**32 - 2, 2**32 - 1, b"\x80")) == (7, 2**32 - 2, [2**32 - 1])
+
+# RetransmissionScheduler
+
+def test_scheduler_expired_in_order():
+    scheduler = RetransmissionScheduler()
+    for idx, deadline in ((0, 3.0), (1, 1.0), (2, 2.0)): scheduler.schedule(idx, deadline)
+    assert len(scheduler) == 3 and scheduler.next_deadline() == 1.0
+    assert scheduler.pop_expired(2.0) == [1, 2]
+    assert scheduler.pop_expired(2.5) == []
+    assert 0 in scheduler and 1 not in scheduler
+    assert scheduler.pop_expired(10) == [0]
+    assert scheduler.next_deadline() is None
+
+def test_scheduler_cancel_and_reschedule():
+    scheduler = RetransmissionScheduler()
+    scheduler.schedule(0, 1.0)
+    scheduler.schedule(1, 1.0)
+    assert scheduler.cancel(0) and not scheduler.cancel(0)
+    scheduler.schedule(1, 5.0) # The old deadline is stale
+    assert scheduler.next_deadline() == 5.0
+    assert scheduler.pop_expired(2.0) == []
+    assert scheduler.pop_expired(5.0) == [1]
+
+def test_scheduler_compacts_stale_entries():
+    scheduler = RetransmissionScheduler()
+    for i in range(1000): scheduler.schedule(0, float(i))
+    assert len(scheduler) == 1 and len(scheduler._heap) <= 2 * len(scheduler) + 65
+    assert scheduler.pop_expired(1e9) == [0]
+
+def test_scheduler_random_against_dict():
+    # Same results as a plain dict of deadlines
+    rng = random.Random(0)
+    scheduler, deadlines = RetransmissionScheduler(), {}
+    now = 0.0
+    for _ in range(5000):
+        op, idx = rng.random(), rng.randrange(50)
+        if op < 0.5:
+            deadlines[idx] = now + rng.random()
+            scheduler.schedule(idx, deadlines[idx])
+        elif op < 0.7:
+            assert scheduler.cancel(idx) == (deadlines.pop(idx, None) is not None)
+        else:
+            now += rng.random() / 4
+            expired = sorted(idx for idx, deadline in deadlines.items() if deadline <= now)
+            assert sorted(scheduler.pop_expired(now)) == expired
+            for idx in expired: del deadlines[idx]
+        assert scheduler.next_deadline() == (min(deadlines.values()) if deadlines else None)
+
+def test_scheduler_threads():
+    # Send threads schedule and cancel concurrently, every live deadline expires exactly once
+    scheduler = RetransmissionScheduler()
+    def worker(first):
+        for idx in range(first, first + 1000):
+            scheduler.schedule(idx, 1.0)
+            if idx % 2: scheduler.cancel(idx)
+    threads = [threading.Thread(target=worker, args=(i * 1000,)) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert sorted(scheduler.pop_expired(1.0)) == list(range(0, 8000, 2))
+
+# AckTracker
+
+def test_ack_tracker():
+    tracker = AckTracker()
+    assert tracker.mark_acked(2) and not tracker.mark_acked(2)
+    tracker.mark_dropped(3)
+    tracker.mark_dropped(2) # Already ACKed
+    assert len(tracker) == 2 and tracker.num_dropped == 1
+    assert tracker.mark_acked(3) # A dropped packet ACKed late
+    assert tracker.num_dropped == 0 and tracker.num_acked == 2
+    assert tracker.mark_acked_below(5) == [0, 1, 4]
+    assert tracker.mark_acked_below(3) == []
+    assert all(tracker.is_acked(seq) for seq in range(5)) and 5 not in tracker
+    assert not tracker.mark_acked(-1)
+    tracker.clear()
+    assert len(tracker) == 0 and not tracker.is_acked(0)
+
+# RTOEstimator
+
+def test_rto_first_sample():
+    rto = RTOEstimator(initial_rto=1.0)
+    assert rto.get_rto() == 1.0
+    rto.add_sample(0.1)
+    assert rto.srtt == 0.1 and rto.rttvar == 0.05
+    assert rto.get_rto() == pytest.approx(0.1 + 4 * 0.05)
+
+def test_rto_smoothing():
+    rto = RTOEstimator(min_rto=0)
+    rto.add_sample(0.1)
+    rto.add_sample(0.2)
+    assert rto.rttvar == pytest.approx(0.75 * 0.05 + 0.25 * 0.1)
+    assert rto.srtt == pytest.approx(0.875 * 0.1 + 0.125 * 0.2)
+    assert rto.get_rto() == pytest.approx(rto.srtt + 4 * rto.rttvar)
+    for _ in range(200): rto.add_sample(0.05)
+    assert rto.srtt == pytest.approx(0.05, rel=1e-3) # A constant RTT converges
+
+def test_rto_bounds():
+    rto = RTOEstimator(min_rto=0.01, max_rto=2.0)
+    for _ in range(50): rto.add_sample(1e-5)
+    assert rto.get_rto() == 0.01
+    rto.add_sample(100)
+    assert rto.get_rto() == 2.0
+
+def test_rto_backoff():
+    rto = RTOEstimator(initial_rto=0.1, max_rto=100, max_backoff=8)
+    for expected in (0.2, 0.4, 0.8, 0.8):
+        rto.on_timeout()
+        assert rto.get_rto() == pytest.approx(expected)
+    rto.add_sample(0.1) # A fresh sample ends the backoff
+    assert rto.backoff == 1
+
+# CongestionWindow
+
+def test_window_slow_start_and_additive_increase():
+    window = CongestionWindow(max_window=64, initial_window=1)
+    window.ssthresh = 8
+    window.on_ack(7)
+    assert window.size == 8 # +1 per ACK below ssthresh
+    window.on_ack(8)
+    assert 8.9 < window.cwnd < 9 # About +1 per window of ACKs above it
+    window.on_ack()
+    assert window.size == 9
+
+def test_window_max_and_min():
+    window = CongestionWindow(max_window=16, min_window=2, initial_window=32)
+    assert window.size == 16
+    window.on_ack(100)
+    assert window.size == 16
+    for seq in range(10): window.on_loss(seq, seq + 1)
+    assert window.size == 2
+
+def test_window_one_decrease_per_window():
+    window = CongestionWindow(max_window=64, initial_window=32)
+    window.on_loss(5, next_seq=40)
+    assert window.size == 16 and window.ssthresh == 16
+    window.on_loss(30, next_seq=41) # Sent before the decrease
+    assert window.size == 16
+    window.on_loss(40, next_seq=60)
+    assert window.size == 8
+
+def test_window_trajectory():
+    window = CongestionWindow(max_window=8, initial_window=1)
+    window.on_ack(3)
+    window.on_loss(0, 4)
+    assert [size for _, size in window.trajectory] == [1, 4, 2]
+    assert 1 <= window.mean_window() <= 8
@@ -7,6 +7,7 @@ import uuid
 import json
 import random
 import string
+import struct
 import hashlib
 
 def _get_unique_filepath(base_name="", filetype="csv",  seperator="", length=8, rootpath=None):
@@ -135,3 +136,37 @@ def assign_sequence_number(msg_str, seq_number)->str:
     msg_with_sequence = "[" + str(seq_number) + "]" + msg_str
     return msg_with_sequence
 
+# Binary framing: 1 flags byte + 4-byte big-endian sequence number in front of the payload
+# instead of "[<seq_number>]". Must be the same as in CovertReceiver.
+BINARY_HEADER = struct.Struct('!BI')
+BINARY_FRAMING_FLAG = 0x80 # Always set, ASCII headers start with '[' so the receiver can tell them apart
+FLAG_SINGLE_SESSION = 0x01 # Preamble and covert bits are in the same session
+# Number of the sender session mod 4, so the receiver tells a packet of the next session that
+# arrives before its seq 0 from a late packet of the previous session (seqs restart every session)
+SESSION_ID_SHIFT = 1
+SESSION_ID_MASK = 0x06
+
+def session_id_flags(session_number)->int:
+    return (session_number % 4) << SESSION_ID_SHIFT
+
+def binary_sequence_header(seq_number, flags=0)->bytes:
+    assert 0 <= seq_number < 2 ** 32, f"[ERROR] Sequence number {seq_number} does not fit in the binary header"
+    return BINARY_HEADER.pack(BINARY_FRAMING_FLAG | flags, seq_number)
+
+
+def ones_complement_sum(data, initial=0)->int:
+    # 16-bit one's complement sum of data, reduced modulo 0xFFFF.
+    # Since 2^16 = 1 (mod 0xFFFF), summing big-endian words is the same as
+    # taking the whole buffer as one big integer modulo 0xFFFF, which lets
+    # int.from_bytes do the work in C instead of a per-word Python loop.
+    # NOTE: 0 and 0xFFFF are the same value in this representation.
+    if len(data) % 2: data = bytes(data) + b'\x00'
+    return (initial + int.from_bytes(data, 'big')) % 0xFFFF
+
+def internet_checksum(data, initial=0)->int:
+    # RFC 1071 checksum of data, initial is a partial ones_complement_sum
+    # (e.g. of a pseudo header). A computed UDP checksum of 0 is sent as
+    # 0xFFFF (RFC 768) since 0 means "no checksum" on the wire.
+    s = ones_complement_sum(data, initial)
+    chksum = (~s) & 0xFFFF
+    return chksum if chksum != 0 else 0xFFFF
@@ -0,0 +1,164 @@
+# UDP checksum normalization of raw Ethernet frames
+#
+# ------------------------------------------------------------------------------------------------
+"""
+Checksum normalization
+------------------------
+The covert channel sends its bits in the presence of the UDP checksum
+(0 = no checksum, anything else = 1), so the mitigation of main.py makes every
+forwarded IPv4 UDP frame carry its correct checksum.
+
+The checksum is written into a copy of the frame without building scapy
+layers: only the IP addresses and the UDP header are read (see udp_offsets).
+The 16-bit one's complement sum of RFC 1071 is the value of the bytes as a
+big endian integer modulo 0xFFFF (2^16 = 1 mod 0xFFFF), so the sum of a whole
+datagram is a single int.from_bytes(), and the pseudo-header adds
+source + destination + protocol + UDP length to it. The checksum field itself
+is taken out of the sum by subtracting its old value.
+
+A computed checksum of 0 is sent as 0xFFFF (RFC 768), 0 means "no checksum".
+
+With verify=False only the frames without a checksum (the covert "0") are
+summed, a checksum that is already present is trusted and kept as it is.
+That is enough to close the channel since every frame then carries a checksum.
+
+udp_checksums() computes the checksums of many frames at once with NumPy
+(reduceat over the 16-bit words of all the frames), it falls back to one
+frame at a time when NumPy is not installed. main.py mitigates the frames
+released together by the delay line with normalize_batch().
+
+test_checksum.py checks the results against scapy's checksums:
+    python3 -m pytest test_checksum.py
+"""
+# ------------------------------------------------------------------------------------------------
+
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ETH_HEADER_LEN = 14
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88A8) # 802.1Q and 802.1ad tags, 4 bytes each
+IPPROTO_UDP = 17
+UDP_HEADER_LEN = 8
+UDP_CHECKSUM_OFFSET = 6 # From the start of the UDP header
+
+def ipv4_offset(data):
+    # Offset of the IPv4 header of an Ethernet frame (after any VLAN tags), None if it is not IPv4
+    view = memoryview(data)
+    if len(view) < ETH_HEADER_LEN: return None
+    offset = 12
+    ethertype = view[offset] << 8 | view[offset + 1]
+    while ethertype in ETHERTYPE_VLAN and len(view) >= offset + 6:
+        offset += 4
+        ethertype = view[offset] << 8 | view[offset + 1]
+    ip = offset + 2
+    if ethertype != ETHERTYPE_IPV4 or len(view) < ip + 20: return None
+    if view[ip] >> 4 != 4 or view[ip] & 0x0F < 5: return None
+    return ip
+
+def udp_offsets(data):
+    # (IP header offset, UDP header offset) of an IPv4 UDP frame, None for anything else
+    # (other EtherTypes and protocols, non-first fragments, truncated frames).
+    # Only the header fields needed for that are read, nothing is copied.
+    view = memoryview(data)
+    ip = ipv4_offset(view)
+    if ip is None or view[ip + 9] != IPPROTO_UDP: return None
+    if (view[ip + 6] & 0x1F) << 8 | view[ip + 7]: return None # Fragment offset != 0, no UDP header
+    udp = ip + (view[ip] & 0x0F) * 4
+    if len(view) < udp + UDP_HEADER_LEN: return None
+    return ip, udp
+
+def udp_length(view, udp)->int:
+    # Bytes of the UDP datagram (header + payload) in the frame, the Ethernet padding
+    # after it is not part of the checksum. Same as scapy when the length field is wrong.
+    udp_len = view[udp + 4] << 8 | view[udp + 5]
+    return min(max(udp_len, UDP_HEADER_LEN), len(view) - udp)
+
+def _fold(total)->int:
+    # Checksum of a one's complement sum given as any non negative int
+    total %= 0xFFFF
+    # total == 0 is a sum of 0xFFFF (the sum is never 0, the pseudo-header has protocol 17),
+    # whose checksum 0 is sent as 0xFFFF
+    return 0xFFFF - total if total else 0xFFFF
+
+def udp_checksum(data, offsets=None)->int:
+    # Correct UDP checksum of the IPv4 UDP frame data, its checksum field is ignored
+    view = memoryview(data)
+    ip, udp = offsets or udp_offsets(view)
+    length = udp_length(view, udp)
+    old_checksum = view[udp + UDP_CHECKSUM_OFFSET] << 8 | view[udp + UDP_CHECKSUM_OFFSET + 1]
+    total = int.from_bytes(view[udp:udp + length], 'big')
+    if length % 2: total <<= 8 # Odd length, padded with a zero byte
+    total -= old_checksum # Every aligned 16-bit word counts the same mod 0xFFFF, whatever its position
+    total += int.from_bytes(view[ip + 12:ip + 20], 'big') + IPPROTO_UDP + length
+    return _fold(total)
+
+def normalize_udp_checksum(data, offsets=None, verify=True)->bytes:
+    # Copy of the IPv4 UDP frame data with a correct UDP checksum. With verify=False a checksum
+    # that is already there is kept, only a missing one (0) is computed. data itself is not modified.
+    offsets = offsets or udp_offsets(data)
+    if offsets is None: return bytes(data)
+    field = offsets[1] + UDP_CHECKSUM_OFFSET
+    old_checksum = data[field] << 8 | data[field + 1]
+    if old_checksum and not verify: return bytes(data)
+    checksum = udp_checksum(data, offsets)
+    if checksum == old_checksum: return bytes(data)
+    frame = bytearray(data)
+    struct.pack_into('!H', frame, field, checksum)
+    return bytes(frame)
+
+def udp_checksums(frames, offsets=None)->list:
+    # Correct UDP checksums of many IPv4 UDP frames at once, None for frames that are not.
+    # The pseudo-header and datagram of every frame are copied into one buffer (checksum field
+    # zeroed, odd lengths padded) and summed per frame with np.add.reduceat.
+    if offsets is None: offsets = [udp_offsets(frame) for frame in frames]
+    if np is None:
+        return [udp_checksum(frame, off) if off is not None else None for frame, off in zip(frames, offsets)]
+
+    buf = bytearray()
+    starts = [] # Index of the first 16-bit word of every UDP frame in buf
+    for frame, off in zip(frames, offsets):
+        if off is None: continue
+        view = memoryview(frame)
+        ip, udp = off
+        length = udp_length(view, udp)
+        starts.append(len(buf) // 2)
+        buf += view[ip + 12:ip + 20]
+        buf += struct.pack('!HH', IPPROTO_UDP, length)
+        buf += view[udp:udp + UDP_CHECKSUM_OFFSET]
+        buf += b'\x00\x00'
+        buf += view[udp + UDP_HEADER_LEN:udp + length]
+        if length % 2: buf += b'\x00'
+    if not starts: return [None] * len(frames)
+
+    words = np.frombuffer(bytes(buf), dtype='>u2').astype(np.uint64)
+    totals = np.add.reduceat(words, starts) % 0xFFFF
+    checksums = np.where(totals == 0, 0xFFFF, 0xFFFF - totals).tolist()
+    it = iter(checksums)
+    return [next(it) if off is not None else None for off in offsets]
+
+def normalize_batch(frames, offsets=None, verify=True)->list:
+    # normalize_udp_checksum() of every frame, with the checksums computed by udp_checksums().
+    # offsets: udp_offsets() of every frame if already known (None for the frames that are not UDP)
+    if offsets is None: offsets = [udp_offsets(frame) for frame in frames]
+    old_checksums = [None] * len(frames)
+    todo = [None] * len(frames) # Offsets of the frames whose checksum is computed
+    for i, (frame, off) in enumerate(zip(frames, offsets)):
+        if off is None: continue
+        field = off[1] + UDP_CHECKSUM_OFFSET
+        old_checksums[i] = frame[field] << 8 | frame[field + 1]
+        if verify or not old_checksums[i]: todo[i] = off
+
+    normalized = []
+    for frame, off, old_checksum, checksum in zip(frames, todo, old_checksums, udp_checksums(frames, todo)):
+        if checksum is None or checksum == old_checksum:
+            normalized.append(bytes(frame))
+            continue
+        copy = bytearray(frame)
+        struct.pack_into('!H', copy, off[1] + UDP_CHECKSUM_OFFSET, checksum)
+        normalized.append(bytes(copy))
+    return normalized
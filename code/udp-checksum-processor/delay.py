@@ -0,0 +1,213 @@
+# Delay line of the processor
+#
+# ------------------------------------------------------------------------------------------------
+"""
+DelayLine Class
+-----------------
+Holds every packet for its injected delay and hands it to a release
+coroutine (the processor's mitigation and publish) when the delay is over.
+
+Instead of one asyncio.sleep() per packet, the packets are kept in a heap
+ordered by release time and a single timer (loop.call_at) is armed for the
+earliest one. When it fires, every due packet is moved to the ready queue of
+its key, then the timer is armed again for the next packet of the heap.
+Every key (the processor uses the input subject, one key per direction) has
+its own ready queue and release task, which releases its packets in order:
+a slow release (e.g. a flush) of one direction does not hold up the other.
+The release coroutine gets a list of the packets of a key that are due (at
+most max_batch), so it can handle them together: packets that become due
+while it runs make the next batch.
+
+Delays (seconds) are drawn from one of DISTRIBUTIONS:
+    uniform:     uniform in [0, 2 * mean_delay], the processor's former delay
+    exponential: exponential of mean mean_delay
+    fixed:       always mean_delay
+    trace:       the delays of a trace file, in order, starting over at its end
+A trace file has one delay per line ('#' starts a comment), record_path
+writes the delays that were drawn in the same format, so a run can be
+replayed with exactly the same delays.
+
+With fifo=True a packet is never released before the packets pushed before
+it (its release time is at least the previous one), otherwise packets with
+a shorter delay overtake the others.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import heapq
+import random
+import asyncio
+from collections import deque
+
+DISTRIBUTIONS = ("uniform", "exponential", "fixed", "trace")
+
+def load_trace(path)->list:
+    # Delays of a trace file, one per line in seconds
+    delays = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line: delays.append(float(line))
+    if not delays:
+        raise ValueError(f"Delay trace {path} has no delays.")
+    if min(delays) < 0:
+        raise ValueError(f"Delay trace {path} has negative delays.")
+    return delays
+
+class ReleaseQueue:
+    # Due items of one key of a DelayLine and the task releasing them
+    def __init__(self):
+        self.ready = deque()
+        self.num_releasing = 0 # Items of the batch being released
+        self.event = asyncio.Event() # Set when items are added to ready
+        self.task = None
+
+class DelayLine:
+    def __init__(self, release, mean_delay=1e-2, distribution="uniform", fifo=False, trace_path=None,
+                 record_path=None, seed=None, max_batch=256):
+        # release: coroutine function called with the list of items whose delay is over, in order
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown delay distribution {distribution}. Must be one of {list(DISTRIBUTIONS)}.")
+        if distribution == "trace" and trace_path is None:
+            raise ValueError("The trace delay distribution needs a trace file.")
+        assert mean_delay >= 0, f"[ERROR] Mean delay must not be negative, got {mean_delay}"
+        assert max_batch >= 1, f"[ERROR] max_batch must be at least 1, got {max_batch}"
+        self.release = release
+        self.mean_delay = mean_delay
+        self.distribution = distribution
+        self.fifo = fifo
+        self.max_batch = max_batch
+        self.rng = random.Random(seed)
+        self.trace = load_trace(trace_path) if distribution == "trace" else None
+        self.trace_index = 0
+        self.record_path = record_path
+        self.recorded = [] if record_path is not None else None
+
+        self.heap = [] # (release time, push number, key, item)
+        self.queues = {} # key -> ReleaseQueue of its due items
+        self.last_release_time = 0 # Latest release time pushed, for fifo
+        self.num_pushed = 0
+        self.num_released = 0
+        self.max_pending = 0
+        self.total_delay = 0
+
+        self._loop = None
+        self._timer = None # Handle of the call_at for the earliest item
+        self._timer_time = None
+        self._closing = False # close(drain=True) waits for the release tasks to release everything
+
+    def start(self):
+        # The release task of a key starts with its first due item
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+    def sample(self)->float:
+        # Next delay in seconds
+        if self.distribution == "uniform":
+            delay = self.rng.uniform(0, self.mean_delay * 2)
+        elif self.distribution == "exponential":
+            delay = self.rng.expovariate(1 / self.mean_delay) if self.mean_delay > 0 else 0
+        elif self.distribution == "fixed":
+            delay = self.mean_delay
+        else:
+            delay = self.trace[self.trace_index]
+            self.trace_index = (self.trace_index + 1) % len(self.trace)
+        if self.recorded is not None: self.recorded.append(delay)
+        return delay
+
+    def push(self, item, key=None):
+        # Schedule the release of item after the next delay, after the earlier items of key
+        delay = self.sample()
+        now = self._loop.time()
+        release_time = now + delay
+        if self.fifo: release_time = max(release_time, self.last_release_time)
+        self.last_release_time = max(self.last_release_time, release_time)
+        self.num_pushed += 1
+        self.total_delay += release_time - now
+
+        if release_time <= now and not self.heap:
+            # Nothing waiting that could be released first, skip the timer
+            self._make_ready(key, item)
+        else:
+            heapq.heappush(self.heap, (release_time, self.num_pushed, key, item))
+            if self._timer_time is None or release_time < self._timer_time:
+                self._arm_timer()
+        self.max_pending = max(self.max_pending, self.pending())
+
+    def _arm_timer(self):
+        # (Re)arm the single timer for the earliest item of the heap
+        if self._timer is not None: self._timer.cancel()
+        if not self.heap:
+            self._timer = self._timer_time = None
+            return
+        self._timer_time = self.heap[0][0]
+        self._timer = self._loop.call_at(self._timer_time, self._on_timer)
+
+    def _on_timer(self):
+        # Move every due item to the ready queue
+        self._timer = self._timer_time = None
+        now = self._loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, key, item = heapq.heappop(self.heap)
+            self._make_ready(key, item)
+        self._arm_timer()
+
+    def _make_ready(self, key, item):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = ReleaseQueue()
+            queue.task = self._loop.create_task(self._release_task(queue))
+        queue.ready.append(item)
+        queue.event.set()
+
+    async def _release_task(self, queue):
+        while not self._closing:
+            await queue.event.wait()
+            queue.event.clear()
+            await self._release_ready(queue)
+
+    async def _release_ready(self, queue):
+        # Release the ready items of queue in batches of at most max_batch, oldest first
+        while queue.ready:
+            batch = [queue.ready.popleft() for _ in range(min(len(queue.ready), self.max_batch))]
+            queue.num_releasing = len(batch)
+            try:
+                await self.release(batch)
+            finally:
+                queue.num_releasing = 0
+            self.num_released += len(batch)
+
+    def pending(self)->int:
+        # Items pushed and not released yet
+        return len(self.heap) + sum(len(queue.ready) + queue.num_releasing for queue in self.queues.values())
+
+    async def close(self, drain=True):
+        # With drain, release what is still waiting right away, then stop and write the recorded delays
+        if self._timer is not None: self._timer.cancel()
+        self._timer = self._timer_time = None
+        if drain:
+            while self.heap:
+                _, _, key, item = heapq.heappop(self.heap)
+                self._make_ready(key, item)
+        self._closing = True
+        for queue in self.queues.values():
+            if drain:
+                # Let the task finish the batch it is releasing (a cancel would lose or repeat it), then the rest
+                queue.event.set()
+                await queue.task
+                await self._release_ready(queue)
+            else:
+                queue.task.cancel()
+                try:
+                    await queue.task
+                except asyncio.CancelledError:
+                    pass
+        if self.recorded is not None:
+            with open(self.record_path, 'w') as f:
+                f.write(f"# {len(self.recorded)} delays in seconds, {self.distribution} distribution\n")
+                f.writelines(f"{delay!r}\n" for delay in self.recorded)
+
+    def print_stats(self):
+        mean = self.total_delay / self.num_pushed if self.num_pushed else 0
+        print(f"[INFO] Delay line: {self.num_pushed} packets delayed by {mean * 1e3:.3f} ms on average "
+              f"({self.distribution}{', fifo' if self.fifo else ''}), {self.num_released} released, "
+              f"at most {self.max_pending} waiting.")
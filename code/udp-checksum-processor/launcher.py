@@ -0,0 +1,104 @@
+# Multi-worker launcher of the UDP checksum processor
+#
+# ------------------------------------------------------------------------------------------------
+"""
+Starts N processor workers (main.py's run() in N processes, so they use N
+cores) and prints the sum of their stats when they stop.
+
+Frames are split over the workers in one of two ways:
+    queue: the workers join one NATS queue group, the server hands every
+           frame to one of them. Frames of one flow can go to different
+           workers and be reordered.
+    flow:  a dispatcher process (see sharding.py) republishes every frame to
+           the sub-subject of its flow's shard, worker i handles shard i, so
+           the frames of a flow stay on one worker and in order. The workers'
+           delay lines are always FIFO (--fifo) in this mode, otherwise a
+           shorter delay would let a frame overtake an earlier one of its flow.
+           A FIFO delay line also holds back the frames of the other flows of
+           the worker behind a long delay.
+
+Every option of main.py applies to all the workers, e.g.
+    python3 launcher.py -n 4 --sharding flow -m -P -d 0.001
+Ctrl+C stops the dispatcher and the workers.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import queue
+import signal
+import asyncio
+import multiprocessing
+
+import main
+from sharding import run_dispatcher
+
+MAX_STATS = ("max_pending",) # Stats aggregated with max instead of sum
+
+def run_worker(args, worker, stop_event, stats_queue):
+    # Ctrl+C goes to the whole process group, the launcher stops the workers through stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    options = main.run_options(args)
+    if args.sharding == "queue":
+        options["queue"] = args.queue or "udp-checksum-processor"
+    else:
+        options["shard"] = worker
+    if args.seed is not None:
+        options["delay_options"]["seed"] = args.seed + worker # Otherwise every worker draws the same delays
+    if args.delay_record is not None:
+        options["delay_options"]["record_path"] = f"{args.delay_record}.{worker}"
+    print(f"[INFO] Worker {worker} started ({args.sharding} sharding).")
+    stats = asyncio.run(main.run(**options, stop_event=stop_event))
+    stats_queue.put((worker, stats))
+
+def run_dispatcher_process(num_shards, stop_event):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_dispatcher(num_shards, stop_event))
+
+def aggregate_stats(worker_stats)->dict:
+    total = {}
+    for stats in worker_stats:
+        for name, value in stats.items():
+            total[name] = max(total.get(name, 0), value) if name in MAX_STATS else total.get(name, 0) + value
+    return total
+
+
+if __name__ == '__main__':
+
+    parser = main.get_parser()
+    parser.description = 'Run several processor workers.'
+    parser.add_argument('-n', '--workers', type=int, default=2, help='Number of worker processes. Default 2.')
+    parser.add_argument('--sharding', choices=["queue", "flow"], default="flow", help='queue: NATS queue group, flow: per flow shard subjects (frames of a flow stay on one worker and in order, turns on --fifo). Default flow.')
+    args = parser.parse_args()
+    if args.shard is not None:
+        parser.error("--shard is set by the launcher for each worker.")
+    if args.sharding == "flow" and args.queue is not None:
+        parser.error("--queue only applies to --sharding queue.")
+
+    stop_event = multiprocessing.Event()
+    stats_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_worker, args=(args, worker, stop_event, stats_queue))
+                 for worker in range(args.workers)]
+    if args.sharding == "flow":
+        processes.append(multiprocessing.Process(target=run_dispatcher_process, args=(args.workers, stop_event)))
+    for process in processes: process.start()
+
+    try:
+        for process in processes: process.join()
+    except KeyboardInterrupt:
+        print("[INFO] Stopping the workers...")
+        stop_event.set()
+
+    # Stats are read before joining, a process does not exit while its queue data is not consumed
+    worker_stats = {}
+    while len(worker_stats) < args.workers:
+        try:
+            worker, stats = stats_queue.get(timeout=1)
+            worker_stats[worker] = stats
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes[:args.workers]): break
+    for process in processes: process.join()
+
+    for worker in sorted(worker_stats):
+        print(f"[INFO] Worker {worker}: {worker_stats[worker]}")
+    missing = args.workers - len(worker_stats)
+    if missing: print(f"[WARNING] {missing} workers stopped without stats.")
+    print(f"[INFO] Total of {len(worker_stats)} workers: {aggregate_stats(worker_stats.values())}")
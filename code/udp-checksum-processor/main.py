@@ -1,73 +1,127 @@
 import os
-import random
 import asyncio
 import argparse 
 
-from scapy.all import Ether, IP, UDP, Raw
+from scapy.all import Ether
 from nats.aio.client import Client as NATS
 
+from checksum import udp_offsets, normalize_batch, UDP_CHECKSUM_OFFSET
+from publisher import PipelinedPublisher
+from delay import DelayLine, DISTRIBUTIONS
+from sharding import shard_subject
+
+LOG_LEVELS = {"warning": 0, "info": 1, "debug": 2}
+
 class UDP_Checksum_Processor:
-    def __init__(self, nc, topic_dict, mean_delay=1e-2, mitigate=False):
+    def __init__(self, nc, topic_dict, mean_delay=1e-2, mitigate=False, log_level="info", verify_checksums=True, publisher=None,
+                 delay_options=None, queue=None):
         self.nc = nc
         self.topic_dict = topic_dict
+        # NATS queue group of the subscriptions, every message goes to one processor of the group
+        self.queue = queue
+        # PipelinedPublisher, None to flush after every batch released by the delay line
+        self.publisher = publisher
         self.mean_delay = mean_delay
+        # Packets wait in the delay line before being mitigated and published, each direction (input
+        # subject) is released on its own. delay_options are its keyword arguments
+        # (distribution, fifo, trace_path, record_path, seed, max_batch, see delay.py)
+        self.delay_line = DelayLine(self.release, mean_delay, **(delay_options or {}))
         self.mitigate_bool = mitigate
+        # False: only add the missing checksums (covert "0"), keep the ones that are there
+        self.verify_checksums = verify_checksums
+        # warning: nothing per packet, info: mitigation summary, debug: packet dumps
+        if log_level not in LOG_LEVELS:
+            raise ValueError(f"Unknown log level {log_level}. Must be one of {list(LOG_LEVELS)}.")
+        self.log_level = LOG_LEVELS[log_level]
+        self.num_forwarded = 0 # Messages forwarded untouched (no mitigation or not UDP)
+        self.num_mitigated = 0 # UDP frames that went through mitigate()
+        self.num_corrected = 0 # UDP frames whose checksum was added or corrected
 
     async def subscribe(self):
+        self.delay_line.start()
         # Subscribe to inpktsec and inpktinsec topics
         subscriptions = [
-            self.nc.subscribe(topic, cb=self.message_handler)
+            self.nc.subscribe(topic, queue=self.queue or "", cb=self.message_handler)
             for topic in self.topic_dict.keys()
         ]
         await asyncio.gather(*subscriptions)
 
+    def get_stats(self)->dict:
+        stats = {"forwarded": self.num_forwarded, "mitigated": self.num_mitigated, "corrected": self.num_corrected,
+                 "delayed": self.delay_line.num_pushed, "released": self.delay_line.num_released,
+                 "max_pending": self.delay_line.max_pending}
+        if self.publisher is not None:
+            publisher_stats = self.publisher.get_stats()
+            for name in ("published", "flushes", "flush_errors", "backpressure_waits"):
+                stats[name] = publisher_stats[name]
+        return stats
+
+    async def release(self, items):
+        # Called by the delay line with the (subject, data, offsets) of the packets of a direction
+        # whose delay is over, the UDP frames among them are mitigated together
+        udp = [i for i, (_, _, offsets) in enumerate(items) if offsets is not None]
+        frames = [data for _, data, _ in items]
+        if udp:
+            mitigated = await self.mitigate([frames[i] for i in udp], [items[i][2] for i in udp])
+            for i, frame in zip(udp, mitigated): frames[i] = frame
+        for (subject, _, _), data in zip(items, frames):
+            await self.publish(subject, data)
+        if self.publisher is None:
+            # Sends a PING and wait for a PONG from the server, up to the given timeout.
+            # This gives guarantee that the server has processed the messages of the batch.
+            await self.nc.flush(timeout=1)
+
     async def publish(self, subject, data):
         # Publish the received message to outpktsec and outpktinsec
+        # Without a publisher, release() flushes once the whole batch is published
+        if self.publisher is not None:
+            # Flushed later together with other messages (see publisher.py)
+            await self.publisher.publish(self.topic_dict[subject], data)
+            return
         await self.nc.publish(self.topic_dict[subject], data)
-
-        # Sends a PING and wait for a PONG from the server, up to the given timeout.
-        # This gives guarantee that the server has processed above message.
-        await self.nc.flush(timeout=1)
        
-    async def mitigate(self, packet):
+    async def mitigate(self, frames, offsets=None)->list:
         # Mitigation strategy: Enforce checksum 
         # (i.e. always correct it, another strategy would be to always drop it, or corrupt)
-    
-        if UDP in packet:
-            ip_layer = packet[IP]
-            udp_layer = packet[UDP]
-            original_checksum = udp_layer.chksum
-
-            # Recompute checksum 
-            udp_layer.chksum = None
-            rebuilt_packet = Ether(bytes(packet))  
-            new_checksum = rebuilt_packet[UDP].chksum
-            print(f"[DEBUG] Original checksum: {original_checksum}")
-            print(f"[DEBUG] Recomputed checksum: {new_checksum}")
-
-            udp_layer.chksum = new_checksum
-            packet = Ether(bytes(packet))
-        return packet
+        # frames are IPv4 UDP frames (see udp_offsets), returns the frames to forward.
+        # The checksums are computed on the raw bytes, all the frames at once (see checksum.py),
+        # no scapy layers are built.
+        if offsets is None: offsets = [udp_offsets(data) for data in frames]
+        normalized = normalize_batch(frames, offsets, self.verify_checksums)
+        for data, off, new_data in zip(frames, offsets, normalized):
+            if new_data != data: self.num_corrected += 1
+            if self.log_level >= LOG_LEVELS["debug"]:
+                field = off[1] + UDP_CHECKSUM_OFFSET
+                print(f"[DEBUG] Original checksum: {int.from_bytes(data[field:field + 2], 'big')}")
+                print(f"[DEBUG] Recomputed checksum: {int.from_bytes(new_data[field:field + 2], 'big')}")
+        return normalized
 
     async def message_handler(self, msg):
         subject = msg.subject
         data = msg.data 
-        
-        packet = Ether(data)
-        print("[DEBUG] Original Packet:")
-        print(packet.show())
-
-        if self.mitigate_bool:
-            modified_packet = await self.mitigate(packet)
+        if self.log_level >= LOG_LEVELS["debug"]:
+            print("[DEBUG] Original Packet:")
+            Ether(data).show()
+
+        # Fast path: without mitigation (or for frames that are not IPv4 UDP)
+        # the message is forwarded as it is, without being parsed
+        offsets = udp_offsets(data) if self.mitigate_bool else None
+        if offsets is not None:
+            self.num_mitigated += 1
         else:
-            modified_packet = packet
+            self.num_forwarded += 1
 
-        delay = random.uniform(0, self.mean_delay * 2)
-        await asyncio.sleep(delay)
-        await self.publish(subject, bytes(modified_packet)) 
+        # Mitigated with the other frames released at the same time and published
+        # by the delay line once its delay is over
+        self.delay_line.push((subject, data, offsets), key=subject)
 
 
-async def run(mean_delay=0, mitigate=False):
+async def run(mean_delay=0, mitigate=False, log_level="info", verify_checksums=True, pipeline=None, delay_options=None,
+              queue=None, shard=None, stop_event=None)->dict:
+    # pipeline: PipelinedPublisher keyword arguments, None to flush after every released batch
+    # delay_options: DelayLine keyword arguments
+    # queue: NATS queue group to join, shard: only handle the frames of this flow shard (see sharding.py)
+    # stop_event: runs until it is set (e.g. a multiprocessing.Event of launcher.py), or Ctrl+C
     nc = NATS()
 
     nats_url = os.getenv("NATS_SURVEYOR_SERVERS", "nats://nats:4222")
@@ -77,28 +131,78 @@ async def run(mean_delay=0, mitigate=False):
                     "inpktsec" : "outpktinsec",
                     "inpktinsec" : "outpktsec"
     }
-
-    processor = UDP_Checksum_Processor(nc, topic_dict, mean_delay, mitigate)
+    if shard is not None:
+        topic_dict = {shard_subject(topic, shard): out_topic for topic, out_topic in topic_dict.items()}
+        # Flow sharding keeps the frames of a flow on this worker to keep their order,
+        # the delay line must not reorder them either
+        delay_options = dict(delay_options or {}, fifo=True)
+
+    publisher = None
+    if pipeline is not None:
+        publisher = PipelinedPublisher(nc, verbose=log_level != "warning", **pipeline)
+        publisher.start()
+    processor = UDP_Checksum_Processor(nc, topic_dict, mean_delay, mitigate, log_level, verify_checksums, publisher,
+                                       delay_options, queue)
     await processor.subscribe()
 
     try:
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
+        while stop_event is None or not stop_event.is_set():
+            await asyncio.sleep(0.5)
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print("Disconnecting...")
+    finally:
+        await processor.delay_line.close() # The frames still waiting are mitigated while draining
+        print(f"[INFO] {processor.num_forwarded} messages forwarded untouched, {processor.num_mitigated} mitigated ({processor.num_corrected} checksums corrected).")
+        processor.delay_line.print_stats()
+        if publisher is not None:
+            await publisher.close()
+            publisher.print_stats()
         await nc.close()
+    return processor.get_stats()
 
+def get_parser():
+    # Processor options, launcher.py adds its own
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-d', '--delay', type=float, default=1e-2, help='Specify the average delay to be added before sending packets in seconds.')
+    parser.add_argument('--delay-dist', help='Distribution of the delays, trace replays the delays of --delay-trace. Default uniform in [0, 2 * delay].', choices=list(DISTRIBUTIONS), default="uniform")
+    parser.add_argument('--delay-trace', type=str, default=None, help='File of delays in seconds, one per line, for --delay-dist trace.')
+    parser.add_argument('--delay-record', type=str, default=None, help='Write the delays that were used to this file (format of --delay-trace).')
+    parser.add_argument('--fifo', help='Keep the packet order, a packet is never released before an earlier one. Always on with --shard. Default False.', action="store_true", default=False)
+    parser.add_argument('--release-batch', type=int, default=256, help='With -m, at most this many frames released together by the delay line are mitigated at once. Default 256.')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed of the delays.')
+    parser.add_argument('-m', '--mitigate', help='Run covert channel mitigation strategy. Default False.', action="store_true", default=False)
+    parser.add_argument('--keep-checksums', help='With -m, only add the missing UDP checksums and keep the ones already there without verifying them. Default False.', action="store_true", default=False)
+    parser.add_argument('-P', '--pipeline', help='Do not flush after every batch of released messages, flush periodically or when enough messages are waiting. Default False.', action="store_true", default=False)
+    parser.add_argument('--max-in-flight', type=int, default=1024, help='With -P, maximum number of published messages waiting for a flush. Default 1024.')
+    parser.add_argument('--flush-interval', type=float, default=5, help='With -P, maximum time a message waits for a flush in ms. Default 5.')
+    parser.add_argument('--flush-count', type=int, default=256, help='With -P, flush when this many messages are waiting. Default 256.')
+    parser.add_argument('--flush-bytes', type=int, default=1024 * 1024, help='With -P, flush when this many bytes are waiting. Default 1 MiB.')
+    parser.add_argument('-q', '--queue', type=str, default=None, help='Join this NATS queue group, every frame is handled by one processor of the group (no flow affinity).')
+    parser.add_argument('--shard', type=int, default=None, help='Only handle the frames of this flow shard, published by the dispatcher of sharding.py. Turns on --fifo.')
+    parser.add_argument('-l', '--log-level', help='warning: no per packet output, info: default, debug: dump every packet.', choices=list(LOG_LEVELS), default="info")
+    return parser
+
+def run_options(args)->dict:
+    # Keyword arguments of run() from the parsed command line
+    pipeline = None
+    if args.pipeline:
+        pipeline = {"max_in_flight": args.max_in_flight, "flush_interval": args.flush_interval / 1e3,
+                    "flush_count": min(args.flush_count, args.max_in_flight), "flush_bytes": args.flush_bytes}
+
+    delay_options = {"distribution": args.delay_dist, "fifo": args.fifo, "trace_path": args.delay_trace,
+                     "record_path": args.delay_record, "seed": args.seed, "max_batch": args.release_batch}
+
+    return {"mean_delay": args.delay, "mitigate": args.mitigate, "log_level": args.log_level,
+            "verify_checksums": not args.keep_checksums, "pipeline": pipeline, "delay_options": delay_options,
+            "queue": args.queue, "shard": args.shard}
 
 
 if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser(description='')
-    parser.add_argument('-d', '--delay', type=float, default=1e-2, help='Specify the average delay to be added before sending packets in seconds.')
-    parser.add_argument('-m', '--mitigate', help='Run covert channel mitigation strategy. Default False.', action="store_true", default=False)
+    args = get_parser().parse_args()
 
-    args = parser.parse_args()
-    
     print("Running processor with delay ", args.delay)
-    asyncio.run(run(args.delay, args.mitigate))
-
- 
\ No newline at end of file
+    try:
+        asyncio.run(run(**run_options(args)))
+    except KeyboardInterrupt:
+        pass
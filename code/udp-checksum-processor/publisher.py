@@ -0,0 +1,153 @@
+# Pipelined NATS publishing
+#
+# ------------------------------------------------------------------------------------------------
+"""
+PipelinedPublisher Class
+--------------------------
+Publishes the processed packets without waiting for a flush (PING/PONG
+round-trip to the NATS server) after every message.
+
+nc.publish() only appends the message to the client's pending buffer, a
+single flusher task calls nc.flush() for all the messages published since
+the last flush when one of these happens:
+    - flush_count messages or flush_bytes bytes are waiting,
+    - flush_interval seconds passed since the first of them was published.
+When the flush returns, the server has processed all of them.
+
+At most max_in_flight messages may be published and not flushed yet, above
+that publish() waits for the running flush (back-pressure), so a slow server
+slows the processor down instead of filling the client's buffer.
+
+Metrics (see get_stats): flush latency (time of nc.flush) and back-pressure
+latency (time publish() waited for a flush), over the last
+latency_samples of each.
+"""
+# ------------------------------------------------------------------------------------------------
+
+import time
+import asyncio
+from collections import deque
+
+def _percentiles(samples, percents=(50, 90, 99))->dict:
+    # Percentiles of samples in ms (nearest rank), plus the max
+    if not samples: return {}
+    ordered = sorted(samples)
+    stats = {f"p{p}": ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1e3 for p in percents}
+    stats["max"] = ordered[-1] * 1e3
+    return stats
+
+class PipelinedPublisher:
+    def __init__(self, nc, max_in_flight=1024, flush_interval=5e-3, flush_count=256, flush_bytes=1024 * 1024,
+                 flush_timeout=1, latency_samples=10000, verbose=False):
+        assert max_in_flight >= 1, f"[ERROR] max_in_flight must be at least 1, got {max_in_flight}"
+        assert 1 <= flush_count <= max_in_flight, f"[ERROR] flush_count must be in [1, max_in_flight], got {flush_count}"
+        self.nc = nc
+        self.max_in_flight = max_in_flight
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        self.flush_bytes = flush_bytes
+        self.flush_timeout = flush_timeout
+        self.verbose = verbose
+
+        self.in_flight = 0 # Published, not flushed yet
+        self.pending_bytes = 0
+        self.first_pending_time = None # Publish time of the oldest message waiting for a flush
+        self._flush_needed = asyncio.Event() # Count or byte threshold reached
+        self._has_pending = asyncio.Event() # A message waits for a flush, wakes up the idle flusher
+        self._flushed = asyncio.Condition() # Notified after every flush
+        self._task = None
+
+        self.num_published = 0
+        self.num_flushes = 0
+        self.num_flush_errors = 0
+        self.num_waits = 0 # publish() calls that hit max_in_flight
+        self.flush_latencies = deque(maxlen=latency_samples)
+        self.wait_latencies = deque(maxlen=latency_samples)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._flusher())
+
+    async def publish(self, subject, data):
+        if self.in_flight >= self.max_in_flight:
+            start = time.perf_counter()
+            self.num_waits += 1
+            self._flush_needed.set()
+            async with self._flushed:
+                await self._flushed.wait_for(lambda: self.in_flight < self.max_in_flight)
+            self.wait_latencies.append(time.perf_counter() - start)
+
+        await self.nc.publish(subject, data)
+        self.num_published += 1
+        self.in_flight += 1
+        self.pending_bytes += len(data)
+        if self.first_pending_time is None:
+            self.first_pending_time = time.monotonic()
+            self._has_pending.set()
+        if self.in_flight >= self.flush_count or self.pending_bytes >= self.flush_bytes:
+            self._flush_needed.set()
+
+    async def _flusher(self):
+        # Single task doing every flush, so there is never more than one PING waiting for its PONG
+        while True:
+            if self.first_pending_time is None:
+                # Nothing to flush, sleep until the next publish() instead of waking every flush_interval
+                self._has_pending.clear()
+                await self._has_pending.wait()
+            timeout = self.first_pending_time + self.flush_interval - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._flush_needed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self._flush_needed.clear()
+            if self.in_flight: await self._flush()
+
+    async def _flush(self):
+        # Flush the messages published so far, the ones published during the flush wait for the next one
+        flushed = self.in_flight
+        self.pending_bytes = 0
+        self.first_pending_time = None
+        start = time.perf_counter()
+        try:
+            await self.nc.flush(timeout=self.flush_timeout)
+            self.flush_latencies.append(time.perf_counter() - start)
+        except Exception as e: # Timeout or lost connection, the messages are given up on
+            self.num_flush_errors += 1
+            if self.verbose: print(f"[WARNING] Flush of {flushed} messages failed: {e!r}")
+        self.num_flushes += 1
+        self.in_flight -= flushed
+        if self.in_flight and self.first_pending_time is None: self.first_pending_time = time.monotonic()
+        async with self._flushed:
+            self._flushed.notify_all()
+
+    async def close(self):
+        # Stop the flusher and flush what is left
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.in_flight: await self._flush()
+
+    def get_stats(self)->dict:
+        return {
+            "published": self.num_published,
+            "flushes": self.num_flushes,
+            "flush_errors": self.num_flush_errors,
+            "messages_per_flush": self.num_published / self.num_flushes if self.num_flushes else 0,
+            "backpressure_waits": self.num_waits,
+            "flush_latency_ms": _percentiles(self.flush_latencies),
+            "backpressure_latency_ms": _percentiles(self.wait_latencies),
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"[INFO] {stats['published']} messages published in {stats['flushes']} flushes "
+              f"({stats['messages_per_flush']:.1f} per flush, {stats['flush_errors']} failed), "
+              f"{stats['backpressure_waits']} waits for back-pressure.")
+        for name in ("flush_latency_ms", "backpressure_latency_ms"):
+            if stats[name]:
+                print(f"[INFO] {name}: " + ", ".join(f"{k} {v:.3f}" for k, v in stats[name].items()))
@@ -0,0 +1,117 @@
+# Flow sharding of the processor over several workers
+#
+# ------------------------------------------------------------------------------------------------
+"""
+FlowDispatcher Class
+----------------------
+The mitm switch publishes every frame to inpktsec or inpktinsec. With
+several processor workers, each frame must be handled by exactly one of them,
+and the frames of one flow by the same one, so their order is kept.
+
+NATS queue groups do the first part (the server hands every message to one
+member of the group) but pick the member per message, so a flow is spread
+over all the workers. The dispatcher does the second: it subscribes to the
+switch's subjects and republishes every frame to the sub-subject of its flow's
+shard, <subject>.<shard> (e.g. inpktsec.2). Worker i subscribes to the
+inpkt*.<i> subjects only (see main.py --shard), with a FIFO delay line so the
+delays do not reorder the frames of a flow either.
+
+The shard of a frame is the CRC32 of its 5-tuple (IP addresses, protocol and
+TCP/UDP ports), with the two endpoints sorted so both directions of a flow
+go to the same worker. IP fragments and other protocols are hashed on the
+addresses and protocol only, frames that are not IPv4 go to shard 0.
+
+Run the dispatcher next to the workers (launcher.py starts it):
+    python3 sharding.py -n 4
+"""
+# ------------------------------------------------------------------------------------------------
+
+import os
+import zlib
+import struct
+import asyncio
+import argparse
+
+from checksum import ipv4_offset
+
+PORT_PROTOCOLS = (6, 17, 132) # TCP, UDP, SCTP, ports are the first 4 bytes of their header
+TOPICS = ("inpktsec", "inpktinsec")
+
+def flow_key(data):
+    # Direction independent 5-tuple of an IPv4 frame as bytes, None if it is not IPv4
+    view = memoryview(data)
+    ip = ipv4_offset(view)
+    if ip is None: return None
+    proto = view[ip + 9]
+    src, dst = bytes(view[ip + 12:ip + 16]), bytes(view[ip + 16:ip + 20])
+    sport = dport = 0
+    l4 = ip + (view[ip] & 0x0F) * 4
+    fragmented = (view[ip + 6] & 0x3F) << 8 | view[ip + 7] # More fragments flag or fragment offset
+    if proto in PORT_PROTOCOLS and not fragmented and len(view) >= l4 + 4:
+        sport, dport = struct.unpack_from('!HH', view, l4)
+    (addr_a, port_a), (addr_b, port_b) = sorted(((src, sport), (dst, dport)))
+    return addr_a + addr_b + struct.pack('!BHH', proto, port_a, port_b)
+
+def flow_shard(data, num_shards)->int:
+    # Shard of the flow of a frame, the same in every process (unlike hash())
+    key = flow_key(data)
+    return zlib.crc32(key) % num_shards if key is not None else 0
+
+def shard_subject(subject, shard)->str:
+    return f"{subject}.{shard}"
+
+class FlowDispatcher:
+    def __init__(self, nc, num_shards, topics=TOPICS, verbose=False):
+        assert num_shards >= 1, f"[ERROR] Number of shards must be at least 1, got {num_shards}"
+        self.nc = nc
+        self.num_shards = num_shards
+        self.topics = topics
+        self.verbose = verbose
+        self.num_dispatched = [0] * num_shards
+
+    async def subscribe(self):
+        for topic in self.topics:
+            await self.nc.subscribe(topic, cb=self.message_handler)
+        if self.verbose: print(f"[INFO] Dispatching {list(self.topics)} over {self.num_shards} shards")
+
+    async def message_handler(self, msg):
+        # No flush: the client writes its pending messages in the background, in publish order
+        shard = flow_shard(msg.data, self.num_shards)
+        self.num_dispatched[shard] += 1
+        await self.nc.publish(shard_subject(msg.subject, shard), msg.data)
+
+    def print_stats(self):
+        total = sum(self.num_dispatched)
+        print(f"[INFO] Dispatcher: {total} frames, per shard: {self.num_dispatched}")
+
+
+async def run_dispatcher(num_shards, stop_event=None, verbose=True):
+    from nats.aio.client import Client as NATS
+
+    nc = NATS()
+    nats_url = os.getenv("NATS_SURVEYOR_SERVERS", "nats://nats:4222")
+    await nc.connect(nats_url)
+
+    dispatcher = FlowDispatcher(nc, num_shards, verbose=verbose)
+    await dispatcher.subscribe()
+    try:
+        while stop_event is None or not stop_event.is_set():
+            await asyncio.sleep(0.5)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("Disconnecting...")
+    finally:
+        dispatcher.print_stats()
+        await nc.drain() # Delivers what was published before closing
+    return dispatcher.num_dispatched
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Republish the frames of the mitm switch to per flow shard subjects.')
+    parser.add_argument('-n', '--num-shards', type=int, default=2, help='Number of shards (processor workers). Default 2.')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_dispatcher(args.num_shards))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,155 @@
+# Tests of the UDP checksum normalization against scapy
+#
+# ------------------------------------------------------------------------------------------------
+"""
+Every frame must come out of normalize_udp_checksum() exactly as scapy
+rebuilds it with its UDP checksum recomputed (the mitigation before
+checksum.py). Random frames cover odd/even payloads, VLAN tags, Ethernet
+padding, missing/wrong/correct checksums and non UDP frames. The batch path
+(udp_checksums/normalize_batch) must give the same results as the scalar
+one, with NumPy and without it.
+
+    python3 -m pytest test_checksum.py
+"""
+# ------------------------------------------------------------------------------------------------
+
+import random
+import struct
+
+import pytest
+from scapy.all import Ether, Dot1Q, IP, UDP, TCP, Raw
+
+import checksum
+from checksum import (udp_offsets, udp_length, udp_checksum, udp_checksums, normalize_udp_checksum, normalize_batch,
+                      UDP_CHECKSUM_OFFSET)
+
+NUM_FRAMES = 500
+
+def random_frame(rng, checksum="random", payload_len=None, vlan=None, proto=UDP):
+    ip = IP(src=f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}",
+            dst=f"10.0.0.{rng.randrange(1, 255)}")
+    if payload_len is None: payload_len = rng.randrange(0, 300)
+    payload = Raw(bytes(rng.randrange(256) for _ in range(payload_len)))
+    if vlan is None: vlan = rng.random() < 0.2
+    eth = Ether() / Dot1Q(vlan=rng.randrange(1, 4095)) if vlan else Ether()
+    if proto is TCP: return bytes(eth / ip / TCP() / payload)
+    if checksum == "random": checksum = rng.choice([0, None, rng.randrange(1, 0x10000)]) # Missing, correct or wrong
+    frame = bytes(eth / ip / UDP(sport=rng.randrange(1, 0x10000), dport=8000, chksum=checksum) / payload)
+    return frame.ljust(60, b'\x00') # Minimum Ethernet frame
+
+def scapy_normalize(frame):
+    # Frame rebuilt by scapy with chksum = None
+    packet = Ether(frame)
+    if UDP not in packet: return frame
+    udp_layer = packet[UDP]
+    udp_layer.chksum = None
+    udp_layer.chksum = Ether(bytes(packet))[UDP].chksum
+    return bytes(packet)
+
+def old_checksum(frame):
+    return struct.unpack_from('!H', frame, udp_offsets(frame)[1] + UDP_CHECKSUM_OFFSET)[0]
+
+@pytest.fixture(scope="module")
+def frames():
+    rng = random.Random(0)
+    return [random_frame(rng, proto=TCP if rng.random() < 0.05 else UDP) for _ in range(NUM_FRAMES)]
+
+def test_random_frames_match_scapy(frames):
+    for i, frame in enumerate(frames):
+        assert normalize_udp_checksum(frame) == scapy_normalize(frame), f"Frame {i} differs from scapy"
+
+@pytest.mark.parametrize("payload_len", [0, 1, 2, 17, 18, 1471])
+@pytest.mark.parametrize("vlan", [False, True])
+def test_payload_lengths_match_scapy(payload_len, vlan):
+    rng = random.Random(payload_len)
+    frame = random_frame(rng, checksum=0, payload_len=payload_len, vlan=vlan)
+    normalized = normalize_udp_checksum(frame)
+    assert normalized == scapy_normalize(frame)
+    assert old_checksum(normalized) == Ether(normalized)[UDP].chksum != 0
+
+def test_keep_checksums(frames):
+    # verify=False only adds the missing checksums
+    for i, frame in enumerate(frames):
+        expected = scapy_normalize(frame) if udp_offsets(frame) and not old_checksum(frame) else frame
+        assert normalize_udp_checksum(frame, verify=False) == expected, f"Frame {i} differs"
+
+def test_checksum_ignores_its_field():
+    rng = random.Random(1)
+    frame = random_frame(rng, checksum=0)
+    wrong = bytearray(frame)
+    struct.pack_into('!H', wrong, udp_offsets(frame)[1] + UDP_CHECKSUM_OFFSET, 0x1234)
+    assert udp_checksum(frame) == udp_checksum(wrong) == old_checksum(scapy_normalize(frame))
+
+def test_zero_checksum_sent_as_ffff():
+    # A computed checksum of 0 is sent as 0xFFFF: the last two payload bytes make the sum 0xFFFF
+    rng = random.Random(2)
+    frame = bytearray(random_frame(rng, checksum=0, payload_len=10, vlan=False))
+    end = udp_offsets(frame)[1] + 8 + 10
+    struct.pack_into('!H', frame, end - 2, 0)
+    struct.pack_into('!H', frame, end - 2, udp_checksum(frame)) # Adds the missing part of the sum
+    normalized = normalize_udp_checksum(bytes(frame))
+    assert old_checksum(normalized) == 0xFFFF
+    assert normalized == scapy_normalize(bytes(frame))
+
+def test_not_udp_unchanged():
+    rng = random.Random(3)
+    tcp = random_frame(rng, proto=TCP)
+    fragment = bytes(Ether() / IP(dst="10.0.0.1", frag=10, proto=17) / Raw(b"x" * 20))
+    truncated = random_frame(rng, checksum=0, payload_len=0, vlan=False)[:14 + 20 + 4]
+    for frame in (tcp, fragment, truncated, b"", b"\x00" * 13):
+        assert udp_offsets(frame) is None
+        assert normalize_udp_checksum(frame) == frame
+
+def test_input_not_modified():
+    frame = bytearray(random_frame(random.Random(4), checksum=0))
+    copy = bytes(frame)
+    assert normalize_udp_checksum(frame) != copy
+    assert frame == copy
+
+# Batch path
+
+@pytest.fixture(params=["numpy", "python"])
+def batch_backend(request, monkeypatch):
+    # udp_checksums() with NumPy, and its fallback of one frame at a time
+    if request.param == "numpy":
+        if checksum.np is None: pytest.skip("NumPy is not installed")
+    else:
+        monkeypatch.setattr(checksum, "np", None)
+    return request.param
+
+def internet_checksum(frame):
+    # RFC 1071 checksum of the pseudo-header and UDP datagram, summed one 16-bit word at a time
+    ip, udp = udp_offsets(frame)
+    length = udp_length(frame, udp)
+    datagram = bytearray(frame[udp:udp + length])
+    datagram[UDP_CHECKSUM_OFFSET:UDP_CHECKSUM_OFFSET + 2] = b'\x00\x00'
+    if length % 2: datagram += b'\x00'
+    data = frame[ip + 12:ip + 20] + struct.pack('!HH', 17, length) + bytes(datagram)
+    total = 0
+    for (word,) in struct.iter_unpack('!H', data):
+        total += word
+        total = (total & 0xFFFF) + (total >> 16)
+    checksum = ~total & 0xFFFF
+    return checksum or 0xFFFF
+
+def test_batch_checksums_match_scalar(frames, batch_backend):
+    checksums = udp_checksums(frames)
+    assert len(checksums) == len(frames)
+    for i, (frame, batch) in enumerate(zip(frames, checksums)):
+        if udp_offsets(frame) is None:
+            assert batch is None
+            continue
+        assert batch == udp_checksum(frame) == internet_checksum(frame), f"Frame {i} differs"
+
+def test_normalize_batch_matches_scalar(frames, batch_backend):
+    assert normalize_batch(frames) == [normalize_udp_checksum(frame) for frame in frames]
+    assert normalize_batch(frames, verify=False) == [normalize_udp_checksum(frame, verify=False) for frame in frames]
+    offsets = [udp_offsets(frame) for frame in frames]
+    assert normalize_batch(frames, offsets) == [scapy_normalize(frame) for frame in frames]
+
+def test_batch_without_udp_frames(batch_backend):
+    rng = random.Random(5)
+    frames = [random_frame(rng, proto=TCP), b""]
+    assert udp_checksums(frames) == [None, None]
+    assert udp_checksums([]) == []
+    assert normalize_batch(frames) == frames